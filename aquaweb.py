@@ -4,6 +4,8 @@
 
 import string
 import serial
+import collections
+import bisect
 import struct
 import threading
 import sys
@@ -12,13 +14,29 @@ import socket
 import os
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 import cgi
+import Queue
+import select
+import gzip
+import hashlib
+import StringIO
+import json
+import logging
+import logging.handlers
+import binascii
+import traceback
+import re
 
 
 # Configuration
 
-RS485Device = "/dev/rs485"        # RS485 serial device to be used
+RS485Device = os.environ.get("AQUAWEB_DEVICE", "/dev/rs485")  # RS485 serial device to be used
 debugData = False
 debugRaw = False
+fastAck = True      # ACK before processing a message rather than after
+pipelined = False   # apply updates in their own thread, off the ACK path
+captureFile = None  # append raw bus traffic to this file, for replay later
+replayFile = None   # read bus traffic from this capture instead of the port
+replaySpeed = 1.0   # replay at this multiple of real time, 0 for flat out
 
 # ASCII constants
 NUL = '\x00'
@@ -26,10 +44,46 @@ DLE = '\x10'
 STX = '\x02'
 ETX = '\x03'
 
+# Receive decoder states
+HUNT = 0        # looking for the DLE of a DLE STX
+HUNT_DLE = 1    # got a DLE, looking for the STX
+BODY = 2        # inside a frame
+BODY_DLE = 3    # got a DLE inside a frame
+MAXFRAME = 128  # longest frame we'll believe before resyncing
+
+# Histogram bucket edges for ACK latency and HTTP request time, in seconds
+ACKBUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+HTTPBUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+KEYQUEUE = 8        # key presses a device will hold until the controller polls
+PIPEQUEUE = 256     # frames the updater may fall behind before the reader applies them itself
+KEYREPEAT = "keep"  # repeats of the last queued key: "keep", "collapse" or "reject"
+
+# Telemetry history for /history, sampled now and then and kept in fixed memory
+SAMPLEPERIOD = 10   # seconds between samples of each metric
+SAMPLES = 360       # raw samples kept per metric, an hour's worth
+MINUTES = 1440      # minute rollups kept per metric, a day's worth
+HOURS = 720         # hour rollups kept per metric, 30 days' worth
+
+# Logging, done by a background thread so the bus never waits on a write
+LOGFILE = "aquaweb.log"  # log file, rotated by size
+LOGBYTES = 1000000  # size the log file grows to before it's rotated
+LOGBACKUPS = 3      # rotated log files kept, aquaweb.log.1 to aquaweb.log.3
+LOGQUEUE = 1000     # records waiting to be written, any more are dropped and counted
+LOGECHO = True      # write the log to stdout as well
+
+# Capture files are a series of records, each this header followed by
+# length raw bytes as they crossed the bus
+CAPHEAD = struct.Struct("!dBH")  # time.time(), direction, length
+CAPRX = 0   # bytes we received
+CAPTX = 1   # bytes we sent
+CAPQUEUE = 1000  # records waiting to be written, any more are dropped and counted
+
 masterAddr = '\x00'          # address of Aqualink controller
-last_log = ""
-ID = "40"
-SPAID = "20"
+ID = 0x40      # square remote served at /, and at /40/ like any other
+SPAID = 0x20   # SpaLink served at /spa.html, and at /20/spa.html
+REMOTES = (ID,)     # square remotes to emulate, any of 0x40-0x43
+SPAS = (SPAID,)     # SpaLinks to emulate, any of 0x20-0x23
 
 
 INDEXHTML = """
@@ -46,35 +100,64 @@ if (window.XMLHttpRequest) {
     var xmlHttpReqScreen = new ActiveXObject("Microsoft.XMLHTTP");
 }
 
-function screen() {
-    xmlhttpPost(xmlHttpReqScreen, "/screen.cgi", "", "screen");
+var version = -1;  /* of the screen we're showing */
+
+function delta() {
+    xmlHttpReqScreen.open('GET', "screen.delta?since=" + version, true);
+    xmlHttpReqScreen.onreadystatechange = function() {
+        if (xmlHttpReqScreen.readyState == 4) {
+            if (xmlHttpReqScreen.status == 200) {
+                patch(JSON.parse(xmlHttpReqScreen.responseText));
+            }
+            setTimeout(delta, 250);
+        }
+    }
+    xmlHttpReqScreen.send(null);
+}
+
+function patch(d) {  /* A full screen rebuilds it, a delta swaps in just the changed lines */
+    if (d.full) {
+        var html = "";
+        for (var n = 0; n < d.lines.length; n++) {
+            html += '<span id="line' + n + '">' + d.lines[n] + '</span>\\n';
+        }
+        document.getElementById("screen").innerHTML = "<pre>" + html + "</pre>";
+    } else {
+        for (var n in d.lines) {
+            document.getElementById("line" + n).innerHTML = d.lines[n];
+        }
+    }
+    version = d.version;
 }
 
 function sendkey(key) {
-    xmlhttpPost(xmlHttpReqKey, "/key.cgi", "key="+key);
+    xmlhttpPost(xmlHttpReqKey, "key.cgi", "key="+key);
 }
 
-function xmlhttpPost(xmlReq, strURL, params, update) {
+function xmlhttpPost(xmlReq, strURL, params) {
     xmlReq.open('POST', strURL, true);
     xmlReq.setRequestHeader("Content-type","application/x-www-form-urlencoded");
     xmlReq.send(params);
-    if (update != "") {
-      xmlReq.onreadystatechange = function() {
-        if (xmlReq.readyState == 4) {
-            updatepage(xmlReq.responseText, update);
-        }
-      }
-    }
-    xmlReq.send();
 }
 
-function updatepage(str, div){
-    document.getElementById(div).innerHTML = str;
-    setTimeout(window[div](), 250);
+function start() {
+    if (window.EventSource) {  /* Server pushes the changes to the screen */
+        var events = new EventSource("screen.events");
+        events.onmessage = function(e) {
+            patch(JSON.parse(e.data));
+        };
+        events.onerror = function(e) {
+            if (events.readyState == 2) {  /* Refused, server is busy */
+                delta();
+            }
+        };
+    } else {
+        delta();
+    }
 }
 </script>
 </head>
-<body onload="screen();">
+<body onload="start();">
 <table>
 <tr>
 <td>
@@ -111,39 +194,67 @@ if (window.XMLHttpRequest) {
 }
 
 function screen() { /* Ping-pong between lights and lcd */
-    xmlhttpPost(xmlHttpReqStatus, "/spastatus.cgi", "", "cstat");
+    xmlhttpPost(xmlHttpReqStatus, "spastatus.cgi", "", "cstat");
 }
 
 function cstat() {
-    xmlhttpPost(xmlHttpReqScreen, "/spascreen.cgi", "", "screen");
+    xmlhttpPost(xmlHttpReqScreen, "spascreen.cgi", "", "screen");
 }
 
 function sendkey(key) {
-    xmlhttpPost(xmlHttpReqKey, "/spakey.cgi", "key="+key);
+    xmlhttpPost(xmlHttpReqKey, "spakey.cgi", "key="+key);
 }
 
 function xmlhttpPost(xmlReq, strURL, params, update) {
     xmlReq.open('POST', strURL, true);
     xmlReq.setRequestHeader("Content-type","application/x-www-form-urlencoded");
-    xmlReq.send(params);
     if (update != "") {
+      if (xmlReq.etag) {  /* Server says 304 if the screen hasn't changed */
+        xmlReq.setRequestHeader("If-None-Match", xmlReq.etag);
+      }
       xmlReq.onreadystatechange = function() {
         if (xmlReq.readyState == 4) {
-            updatepage(xmlReq.responseText, update);
+            if (xmlReq.status == 304) {
+                updatepage(null, update);
+            } else {
+                xmlReq.etag = xmlReq.getResponseHeader("ETag");
+                updatepage(xmlReq.responseText, update);
+            }
         }
       }
     }
-    xmlReq.send();
+    xmlReq.send(params);
 }
 
 function updatepage(str, div){
-    document.getElementById(div).innerHTML = str;
-    setTimeout(window[div](), 125);
+    if (str != null) {
+        document.getElementById(div).innerHTML = str;
+    }
+    setTimeout(window[div], 125);
+}
+
+function start() {
+    if (window.EventSource) {  /* Server pushes the LCD and lights when they change */
+        var events = new EventSource("spa.events");
+        events.addEventListener("screen", function(e) {
+            document.getElementById("screen").innerHTML = e.data;
+        });
+        events.addEventListener("status", function(e) {
+            document.getElementById("cstat").innerHTML = e.data;
+        });
+        events.onerror = function(e) {
+            if (events.readyState == 2) {  /* Refused, server is busy */
+                cstat();
+            }
+        };
+    } else {
+        cstat();
+    }
 }
 
 </script>
 </head>
-<body onload="cstat(); screen();">
+<body onload="start();">
 <table>
 <tr>
 <td><div id="screen"></div></td>
@@ -173,45 +284,331 @@ function updatepage(str, div){
 </html>
 """
 
-PORT = 80
+PORT = int(os.environ.get("AQUAWEB_PORT", 80))
+HTTPTHREADS = 16    # web worker threads, each open event stream holds one
+MAXSTREAMS = 8      # event streams allowed at once, pages poll after that
+IDLETIMEOUT = 5.0   # seconds an idle keep-alive connection is kept open
+STARTED = int(time.time())  # makes ETags unique to this run
+PAGEMAXAGE = 3600   # seconds browsers may cache the static pages
+KEEPALIVE = 15      # seconds between keepalives on idle event streams
+HISTORY = 32        # screen versions kept for sending clients just the changed lines
 
 
 class webHandler(BaseHTTPRequestHandler):
     """CGI and dummy web page handler to interface to control objects."""
-    screen = None
+    protocol_version = "HTTP/1.1"  # keep-alive, so every reply needs a length
+    wbufsize = -1  # send each reply in one go, flushed by handle_one_request
+    # Read ahead only where buffered() can see what was read, see there
+    rbufsize = hasattr(socket, '_fileobject') and -1 or 0
+    streams = threading.BoundedSemaphore(MAXSTREAMS)  # event streams open
+    screen = None  # the devices a request talks to, see route()
     spa = None
+    devices = {}   # address -> Screen or Spa
+    interface = None
+    httpTimes = None  # Histogram of request handling time, streams excluded
+    httpCodes = collections.defaultdict(int)  # replies sent by status code
+    httpLock = threading.Lock()
+    pages = {}
+    states = {}  # (screen, spa) -> last (version, JSON) from stateJson()
 
     def log_request(self, code='-', size='-'):
-        """Don't log anything, we're on an embedded system"""
-        pass
+        """Don't log anything, we're on an embedded system.  Just note the
+        code for /metrics."""
+        self.code = code
 
     def log_error(self, fmt, *args):
-        """This was an error, dump it."""
-        self.log_message(fmt, *args)
+        """This was an error, dump it.  Idle keep-alives timing out aren't."""
+        if not fmt.startswith("Request timed out"):
+            self.log_message(fmt, *args)
+
+    def sendEvents(self, device, events):
+        """Stream Server-Sent Events to the client, a new set each time the
+        device changes.  events(device, since) returns the version they
+        bring the client up to from version since, and the (name, data)
+        pairs."""
+        if not self.streams.acquire(False):
+            self.send_error(503, 'Too many event streams')
+            return
+        try:
+            self.streamEvents(device, events)
+        finally:
+            self.streams.release()
+
+    def streamEvents(self, device, events):
+        """Send the event stream, each open one holds a server worker."""
+        self.stream = True  # not a request to time
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')  # The stream ends with the connection
+        self.end_headers()
+        self.close_connection = 1
+        version = None
+        try:
+            while True:
+                current = device.waitChange(version)
+                if current != version:
+                    version, pairs = events(device, version)
+                    ret = ""
+                    for name, data in pairs:
+                        ret += eventText(name, data)
+                    self.wfile.write(ret)
+                else:
+                    self.wfile.write(": keepalive\n\n")
+                self.wfile.flush()
+        except socket.error:
+            pass  # Client went away
+
+    def handle(self):
+        """Handle the request that woke the connection.  The server parks
+        the connection between keep-alive requests rather than a worker
+        waiting on it, but requests a client pipelined behind this one are
+        already read into rfile's buffer where select() can't see them, so
+        those are handled first."""
+        self.handleOne()
+        while not self.close_connection and self.buffered():
+            self.handleOne()
+
+    def buffered(self):
+        """Whether rfile holds bytes already read off the socket.  This
+        looks at the read buffer of Python 2.7's socket._fileobject, a
+        private detail; rbufsize turns read-ahead off where there's no
+        such thing, so nothing can be left in a buffer when we park."""
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf is not None and rbuf.tell() > 0
+
+    def handleOne(self):
+        """Handle one request, timing it for /metrics."""
+        self.close_connection = 1
+        self.screen, self.spa = webHandler.screen, webHandler.spa  # until route() says otherwise
+        self.code = None
+        self.stream = False
+        start = time.time()
+        self.handle_one_request()
+        if self.code and not self.stream:
+            self.httpLock.acquire()
+            try:
+                self.httpTimes.add(time.time() - start)
+                self.httpCodes[self.code] += 1
+            finally:
+                self.httpLock.release()
+
+    def sendPage(self, page):
+        """Send a static page built by staticPage(), gzipped if the client
+        takes it, or just a 304 if the client's copy is current."""
+        if acceptsGzip(self.headers.getheader('accept-encoding')):
+            ret, etag, encoding = page['gzip'], page['etag'] + '-gz', 'gzip'
+        else:
+            ret, etag, encoding = page['body'], page['etag'], None
+        etag = '"' + etag + '"'
+        matches = [t.strip() for t in (self.headers.getheader('if-none-match') or "").split(",")]
+        if etag in matches or "*" in matches:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'max-age=%d' % PAGEMAXAGE)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'max-age=%d' % PAGEMAXAGE)
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def queueKeys(self, device, postvars):
+        """Queue the posted keys on device and return the reply page.
+        Takes any number of key=<key> fields and a comma separated
+        keys=<key>,<key>,... field, queued in that order."""
+        keys = list(postvars.get('key', []))
+        for field in postvars.get('keys', []):
+            keys += [key for key in field.split(",") if key]
+        sent = []
+        refused = []
+        for key in keys:
+            if device.sendKey(key):
+                sent.append(key)
+            else:
+                refused.append(key)
+        ret = "<html><head><title>key</title></head><body>" + cgi.escape(" ".join(sent))
+        if refused:
+            ret += "<br>refused: " + cgi.escape(" ".join(refused))
+        return ret + "</body></html>\n"
+
+    def route(self):
+        """Point this request at the device named by an /<address>/ prefix,
+        e.g. /41/key.cgi or /21/spa.html, and strip the prefix.  Without
+        one the first remote and spa are used.  False if there's no such
+        device."""
+        if self.path[3:4] != "/":
+            return True
+        try:
+            device = self.devices[int(self.path[1:3], 16)]
+        except (ValueError, KeyError):
+            return False
+        if isinstance(device, Spa):
+            self.spa = device
+        else:
+            self.screen = device
+        self.path = self.path[3:]
+        return True
+
+    def sendMetrics(self):
+        """Send the bus and web server counters in Prometheus text format."""
+        ret = self.interface.metrics()
+        self.httpLock.acquire()
+        try:
+            ret += promHeader("aquaweb_http_requests_total", "counter",
+                              "HTTP replies sent, by status code.")
+            for code, count in sorted(self.httpCodes.items()):
+                ret += 'aquaweb_http_requests_total{code="%s"} %d\n' % (code, count)
+            ret += promHeader("aquaweb_http_request_seconds", "histogram",
+                              "Time to handle an HTTP request, event streams excluded.")
+            ret += self.httpTimes.prometheus("aquaweb_http_request_seconds")
+        finally:
+            self.httpLock.release()
+        ret += logs.metrics()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def sendState(self):
+        """Send the state snapshot as JSON, or 304 if the client has it."""
+        version, ret = self.states.get((self.screen, self.spa), (None, None))
+        if version != self.screen.snap.version + self.spa.snap.version:
+            version, ret = stateJson(self.screen, self.spa)
+            self.states[(self.screen, self.spa)] = (version, ret)
+        etag = versionTag(version)
+        if self.headers.getheader('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def sendCells(self):
+        """Send the screen snapshot as it's stored, the character cells
+        then their attribute bytes, or 304 if the client has it."""
+        snap = self.screen.snap
+        etag = versionTag(snap.version)
+        if self.headers.getheader('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Screen-Size', "%dx%d" % (self.screen.W, self.screen.H))
+        self.send_header('Content-Length', str(len(snap.cells) + len(snap.attrs)))
+        self.end_headers()
+        self.wfile.write(snap.cells)
+        self.wfile.write(snap.attrs)
+
+    def sendDelta(self):
+        """Send the screen lines changed since the version in the query,
+        e.g. /screen.delta?since=5f0c1a2b-42, or the whole screen without
+        one or with one from another run."""
+        query = cgi.parse_qs(self.path.partition("?")[2])
+        try:
+            run, since = query['since'][0].split("-")
+            if int(run, 16) != STARTED:
+                since = None
+            else:
+                since = int(since)
+        except (KeyError, ValueError):
+            since = None
+        version, ret = self.screen.delta(since)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def sendHistory(self, history):
+        """Send /history?metric=<name>&from=<time>[&res=raw|minute|hour]
+        as JSON.  from is a Unix time, or seconds ago if not above 0, and
+        defaults to an hour ago.  Without a metric, list them."""
+        query = cgi.parse_qs(self.path.partition("?")[2])
+        metric = query.get('metric', [None])[0]
+        resolution = query.get('res', [None])[0]
+        try:
+            since = float(query.get('from', [-3600])[0])
+        except ValueError:
+            self.send_error(400, 'Bad from time')
+            return
+        if since <= 0:
+            since += time.time()
+        if resolution not in (None, 'raw', 'minute', 'hour'):
+            self.send_error(400, 'Bad resolution')
+            return
+        ret = history.query(metric, since, resolution)
+        if ret is None:
+            self.send_error(404, 'No such metric: %s' % metric)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
 
     #Handler for the GET requests
     def do_GET(self):
-        """HTTP GET handler, only the html files allowed."""
+        """HTTP GET handler, only the html files, state and event streams allowed."""
+        if not self.route():
+            self.send_error(404, 'File Not Found: %s' % self.path)
+            return
         if self.path == "/":
             self.path = "/index.html"
+        if self.path == "/metrics":
+            self.sendMetrics()
+            return
+        if self.path.startswith("/screen.events"):
+            self.sendEvents(self.screen, deltaEvents)
+            return
+        if self.path.startswith("/state.json"):
+            self.sendState()
+            return
+        if self.path.startswith("/screen.bin"):
+            self.sendCells()
+            return
+        if self.path.startswith("/screen.delta"):
+            self.sendDelta()
+            return
+        if self.path.startswith("/history"):
+            self.sendHistory(self.spa.history)
+            return
+        if self.path.startswith("/spa.events"):
+            self.sendEvents(self.spa, lambda spa, since: (spa.snap.version,
+                [("screen", spa.html()), ("status", spa.statusText())]))
+            return
         # We only serve some static stuff
-        if (self.path.startswith("/spa.html") or
-           self.path.startswith("/index.html")):
-            mimetype = 'text/html'
-            ret = ""
-            if self.path.startswith("/index.html"):
-                ret = INDEXHTML
-            elif self.path.startswith("/spa.html"):
-                ret = SPAHTML
-            self.send_response(200)
-            self.send_header('Content-Type', mimetype)
-            self.end_headers()
-            self.wfile.write(ret)
-        else:
-            self.send_error(404, 'File Not Found: %s' % self.path)
+        for name, page in self.pages.items():
+            if self.path.startswith(name):
+                self.sendPage(page)
+                return
+        self.send_error(404, 'File Not Found: %s' % self.path)
 
     def do_POST(self):
         """HTTP POST handler.  CGI "scripts" handled here."""
+        if not self.route():
+            self.send_error(404, 'File Not Found: %s' % self.path)
+            return
         ctype, pdict = cgi.parse_header(self.headers.getheader('content-type'))
         try:
             if ctype == 'multipart/form-data':
@@ -229,71 +626,254 @@ class webHandler(BaseHTTPRequestHandler):
            self.path.startswith("/screen.cgi") or
            self.path.startswith("/spascreen.cgi") or
            self.path.startswith("/status.cgi") or
-           self.path.startswith("/spastatus.cgi")):
+           self.path.startswith("/spastatus.cgi") or
+           self.path.startswith("/acktimes.cgi")):
             mimetype = 'text/html'
             ret = ""
+            # Display polls can be answered 304 if nothing has changed
+            etag = None
+            if self.path.startswith("/screen.cgi"):
+                etag = versionTag(self.screen.snap.version)
+            elif (self.path.startswith("/spascreen.cgi") or
+                  self.path.startswith("/spastatus.cgi")):
+                etag = versionTag(self.spa.snap.version)
+            if etag and self.headers.getheader('if-none-match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
             if self.path.startswith("/key.cgi"):
-                if 'key' in postvars:
-                    key = postvars['key'][0]
-                    self.screen.sendKey(key)
-                ret = "<html><head><title>key</title></head><body>"+key+"</body></html>\n"
+                ret = self.queueKeys(self.screen, postvars)
             elif self.path.startswith("/spakey.cgi"):
-                if 'key' in postvars:
-                    key = postvars['key'][0]
-                    self.spa.sendKey(key)
-#                    print "SPA - key "+key
-                    ret = "<html><head><title>key</title></head><body>"+key+"</body></html>\n"
+                ret = self.queueKeys(self.spa, postvars)
             elif self.path.startswith("/spabinary.cgi"):
-                ret = self.spa.text() + "|" + time.strftime("%_I:%M%P %_m/%d") + "|"
-                if (self.spa.status['spa']=="ON"): ret += "1"
+                snap = self.spa.snap
+                ret = snap.text + "|" + time.strftime("%_I:%M%P %_m/%d") + "|"
+                if (snap.status['spa']=="ON"): ret += "1"
                 else: ret += "0"
-                if (self.spa.status['heat']=="ON"): ret += "1"
+                if (snap.status['heat']=="ON"): ret += "1"
                 else: ret += "0"
-                if (self.spa.status['jets']=="ON"): ret += "1"
+                if (snap.status['jets']=="ON"): ret += "1"
                 else: ret += "0"
             elif self.path.startswith("/screen.cgi"):
                 ret = self.screen.html()
             elif self.path.startswith("/spascreen.cgi"):
                 ret = self.spa.html()
             elif self.path.startswith("/status.cgi"):
-                ret = self.screen.status
+                ret = self.screen.snap.status
             elif self.path.startswith("/spastatus.cgi"):
-                ret = self.spa.status
+                ret = self.spa.statusText()
+            elif self.path.startswith("/acktimes.cgi"):
+                mimetype = 'text/plain'
+                ret = self.interface.ackTimes.text()
             self.send_response(200)
             self.send_header('Content-Type', mimetype)
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Length', str(len(ret)))
             self.end_headers()
             self.wfile.write(ret)
         else:
             self.send_error(404, 'File Not Found: %s' % self.path)
 
 
-class MyServer(HTTPServer):
-    """Override some HTTPServer procedures to allow instance variables and timeouts."""
-    def serve_forever(self, screen, spa):
-        """Store the screen and spa objects and serve until end of times."""
-        self.RequestHandlerClass.screen = screen 
-        self.RequestHandlerClass.spa = spa 
-        HTTPServer.serve_forever(self)
+def stateJson(screen, spa):
+    """Turn the current snapshots of the square remote and the spa into
+    (version, JSON text).  The version goes up whenever either of them
+    changes."""
+    snap = screen.snap
+    spasnap = spa.snap
+    version = snap.version + spasnap.version
+    state = {'version': version,
+             'screen': {'lines': screen.rows(snap.cells),
+                        'invert': [{'line': line, 'start': start, 'end': end - 1}
+                                   for line, start, end in screen.inverted(snap.attrs)],
+                        'status': snap.status,
+                        'version': snap.version},
+             'spa': {'text': spasnap.text,
+                     'status': spasnap.status,
+                     'version': spasnap.version}}
+    return version, json.dumps(state, encoding="latin-1")
+
+
+def staticPage(html):
+    """Prepare a static page once: the plain and gzipped bodies and a
+    strong ETag from its contents."""
+    buf = StringIO.StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    gz.write(html)
+    gz.close()
+    return {'body': html, 'gzip': buf.getvalue(), 'etag': hashlib.md5(html).hexdigest()}
+
+
+def acceptsGzip(header):
+    """Check an Accept-Encoding header for gzip (not refused with q=0)."""
+    for coding in (header or "").split(","):
+        params = coding.split(";")
+        if params[0].strip().lower() in ("gzip", "x-gzip", "*"):
+            for param in params[1:]:
+                name, _, value = param.strip().partition("=")
+                try:
+                    if name == "q" and float(value) == 0:
+                        return False
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def versionTag(version):
+    """Return an ETag for a display version.  The start time is mixed in
+    so tags from before a restart never match."""
+    return '"%x-%d"' % (STARTED, version)
+
+
+def runVersion(version):
+    """Return a display version as clients see it, with the start time
+    mixed in like versionTag() so one from before a restart never matches."""
+    return "%x-%d" % (STARTED, version)
+
+
+class PoolMixIn:
+    """Mix-in handing connections to a fixed pool of worker threads.
+
+    A worker only holds a connection while it handles one request.  Idle
+    keep-alive connections are parked and watched with select() by the
+    serving thread, and go back in the queue when the next request arrives.
+    When every worker is busy, ready connections wait in the queue."""
+
+    def servePool(self, size):
+        """Start size worker threads and serve until the end of times."""
+        self.requests = Queue.Queue()
+        self.idle = {}  # parked socket -> (client address, parked at)
+        self.idleLock = threading.Lock()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for n in range(size):
+            worker = threading.Thread(target=self.worker)
+            worker.daemon = True
+            worker.start()
+        while True:
+            self.idleLock.acquire()
+            try:
+                parked = self.idle.keys()
+            finally:
+                self.idleLock.release()
+            ready = select.select([self.socket, self.wakeRead] + parked, [], [], 1.0)[0]
+            now = time.time()
+            self.idleLock.acquire()
+            try:
+                for sock in ready:
+                    if sock is self.socket:
+                        self._handle_request_noblock()
+                    elif sock == self.wakeRead:
+                        os.read(self.wakeRead, 512)  # just a wake up
+                    elif sock in self.idle:
+                        self.requests.put((sock, self.idle.pop(sock)[0]))
+                for sock, (client_address, since) in self.idle.items():
+                    if now - since > IDLETIMEOUT:
+                        del self.idle[sock]
+                        self.shutdown_request(sock)
+            finally:
+                self.idleLock.release()
+
+    def worker(self):
+        """Handle one request at a time from the queue, forever."""
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                keep = not self.finish_request(request, client_address).close_connection
+            except:
+                self.handle_error(request, client_address)
+                keep = False
+            if keep:
+                self.idleLock.acquire()
+                try:
+                    self.idle[request] = (client_address, time.time())
+                finally:
+                    self.idleLock.release()
+                os.write(self.wakeWrite, "x")
+            else:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """Queue a new connection for the next free worker."""
+        self.requests.put((request, client_address))
+
+    def finish_request(self, request, client_address):
+        """Handle one request, returning the handler."""
+        return self.RequestHandlerClass(request, client_address, self)
+
+
+def eventText(name, data):
+    """Format one Server-Sent Event, a data: field per line of data."""
+    ret = ""
+    if name:
+        ret += "event: " + name + "\n"
+    for line in data.split("\n"):
+        ret += "data: " + line + "\n"
+    return ret + "\n"
+
+
+def deltaEvents(screen, since):
+    """The event that brings a client showing version since of screen up
+    to date, for sendEvents()."""
+    version, ret = screen.delta(since)
+    return version, [(None, ret)]
+
+
+class MyServer(PoolMixIn, HTTPServer):
+    """Override some HTTPServer procedures to allow instance variables and timeouts.
+    Connections are handled by a fixed pool of worker threads, so one slow
+    client or event stream doesn't hold up the rest."""
+
+    def serve_forever(self, devices, interface):
+        """Store the devices and interface objects and serve until end of times."""
+        self.RequestHandlerClass.screen = devices[REMOTES[0]]
+        self.RequestHandlerClass.spa = devices[SPAS[0]]
+        self.RequestHandlerClass.devices = devices
+        self.RequestHandlerClass.interface = interface
+        self.RequestHandlerClass.httpTimes = Histogram(HTTPBUCKETS)
+        self.RequestHandlerClass.pages = {"/index.html": staticPage(INDEXHTML),
+                                          "/spa.html": staticPage(SPAHTML)}
+        self.servePool(HTTPTHREADS)
     def get_request(self):
         """Get the request and client address from the socket."""
-        self.socket.settimeout(1.0)
-        result = None
-        while result is None:
-            try:
-                result = self.socket.accept()
-            except socket.timeout:
-                pass
-        result[0].settimeout(1.0)
-        return result
+        request, client_address = self.socket.accept()
+        request.settimeout(IDLETIMEOUT)
+        return request, client_address
+
+
+def keepAlive(devices):
+    """Wake up event streams now and then so they can notice dead clients."""
+    while True:
+        time.sleep(KEEPALIVE)
+        for device in devices:
+            device.poke()
 
 
-def startServer(screen, spa):
+def sampler(spas):
+    """Record each spa's status in its history every SAMPLEPERIOD."""
+    while True:
+        time.sleep(SAMPLEPERIOD)
+        for spa in spas:
+            spa.sample()
+
+
+def startServer(devices, interface):
     """HTTP Server implementation, to be in separate thread from main code."""
     try:
         server = MyServer(('', PORT), webHandler)
         print 'Started httpserver on port ' , PORT
+        ticker = threading.Thread(target=keepAlive, args=(devices.values(),))
+        ticker.daemon = True
+        ticker.start()
+        spas = [device for device in devices.values() if isinstance(device, Spa)]
+        recorder = threading.Thread(target=sampler, args=(spas,))
+        recorder.daemon = True
+        recorder.start()
         # Wait forever for incoming http requests
-        server.serve_forever(screen, spa)
+        server.serve_forever(devices, interface)
     except KeyboardInterrupt:
         print '^C received, shutting down the web server'
         server.socket.close()
@@ -302,114 +882,149 @@ def startServer(screen, spa):
 class Spa(object):
     """Emulate spa-side controller with LCD display."""
     lock = None
-    nextAck = "00"
     status = {}
+    KEYS = {'1': 0x09, '2': 0x06, '3': 0x03, '4': 0x08, '5': 0x02, '6': 0x07, '7': 0x04, '8': 0x01, '*': 0x05}
+    TEMP = re.compile(r"^ *(\d+) (H2O|AIR)$")
 
     def __init__(self):
-        self.screen = "---"
-        self.status = {'spa': "UNK", 'jets': "UNK", 'heat': "UNK"}
-        self.nextAck = "00"
-        self.lock = threading.Lock()
+        self.snap = SpaSnapshot("---", {'spa': "UNK", 'jets': "UNK", 'heat': "UNK"}, 0)
+        self.lock = threading.Lock()  # serializes changes, readers just take snap
+        self.changed = threading.Condition(self.lock)
+        self.acks = ackFrames(0x00, self.KEYS.values())
+        self.keys = KeyQueue(KEYQUEUE, KEYREPEAT)
+        self.history = History()
+
+    def _publish(self, snap):
+        """Make snap, with the next version, what readers see, and wake up
+        anyone waiting on a change.  Called with the lock held."""
+        self.snap = snap._replace(version=self.snap.version + 1)
+        self.changed.notifyAll()
+
+    def waitChange(self, version):
+        """Wait until our version differs from version, or for the next
+        keepalive poke, and return the current version."""
+        self.lock.acquire()
+        try:
+            if self.snap.version == version:
+                self.changed.wait()
+            return self.snap.version
+        finally:
+            self.lock.release()
 
-    def sendAck(self, i):
-        """Tell controller we got messag, including keypresses in response."""
-        ackstr = "00" + self.nextAck
-#	print "SPACK: "+ackstr
-        i.sendMsg((chr(0), chr(1), ackstr.decode("hex")))
-        self.nextAck = "00"
+    def poke(self):
+        """Wake up waiters without changing anything."""
+        self.lock.acquire()
+        try:
+            self.changed.notifyAll()
+        finally:
+            self.lock.release()
 
-    def setNextAck(self, nextAck):
-        """Set value to send on next controller ping."""
-        self.nextAck = nextAck
+    def sendAck(self, i, ret):
+        """Tell controller we got messag, including keypresses in response."""
+        i.sendAck(ret, self.acks[self.keys.get()])
 
     def sendKey(self, key):
-        """Send a key on the next ack"""
-        keyToAck = {'1': "09", '2': "06", '3': "03", '4': "08", '5': "02", '6': "07", '7': "04", '8': "01", '*': "05"}
-        if key in keyToAck.keys():
-            self.setNextAck(keyToAck[key])
+        """Queue a key for the next free ack.  Return False if refused."""
+        if key in self.KEYS:
+            return self.keys.put(self.KEYS[key])
+        return False
 
     def update(self, args):
         """Update the 7-segment LCD display."""
 #        print "SPAUPDATE"
+        args = args.tobytes()
+        text = args[1:4]
+        if args[1:7] == " . . .":
+            screen = "... ..."
+        else:
+            screen = text
+            if args[5:6] == "\x01":
+                screen += " SET"
+            elif args[9:10] == "!":
+                screen += " AIR"
+            elif args[7:8] == "!":
+                screen += " H2O"
+            else:
+                log("spa: unknown display %s", Lazy(binascii.hexlify, args))
+            if text == "0FF":
+                screen = "OFF H2O"
         self.lock.acquire()
         try:
-            text = args[1:4]
-            if args[1:7] == " . . .":
-                self.screen = "... ..."
-            else:
-                self.screen = text
-                if ord(args[5:6]) == 1:
-                    self.screen += " SET"
-                elif ord(args[9:10]) == 33:
-                    self.screen += " AIR"
-                elif ord(args[7:8]) == 33:
-                    self.screen += " H2O"
-                else:
-                    print args.encode("hex")
-                if text == "0FF":
-                    self.screen = "OFF H2O"
+            if screen != self.snap.text:
+                self._publish(self.snap._replace(text=screen))
         finally:
             self.lock.release()
 #            print "SPATEXT: "+text
 
     def setStatus(self, stat):
         """Process the status into a string for HTML return"""
+        status = {}
         try:
-            if ord(stat[0:1]) & 16:
-                self.status['spa'] = 'ON'
+            bits = ord(stat[0])
+            if bits & 16:
+                status['spa'] = 'ON'
             else:
-                self.status['spa'] = 'OFF'
-            if ord(stat[0:1]) & 1:
-                self.status['jets'] = 'ON'
+                status['spa'] = 'OFF'
+            if bits & 1:
+                status['jets'] = 'ON'
             else:
-                self.status['jets'] = 'OFF'
-            if ord(stat[0:1]) & 8:
-                self.status['heat'] = 'ON'
+                status['jets'] = 'OFF'
+            if bits & 8:
+                status['heat'] = 'ON'
             else:
-                self.status['heat'] = 'OFF'
+                status['heat'] = 'OFF'
         except:
-            self.status = {'spa': "UNK", 'jets': "UNK", 'heat': "UNK"}
-
-    def html(self):
-        """Return HTML formatted 7-segment display"""
+            status = {'spa': "UNK", 'jets': "UNK", 'heat': "UNK"}
         self.lock.acquire()
         try:
-            ret = "<pre>"
-            ret += self.screen
-            ret += "</pre>"
+            if status != self.snap.status:
+                self._publish(self.snap._replace(status=status))
         finally:
             self.lock.release()
-        return ret
+
+    def sample(self):
+        """Record the equipment status, and the temperature on the display
+        if it's showing one, in the history."""
+        snap = self.snap
+        values = {}
+        for name in ('spa', 'jets', 'heat'):
+            values[name] = {'ON': 1, 'OFF': 0}.get(snap.status[name])
+        temp = self.TEMP.match(snap.text)
+        if temp:
+            values[temp.group(2) == "H2O" and 'tempwater' or 'tempair'] = int(temp.group(1))
+        self.history.record(values)
+
+    def statusText(self):
+        """Return the equipment status as a line of text"""
+        status = self.snap.status
+        return "SPA: %s  JETS: %s  HEAT: %s" % (status['spa'], status['jets'], status['heat'])
+
+    def html(self):
+        """Return HTML formatted 7-segment display"""
+        return "<pre>" + self.snap.text + "</pre>"
 
     def text(self):
         """Return plain 7-character display"""
-        ret = self.screen
-        return ret
+        return self.snap.text
 
-    def processMessage(self, ret, i):
-        """Handle controller messages to us"""
-        if ret['cmd'] == "03":  # Text status
+    def processMessage(self, ret):
+        """Handle controller messages to us, the ACK is sent separately."""
+        if ret.cmd == 0x03:  # Text status
 #            print "SPA-TEXT"
-            self.sendAck(i)
-            self.update(ret['args'])
-        elif ret['cmd'] == "09":  # Change send ??
+            self.update(ret.args)
+        elif ret.cmd == 0x09:  # Change send ??
 #            print "SPA-CHANGE"
-            self.sendAck(i)
-            try:
-                equip = ord(ret['args'][0:1])
-                state = ord(ret['args'][1:2])
-            except:
-                pass
-        elif ret['cmd'] == "02":  # Status binary
+            equip = ret.arg(0)
+            state = ret.arg(1)
+        elif ret.cmd == 0x02:  # Status binary
 #            print "SPA-BSTATUS"
-            self.sendAck(i)
-            self.setStatus(ret['args'])
-        elif ret['cmd'] == "00":  # Probe
+            self.setStatus(ret.args)
+        elif ret.cmd == 0x00:  # Probe
 #            print "SPA-PROBE"
-            self.sendAck(i)
+            pass
         else:
 #            print "SPA-UNKCMD"
-            self.sendAck(i)
+            pass
 
 
 class Screen(object):
@@ -418,188 +1033,787 @@ class Screen(object):
     H = 12
     UNDERLINE = '\033[4m'
     END = '\033[0m'
+    INVERSE = '\x01'  # attribute byte of an inverted cell
+    INVERTED = re.compile('\x01+')
     lock = None
-    nextAck = "00"
+    KEYS = { 'up':0x06, 'down':0x05, 'back':0x02, 'select':0x04, 'pgup':0x01, 'pgdn':0x03 }
 
     def __init__(self):
         """Set up the instance"""
         self.dirty = 1
-        self.screen = self.W * [self.H * " "]
-        self.invert = {'line':-1, 'start':-1, 'end':-1}
-        self.status = "00000000"
-        self.lock = threading.Lock()
+        self.blank = self.H * self.W * " "  # cells of a clear screen
+        self.plain = self.H * self.W * NUL  # attrs with nothing inverted
+        self.cells = bytearray(self.blank)  # the display, row after row
+        self.attrs = bytearray(self.plain)  # an attribute byte per cell
+        self.snap = Snapshot(str(self.cells), str(self.attrs), "00000000", 0)
+        self.lock = threading.Lock()  # serializes changes, readers just take snap
+        self.changed = threading.Condition(self.lock)
+        self.renderLock = threading.Lock()
+        self.renders = {}  # form -> (version, output)
+        self.recent = collections.deque([self.snap], HISTORY)  # recent snapshots
+        self.deltas = (None, {})  # version, {base version: delta JSON}
+        self.acks = ackFrames(0x8b, self.KEYS.values())
+        self.keys = KeyQueue(KEYQUEUE, KEYREPEAT)
+
+    def _publish(self, snap):
+        """Make snap, with the next version, what readers see, and wake up
+        anyone waiting on a change.  Called with the lock held."""
+        self.snap = snap._replace(version=self.snap.version + 1)
+        self.recent.append(self.snap)
+        self.dirty = 1
+        self.changed.notifyAll()
+
+    def _commit(self, cells=True, attrs=True):
+        """Publish copies of the buffers that were changed, if they no
+        longer match the snapshot.  Called with the lock held."""
+        snap = self.snap
+        cells = cells and str(self.cells) or snap.cells
+        attrs = attrs and str(self.attrs) or snap.attrs
+        if cells != snap.cells or attrs != snap.attrs:
+            self._publish(snap._replace(cells=cells, attrs=attrs))
+
+    def waitChange(self, version):
+        """Wait until our version differs from version, or for the next
+        keepalive poke, and return the current version."""
+        self.lock.acquire()
+        try:
+            if self.snap.version == version:
+                self.changed.wait()
+            return self.snap.version
+        finally:
+            self.lock.release()
+
+    def poke(self):
+        """Wake up waiters without changing anything."""
+        self.lock.acquire()
+        try:
+            self.changed.notifyAll()
+        finally:
+            self.lock.release()
 
     def setStatus(self, status):
-        """Stuff status into a variable, but not used presently."""
-        self.status = status
+        """Stuff status into a variable, only reported in /state.json."""
+        self.lock.acquire()
+        try:
+            if self.snap.status != status:
+                self._publish(self.snap._replace(status=status))
+        finally:
+            self.lock.release()
 
     def cls(self):
-        """Clear the screen."""
+        """Clear the screen, and the invert region with it."""
         self.lock.acquire()
         try:
-            for i in range(0, 12):
-                self.screen[i] = ""
-            self.invert['line'] = -1
-            self.dirty = 1
+            self.cells[:] = self.blank
+            self.attrs[:] = self.plain
+            self._commit()
         finally:
             self.lock.release()
 
     def scroll(self, start, end, direction):
         """Scroll screen up or down per controller request."""
+        end = min(end, self.H - 1)
+        if start >= self.H:
+            return
+        W = self.W
         self.lock.acquire()
         try:
             if direction == 255:  #-1
-                for x in range(start, end):
-                    self.screen[x] = self.screen[x+1]
-                self.screen[end] = self.W*" "
+                self.cells[start*W:end*W] = self.cells[(start+1)*W:(end+1)*W]
+                self.cells[end*W:(end+1)*W] = W*" "
             elif direction == 1:  # +1
-                for x in range(end, start, -1):
-                    self.screen[x] = self.screen[x-1]
-                self.screen[start] = self.W*" "
-            self.dirty = 1
+                self.cells[(start+1)*W:(end+1)*W] = self.cells[start*W:end*W]
+                self.cells[start*W:(start+1)*W] = W*" "
+            self._commit(attrs=False)
         finally:
             self.lock.release()
 
     def writeLine(self, line, text):
         """"Controller sent new line for screen."""
+        if line >= self.H:
+            return
+        text = text[:self.W].ljust(self.W)
+        start = line*self.W
         self.lock.acquire()
         try:
-            self.screen[line] = text + self.W*" "
-            self.screen[line] = self.screen[line][:self.W]
-            self.dirty = 1
+            # Controllers rewrite lines that haven't changed all the time
+            if self.snap.cells[start:start + self.W] != text:
+                self.cells[start:start + self.W] = text
+                self._commit(attrs=False)
         finally:
             self.lock.release()
 
     def invertLine(self, line):
         """Controller asked to invert entire line."""
-        self.lock.acquire()
-        try:
-            self.invert['line'] = line
-            self.invert['start'] = 0
-            self.invert['end'] = self.W
-            self.dirty = 1
-        finally:
-            self.lock.release()
+        self.setInvert(line, 0, self.W)
 
     def invertChars(self, line, start, end):
         """Controller asked to invert chars on a line."""
+        self.setInvert(line, start, end)
+
+    def setInvert(self, line, start, end):
+        """Invert cells start to end (inclusive) of line, in place of
+        whatever was inverted before."""
         self.lock.acquire()
         try:
-            self.invert['line'] = line
-            self.invert['start'] = start
-            self.invert['end'] = end
-            self.dirty = 1
+            self.attrs[:] = self.plain
+            if line < self.H:
+                first = line*self.W + min(start, self.W)
+                last = line*self.W + min(end, self.W - 1) + 1
+                self.attrs[first:last] = (last - first) * self.INVERSE
+            self._commit(cells=False)
         finally:
             self.lock.release()
 
+    def rows(self, cells):
+        """Split a snapshot's cells into its lines of text."""
+        return [cells[n:n + self.W] for n in range(0, self.H * self.W, self.W)]
+
+    def inverted(self, attrs):
+        """Return (line, start, end) for each run of inverted cells in a
+        snapshot's attrs, end exclusive."""
+        ret = []
+        for m in self.INVERTED.finditer(attrs):
+            start, end = m.span()
+            while start < end:  # split any run that wraps onto the next line
+                line, first = divmod(start, self.W)
+                last = min(end - line*self.W, self.W)
+                ret.append((line, first, last))
+                start = line*self.W + last
+        return ret
+
     def show(self):
         """Print the screen to stdout."""
-        self.lock.acquire()
+        if self.dirty:
+            self.dirty = 0
+            os.system("clear")
+            sys.stdout.write(self.rendered('show', self._show) +
+                             self.W*"-" + "\n" +
+                             "STATUS: " + self.snap.status + "\n")
+
+    def _show(self, cells, attrs):
+        """Render cells for a terminal, underlining inverted ones."""
+        return "".join([line + "\n" for line in self._mark(cells, attrs, self.UNDERLINE, self.END)])
+
+    def _mark(self, cells, attrs, before, after):
+        """The lines of cells with before and after around each run of
+        inverted cells."""
+        lines = self.rows(cells)
+        for line, start, end in reversed(self.inverted(attrs)):
+            text = lines[line]
+            lines[line] = text[:start] + before + text[start:end] + after + text[end:]
+        return lines
+
+    def rendered(self, form, render):
+        """Return render(cells, attrs) for the current screen, reusing the
+        last result until the screen changes.  Rendering works from the
+        current snapshot without the bus lock, and concurrent callers wait
+        for and share a single render."""
+        self.renderLock.acquire()
         try:
-            if self.dirty:
-                self.dirty = 0
-                os.system("clear")
-                for i in range(0, self.H):
-                    if self.invert['line'] == i:
-                        sys.stdout.write(self.UNDERLINE)
-                    sys.stdout.write(self.screen[i])
-                    sys.stdout.write(self.END)
-                    sys.stdout.write("\n")
-                sys.stdout.write(self.W*"-" + "\n")
-                sys.stdout.write("STATUS: " + self.status + "\n")
+            return self._render(form, render, self.snap)
         finally:
-            self.lock.release()
+            self.renderLock.release()
+
+    def _render(self, form, render, snap):
+        """rendered() for snap.  Called with the render lock held."""
+        version, ret = self.renders.get(form, (None, None))
+        if version != snap.version:
+            ret = render(snap.cells, snap.attrs)
+            self.renders[form] = (snap.version, ret)
+        return ret
 
-    def html(self):
-        """Return the screen as a HTML element (<PRE> assumed)"""
-        self.lock.acquire()
+    def delta(self, since):
+        """Return (version, JSON text) to bring a client showing version
+        since up to date: the HTML of just the lines that changed since
+        then, or of every line with "full" set if since is too old."""
+        self.renderLock.acquire()
         try:
-            ret = "<pre>"
-            for x in range(0, self.H): 
-                if x == self.invert['line']:
-                    for y in range(0, self.W):
-                        if y == self.invert['start']:
-                            ret += "<span style=\"background-color: #FFFF00\"><b>"
-                        ret += self.screen[x][y:y+1]
-                        if y == self.invert['end']:
-                            ret += "</b></span>"
-                    if self.invert['end'] == self.W:
-                        ret += "</b></span>"
-                    ret += "\n"
+            snap = self.snap
+            base = None
+            for old in list(self.recent):  # a copy, the bus thread appends
+                if old.version == since:
+                    base = old
+            key = base and base.version
+            version, deltas = self.deltas
+            if version != snap.version:
+                deltas = {}
+                self.deltas = (snap.version, deltas)
+            if key not in deltas:
+                lines = self._render('lines', self._htmlLines, snap)
+                if base is None:
+                    delta = {'version': runVersion(snap.version), 'full': True, 'lines': lines}
                 else:
-                    ret += self.screen[x] + "\n"
-            ret += "</pre>"
+                    delta = {'version': runVersion(snap.version), 'lines': {}}
+                    for n in range(0, self.H):
+                        start, end = n*self.W, (n+1)*self.W
+                        if (base.cells[start:end] != snap.cells[start:end] or
+                            base.attrs[start:end] != snap.attrs[start:end]):
+                            delta['lines'][n] = lines[n]
+                deltas[key] = json.dumps(delta, encoding="latin-1")  # screen bytes as they are
+            return snap.version, deltas[key]
         finally:
-            self.lock.release()
-        return ret
+            self.renderLock.release()
+
+    def html(self):
+        """Return the screen as a HTML element (<PRE> assumed)"""
+        return self.rendered('html', self._html)
+
+    def _html(self, cells, attrs):
+        """Render cells as HTML with the inverted ones highlighted."""
+        return "<pre>" + "".join([line + "\n" for line in self._htmlLines(cells, attrs)]) + "</pre>"
 
-    def sendAck(self, i):
-        """Controller talked to us, send back our last keypress."""
-        ackstr = "8b" + self.nextAck
-        i.sendMsg( (chr(0), chr(1), ackstr.decode("hex")) )
-        self.nextAck = "00"
+    def _htmlLines(self, cells, attrs):
+        """The lines of cells as HTML, inverted ones highlighted."""
+        return self._mark(cells, attrs, "<span style=\"background-color: #FFFF00\"><b>", "</b></span>")
 
-    def setNextAck(self, nextAck):
-        """Set the value we will send on the next ack, but don't send yet."""
-        self.nextAck = nextAck
+    def text(self):
+        """Return the screen as plain text, one line per row."""
+        return self.rendered('text', lambda cells, attrs: "\n".join(self.rows(cells)) + "\n")
+
+    def sendAck(self, i, ret):
+        """Controller talked to us, send back our oldest queued keypress."""
+        i.sendAck(ret, self.acks[self.keys.get()])
 
     def sendKey(self, key):
-        """Send a key (text) on the next ack."""
-        keyToAck = { 'up':"06", 'down':"05", 'back':"02", 'select':"04", 'pgup':"01", 'pgdn':"03" }
-        if key in keyToAck.keys():
-            self.setNextAck(keyToAck[key])
-
-    def processMessage(self, ret, i):
-        """Process message from a controller, updating internal state."""
-        if ret['cmd'] == "09":  # Clear Screen
+        """Queue a key (text) for the next free ack.  Return False if refused."""
+        if key in self.KEYS:
+            return self.keys.put(self.KEYS[key])
+        return False
+
+    def processMessage(self, ret):
+        """Process message from a controller, updating internal state.
+        The ACK is sent separately."""
+        if ret.cmd == 0x09:  # Clear Screen
             # What do the args mean?  Ignore for now
-            if (ord(ret['args'][0:1])==0):
+            if (ret.arg(0)==0):
                 self.cls()
             else:  # May be a partial clear?
                 self.cls()
-#                print "cls: "+ret['args'].encode("hex")
-            self.sendAck(i)
-        elif ret['cmd'] == "0f":  # Scroll Screen
-            start = ord(ret['args'][:1])
-            end = ord(ret['args'][1:2])
-            direction = ord(ret['args'][2:3])
+#                print "cls: "+ret.args.tobytes().encode("hex")
+        elif ret.cmd == 0x0f:  # Scroll Screen
+            start = ret.arg(0)
+            end = ret.arg(1)
+            direction = ret.arg(2)
             self.scroll(start, end, direction)
-            self.sendAck(i)
-        elif ret['cmd'] == "04":  # Write a line
-            line = ord(ret['args'][:1])
-            offset = 1
-            text = ""
-            while (ret['args'][offset:offset+1].encode("hex") != "00") and (offset < len(ret['args'])):
-                text += ret['args'][offset:offset+1]
-                offset = offset + 1
+        elif ret.cmd == 0x04:  # Write a line
+            line = ret.arg(0)
+            # Text runs up to the first NUL
+            text = ret.args[1:].tobytes().split(NUL, 1)[0]
             self.writeLine(line, text)
-            self.sendAck(i)
-        elif ret['cmd'] == "05":  # Initial handshake?
+        elif ret.cmd == 0x05:  # Initial handshake?
             # ??? After initial turn on get this, rela box responds custom ack
 #            i.sendMsg( (chr(0), chr(1), "0b00".decode("hex")) )
-            self.sendAck(i)
-        elif ret['cmd'] == "00":  # PROBE
-            self.sendAck(i)
-        elif ret['cmd'] == "02":  # Status?
-            self.setStatus(ret['args'].encode("hex"))
-            self.sendAck(i)
-        elif ret['cmd'] == "08":  # Invert an entire line
-            self.invertLine( ord(ret['args'][:1]) )
-            self.sendAck(i)
-        elif ret['cmd'] == "10":  # Invert just some chars on a line
-            self.invertChars( ord(ret['args'][:1]), ord(ret['args'][1:2]), ord(ret['args'][2:3]) )
-            self.sendAck(i)
+            pass
+        elif ret.cmd == 0x00:  # PROBE
+            pass
+        elif ret.cmd == 0x02:  # Status?
+            self.setStatus(ret.args.tobytes().encode("hex"))
+        elif ret.cmd == 0x08:  # Invert an entire line
+            self.invertLine( ret.arg(0) )
+        elif ret.cmd == 0x10:  # Invert just some chars on a line
+            self.invertChars( ret.arg(0), ret.arg(1), ret.arg(2) )
         else:
-            print "unk: cmd=" + ret['cmd'] + " args=" + ret['args'].encode("hex")
-            self.sendAck(i)
+            log("unk: cmd=%02x args=%s", ret.cmd, Lazy(binascii.hexlify, ret.args))
+
+def log(format, *args):
+    """Queue format % args for the log.  The formatting is left to the
+    log writer, so pass anything costly to work out as a Lazy."""
+    logs.put(format, args)
+
+
+class Lazy(object):
+    """A log argument worked out only when the record is written, as the
+    text of fn(*args).  args must not change in the meantime."""
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+class LogQueue(object):
+    """Log records waiting in memory for a background thread to format
+    them and write them out, so the bus thread never waits on stdout or
+    the disk.  Records that don't fit are dropped and counted."""
+
+    def __init__(self, size):
+        self.queue = Queue.Queue(size)  # (time, format, args)
+        self.dropped = 0
+
+    def put(self, format, args):
+        """Queue a record, or drop it if the queue is full."""
+        try:
+            self.queue.put_nowait((time.time(), format, args))
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self, filename, maxBytes, backups, echo):
+        """Write records from now on to filename, rotated at maxBytes,
+        and to stdout as well if echo."""
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=maxBytes,
+                                                       backupCount=backups)
+        writer = threading.Thread(target=self.run, args=(handler, echo))
+        writer.daemon = True
+        writer.start()
+
+    def run(self, handler, echo):
+        """Format and write records as they come, forever."""
+        dropped = 0
+        while True:
+            stamp, format, args = self.queue.get()
+            lines = []
+            if self.dropped != dropped:
+                lines.append("%d log records dropped" % (self.dropped - dropped))
+                dropped = self.dropped
+            try:
+                lines.append(args and format % args or format)
+            except (TypeError, ValueError), e:
+                lines.append("%s %r (%s)" % (format, args, e))
+            for line in lines:
+                line = time.asctime(time.localtime(stamp)) + ": " + line
+                if echo:
+                    print line
+                handler.emit(logging.makeLogRecord({'msg': line}))
+            self.queue.task_done()
+
+    def drain(self):
+        """Wait for everything queued so far to be written."""
+        self.queue.join()
+
+    def metrics(self):
+        """Return the queue depth and drops in Prometheus text format."""
+        ret = promHeader("aquaweb_log_queue_depth", "gauge", "Log records waiting to be written.")
+        ret += "aquaweb_log_queue_depth %d\n" % self.queue.qsize()
+        ret += promHeader("aquaweb_log_dropped_total", "counter", "Log records dropped, the queue being full.")
+        return ret + "aquaweb_log_dropped_total %d\n" % self.dropped
+
+logs = LogQueue(LOGQUEUE)
+
+
+def frameText(frame):
+    """Describe a frame, dest to checksum, as it was on the wire, for the log."""
+    ascii_args = filter(lambda x: x in string.printable, frame[2:-1])
+    return (DLE+STX).encode("hex")+" "+frame[0].encode("hex")+" "+\
+           frame[1].encode("hex")+" "+frame[2:-1].encode("hex")+" \""+ascii_args+"\" " +\
+           frame[-1].encode("hex")+" "+(DLE+ETX).encode("hex")
+
+
+def checksum(msg):
+    """ Compute the checksum of a string of bytes."""
+    return chr(sum(bytearray(msg)) & 0xff)
+
+
+def buildMsg(dest, cmd, args):
+    """ Frame a message for the wire: DLE STX, checksum, DLE ETX, and a NUL
+    stuffed after every \x10 in between."""
+    msg = DLE + STX + dest + cmd + args
+    msg = msg + checksum(msg)
+    return DLE + STX + msg[2:].replace(DLE, DLE + NUL) + DLE + ETX
+
+
+def ackFrames(ackType, keycodes):
+    """ Build the complete on-the-wire ACK for every keycode we can send
+    (and 0, no key), so answering the controller is a single write."""
+    acks = {}
+    for keycode in [0] + list(keycodes):
+        acks[keycode] = buildMsg(masterAddr, chr(1), chr(ackType) + chr(keycode))
+    return acks
+
+
+class Frame(object):
+    """One validated message off the bus.  dest and cmd are ints, args is
+    a read-only memoryview of the argument bytes."""
+    __slots__ = ('dest', 'cmd', 'args', 'stamp')
+
+    def __init__(self, dest, cmd, args, stamp=0.0):
+        self.dest = dest
+        self.cmd = cmd
+        self.args = args
+        self.stamp = stamp  # time the read holding its DLE ETX returned
+
+    def arg(self, n):
+        """Return argument byte n as an int, or 0 if the message was short."""
+        if n < len(self.args):
+            return ord(self.args[n])
+        return 0
+
+
+def promHeader(name, kind, text):
+    """The HELP and TYPE lines that start a Prometheus metric."""
+    return "# HELP %s %s\n# TYPE %s %s\n" % (name, text, name, kind)
+
+
+# What readers see of a device.  A new one replaces it on every change and
+# it is never modified, so readers take a reference to it without locking.
+Snapshot = collections.namedtuple('Snapshot', 'cells attrs status version')
+SpaSnapshot = collections.namedtuple('SpaSnapshot', 'text status version')
+
+
+class Histogram(object):
+    """Counts of timings in fixed buckets, cheap enough to bump every frame."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds  # upper bucket edges in seconds, ascending
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Record one timing, in seconds."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def text(self):
+        """Return the buckets as a small plain-text table."""
+        ret = "count %d" % self.count
+        if self.count:
+            ret += "  avg %.1fms  max %.1fms" % (1000 * self.sum / self.count, 1000 * self.max)
+        ret += "\n"
+        for bound, count in zip(self.bounds, self.counts):
+            ret += "<= %6.1fms: %d\n" % (1000 * bound, count)
+        ret += ">  %6.1fms: %d\n" % (1000 * self.bounds[-1], self.counts[-1])
+        return ret
+
+    def prometheus(self, name):
+        """Return the buckets in Prometheus text format, which wants them
+        cumulative."""
+        ret = ""
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            ret += '%s_bucket{le="%g"} %d\n' % (name, bound, total)
+        ret += '%s_bucket{le="+Inf"} %d\n' % (name, self.count)
+        return ret + "%s_sum %f\n%s_count %d\n" % (name, self.sum, name, self.count)
+
+
+class Series(object):
+    """One metric's samples in a ring, rolled up as they arrive into
+    [start, min, max, sum, count, watt hours] rows per minute and per
+    hour, themselves in rings, so memory never grows."""
+
+    def __init__(self, energy):
+        self.energy = energy  # the metric is in watts, rollups total up watt hours
+        self.samples = collections.deque(maxlen=SAMPLES)  # (time, value)
+        self.rollups = {'minute': (60, collections.deque(maxlen=MINUTES)),
+                        'hour': (3600, collections.deque(maxlen=HOURS))}
+
+    def add(self, now, value, period):
+        """Record value at time now, held for period seconds."""
+        self.samples.append((now, value))
+        wh = self.energy and value * period / 3600.0 or 0.0
+        for size, rows in self.rollups.values():
+            start = int(now) - int(now) % size
+            if rows and rows[-1][0] == start:
+                row = rows[-1]
+                row[1] = min(row[1], value)
+                row[2] = max(row[2], value)
+                row[3] += value
+                row[4] += 1
+                row[5] += wh
+            else:
+                rows.append([start, value, value, value, 1, wh])
+
+    def resolution(self, since):
+        """The finest resolution still holding everything from since on."""
+        if len(self.samples) < SAMPLES or self.samples[0][0] <= since:
+            return 'raw'
+        rows = self.rollups['minute'][1]
+        if len(rows) < MINUTES or rows[0][0] <= since:
+            return 'minute'
+        return 'hour'
+
+    def points(self, since, resolution):
+        """The columns and points from since on at resolution."""
+        if resolution == 'raw':
+            return ['time', 'value'], [[t, value] for t, value in self.samples if t >= since]
+        size, rows = self.rollups[resolution]
+        columns = ['time', 'min', 'max', 'avg']
+        points = []
+        for start, lo, hi, total, count, wh in rows:
+            if start + size > since:
+                points.append([start, lo, hi, total / count])
+                if self.energy:
+                    points[-1].append(wh)
+        if self.energy:
+            columns.append('wh')
+        return columns, points
+
+
+class History(object):
+    """Recent values of a device's metrics, a Series each."""
+
+    def __init__(self, energy=()):
+        self.series = {}
+        self.energy = energy  # names of the metrics in watts
+        self.lock = threading.Lock()
+
+    def record(self, values):
+        """Add a sample of each metric in the values dict, bar any None."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for name, value in values.items():
+                if value is None:
+                    continue
+                if name not in self.series:
+                    self.series[name] = Series(name in self.energy)
+                self.series[name].add(now, float(value), SAMPLEPERIOD)
+        finally:
+            self.lock.release()
+
+    def query(self, metric, since, resolution=None):
+        """The JSON for /history: metric from time since on, raw if the
+        samples reach back that far, else in minute or hour rollups.
+        The list of metrics if metric is None, None if there's no such
+        metric."""
+        self.lock.acquire()
+        try:
+            if metric is None:
+                return json.dumps({'metrics': sorted(self.series)})
+            series = self.series.get(metric)
+            if series is None:
+                return None
+            resolution = resolution or series.resolution(since)
+            columns, points = series.points(since, resolution)
+        finally:
+            self.lock.release()
+        return json.dumps({'metric': metric, 'resolution': resolution,
+                           'columns': columns, 'points': points})
+
+
+class KeyQueue(object):
+    """Key presses waiting to go out, one per ACK, oldest first."""
+
+    def __init__(self, size, repeat):
+        self.size = size      # most presses we'll hold
+        self.repeat = repeat  # "keep", "collapse" or "reject" repeats of the last key
+        self.keys = collections.deque()
+        self.lock = threading.Lock()
+
+    def put(self, code):
+        """Queue a key code.  Return False if it was refused."""
+        self.lock.acquire()
+        try:
+            if self.keys and self.keys[-1] == code and self.repeat != "keep":
+                return self.repeat == "collapse"
+            if len(self.keys) >= self.size:
+                return False
+            self.keys.append(code)
+            return True
+        finally:
+            self.lock.release()
 
-def log(*args):
-    """Set the last log message"""
-    global last_log
-    message = "%-16s: " % args[0]
-    for arg in args[1:]:
-        message += arg.__str__() + " "
-    last_log =  message + "\n"
+    def get(self):
+        """Take the oldest key code, or 0 (no key) if there are none."""
+        self.lock.acquire()
+        try:
+            if self.keys:
+                return self.keys.popleft()
+            return 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class CaptureQueue(object):
+    """Capture records waiting for a background thread to append them to
+    the capture file, so the bus thread never waits on the disk.  Records
+    that don't fit are dropped and counted."""
+
+    def __init__(self, filename, size):
+        self.file = open(filename, 'ab')
+        self.queue = Queue.Queue(size)  # packed records, None to finish
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def put(self, direction, data):
+        """Queue a record stamped now, or drop it if the queue is full."""
+        try:
+            self.queue.put_nowait(CAPHEAD.pack(time.time(), direction, len(data)) + data)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        """Write records as they come, flushing whenever it catches up,
+        until close()."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.file.write(record)
+            if self.queue.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        """Write out what's queued and close the file."""
+        self.queue.put(None)
+        self.writer.join()
+
+    def metrics(self):
+        """Return the records dropped in Prometheus text format."""
+        ret = promHeader("aquaweb_capture_dropped_total", "counter",
+                         "Capture records dropped, the queue being full.")
+        return ret + "aquaweb_capture_dropped_total %d\n" % self.dropped
+
+
+class ReplayPort(object):
+    """Stands in for the serial port, feeding the received bytes from a
+    capture file at the recorded pace divided by speed, or flat out if
+    speed is 0.  Raises EOFError once the capture runs out."""
+
+    def __init__(self, name, speed):
+        self.file = open(name, 'rb')
+        self.speed = speed
+        self.pending = ""   # received bytes that are due but not read yet
+        self.due = None     # (stamp, data) of the next received record
+        self.start = None   # (wall time, capture stamp) of the first record
+        self.bytes = 0
+
+    def _next(self):
+        """Load the next received record, skipping what we sent."""
+        while self.due is None:
+            head = self.file.read(CAPHEAD.size)
+            if len(head) < CAPHEAD.size:
+                raise EOFError
+            stamp, direction, length = CAPHEAD.unpack(head)
+            data = self.file.read(length)
+            if direction == CAPRX:
+                if self.start is None:
+                    self.start = (time.time(), stamp)
+                self.due = (stamp, data)
+
+    def _delay(self):
+        """Seconds until the next record is due."""
+        if not self.speed:
+            return 0
+        wall, first = self.start
+        return wall + (self.due[0] - first) / self.speed - time.time()
+
+    def _take(self):
+        self.pending = self.due[1]
+        self.due = None
+
+    def inWaiting(self):
+        if not self.pending:
+            self._next()
+            if self._delay() <= 0:
+                self._take()
+        return len(self.pending)
+
+    def read(self, size=1):
+        """Read up to size bytes, or the whole of the next record if it
+        has to wait for it, as the port's buffer would hold by the time it
+        came in, so records come back as they were captured."""
+        if not self.pending:
+            self._next()
+            delay = self._delay()
+            if delay > 0:
+                time.sleep(delay)
+            self._take()
+            size = max(size, len(self.pending))
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.bytes += len(data)
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def summary(self):
+        """One line on how much was replayed and how long it took."""
+        elapsed = time.time() - self.start[0] if self.start else 0.0
+        return "replayed %d bytes in %.2fs" % (self.bytes, elapsed)
+
+
+class Pipeline(object):
+    """Applies frames to the devices in a thread of its own, so the bus
+    reader only frames, validates and ACKs, and a render holding a
+    device's lock can't make an ACK late."""
+
+    def __init__(self):
+        self.queue = Queue.Queue(PIPEQUEUE)
+        self.waits = Histogram(ACKBUCKETS)    # frame read to update started
+        self.updates = Histogram(ACKBUCKETS)  # time in processMessage
+        self.maxDepth = 0
+        self.inline = 0    # frames applied by the reader, the queue being full
+        self.failures = 0  # frames processMessage raised on
+        updater = threading.Thread(target=self.run)
+        updater.daemon = True
+        updater.start()
+
+    def put(self, device, frame):
+        """Queue a frame for device.processMessage().  If the updater is
+        that far behind, catch it up and apply the frame here instead, so
+        the queue can't grow without end and frames still go in order."""
+        try:
+            self.queue.put_nowait((device, frame))
+        except Queue.Full:
+            self.inline += 1
+            self.drain()
+            self.apply(device, frame)
+            return
+        depth = self.queue.qsize()
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+
+    def drain(self):
+        """Wait until every queued frame has been applied."""
+        self.queue.join()
+
+    def run(self):
+        """The updater thread."""
+        while True:
+            device, frame = self.queue.get()
+            try:
+                self.apply(device, frame)
+            finally:
+                self.queue.task_done()
+
+    def apply(self, device, frame):
+        """Apply one frame, timing it.  A frame that raises is logged and
+        skipped rather than taking the updater down with it."""
+        start = time.time()
+        self.waits.add(start - frame.stamp)
+        try:
+            device.processMessage(frame)
+        except Exception:
+            self.failures += 1
+            log("pipeline: %02x %02x %s failed\n%s", frame.dest, frame.cmd,
+                Lazy(binascii.hexlify, frame.args.tobytes()), traceback.format_exc())
+        self.updates.add(time.time() - start)
+
+    def metrics(self):
+        """Return the queue depth and stage timings in Prometheus text format."""
+        ret = promHeader("aquaweb_queue_depth", "gauge", "Frames waiting for the updater.")
+        ret += "aquaweb_queue_depth %d\n" % self.queue.qsize()
+        ret += promHeader("aquaweb_queue_depth_max", "gauge", "Most frames ever waiting for the updater.")
+        ret += "aquaweb_queue_depth_max %d\n" % self.maxDepth
+        ret += promHeader("aquaweb_queue_wait_seconds", "histogram",
+                          "Time from reading the end of a frame to the updater starting on it.")
+        ret += self.waits.prometheus("aquaweb_queue_wait_seconds")
+        ret += promHeader("aquaweb_queue_inline_total", "counter",
+                          "Frames applied by the reader, the queue being full.")
+        ret += "aquaweb_queue_inline_total %d\n" % self.inline
+        ret += promHeader("aquaweb_update_failures_total", "counter",
+                          "Frames the updater couldn't apply.")
+        ret += "aquaweb_update_failures_total %d\n" % self.failures
+        ret += promHeader("aquaweb_update_seconds", "histogram",
+                          "Time the updater spends applying a frame.")
+        ret += self.updates.prometheus("aquaweb_update_seconds")
+        return ret
 
 
 class Interface(object):
@@ -607,27 +1821,34 @@ class Interface(object):
 
     def __init__(self, theName):
         """Initialization.
-        Open the serial port and find the start of a message."""
+        Open the serial port, the decoder will find the start of a message."""
         self.name = theName
         if debugData:
-            log(self.name, "opening RS485 port", RS485Device)
+            log("%s: opening RS485 port %s", self.name, RS485Device)
         self._open()
-        self.msg = "\x00\x00"
         self.debugRawMsg = ""
-        # skip bytes until synchronized with the start of a message
-        while (self.msg[-1] != STX) or (self.msg[-2] != DLE):
-            self.msg += self.port.read(1)
-            if debugRaw:
-                self.debugRaw(self.msg[-1])
-        self.msg = self.msg[-2:]
-        if debugData:
-            log(self.name, "synchronized")
+        self.state = HUNT              # receive decoder state
+        self.frame = bytearray()       # frame being decoded, reused
+        self.frames = collections.deque()  # decoded frames not yet returned
+        self.stamp = 0.0               # when the last read returned
+        self.ackTimes = Histogram(ACKBUCKETS)  # ETX to ACK written
+        self.counts = collections.defaultdict(int)  # good frames by (dest, cmd)
+        self.badChecksums = 0
+        self.resyncs = 0       # frames given up on part way through
+        self.reopens = 0       # attempts to reopen the serial port
+        self.pipeline = None   # Pipeline applying our frames, if any
+        self.capture = None
+        if captureFile:
+            self.capture = CaptureQueue(captureFile, CAPQUEUE)
         # start up the read thread
-        log(self.name, "ready")
+        log("%s: ready", self.name)
 
     def _open(self):
         """Try and connect to the serial port, if it exists.  If not, then
         add a small delay to avoid CPU hogging"""
+        if replayFile:
+            self.port = ReplayPort(replayFile, replaySpeed)
+            return
         try:
             if not os.path.exists(RS485Device):
                 time.sleep(1)
@@ -639,123 +1860,204 @@ class Interface(object):
         except:
             self.port = None
          
-        
+    def _read(self):
+        """Read everything the port has buffered in one go, blocking for at
+        most the port timeout if nothing is waiting yet."""
+        try:
+            data = self.port.read(max(1, self.port.inWaiting()))
+        except serial.SerialException:
+            self.reopens += 1
+            self._open()
+            return ""
+        self.stamp = time.time()
+        if self.capture and data:
+            self._capture(CAPRX, data)
+        if debugRaw:
+            for byte in data:
+                self.debugRaw(byte)
+        return data
+
+    def _decode(self, data):
+        """Run received bytes through the DLE/STX/ETX state machine.
+        Stuffed DLE-NULs are dropped, and every complete frame is queued
+        on self.frames.  Garbage resyncs to the next DLE STX."""
+        state = self.state
+        frame = self.frame
+        for byte in bytearray(data):
+            if state == BODY:
+                if byte == 0x10:
+                    state = BODY_DLE
+                elif len(frame) < MAXFRAME:
+                    frame.append(byte)
+                else:  # runaway frame, we missed the DLE ETX
+                    self.resyncs += 1
+                    state = HUNT
+            elif state == BODY_DLE:
+                if byte == 0x00:  # DLE NUL is a stuffed \x10 data byte
+                    frame.append(0x10)
+                    state = BODY
+                elif byte == 0x03:  # DLE ETX ends the frame
+                    self._frameDone()
+                    state = HUNT
+                elif byte == 0x02:  # DLE STX, lost the end of the last one
+                    self.resyncs += 1
+                    del frame[:]
+                    state = BODY
+                elif byte == 0x10:
+                    self.resyncs += 1
+                    state = HUNT_DLE
+                else:
+                    self.resyncs += 1
+                    state = HUNT
+            elif byte == 0x10:
+                state = HUNT_DLE
+            elif state == HUNT_DLE and byte == 0x02:
+                del frame[:]
+                state = BODY
+            else:
+                state = HUNT
+        self.state = state
+
+    def _frameDone(self):
+        """Validate the just-completed frame and queue it if it's good."""
+        frame = self.frame
+        if len(frame) < 3:
+            self.resyncs += 1
+            return
+        checksum = frame[-1]
+        # only pass on messages with a valid checksum, DLE STX adds 0x12
+        if (sum(frame) - checksum + 0x12) & 0xff == checksum:
+            self.counts[(frame[0], frame[1])] += 1
+            if debugData:
+                log("%s: --> %s", self.name, Lazy(frameText, str(frame)))
+            # frame gets reused, so args views one immutable copy of it
+            self.frames.append(Frame(frame[0], frame[1], memoryview(str(frame))[2:-1], self.stamp))
+        else:
+            self.badChecksums += 1
+            if debugData:
+                log("%s: --> %s *** bad checksum ***", self.name, Lazy(frameText, str(frame)))
+
     def readMsg(self):
         """ Read the next valid message from the serial port.
         Parses and returns the destination address, command, and arguments as a 
-        tuple."""
-        if (self.port == None):
-            self._open()  # Try and re-open port
-        if (self.port == None):  # We failed, return garbage
-            return {'dest':"ff", 'cmd':"ff", 'args':""}
-
-        while True:                                         
-            dleFound = False
-            # read what is probably the DLE STX
-            try:
-                self.msg += self.port.read(2)
-            except serial.SerialException:
-                self.msg += chr(0) + chr(0)
-                self._open()
-            if debugRaw: 
-                self.debugRaw(self.msg[-2])
-                self.debugRaw(self.msg[-1])
-            while len(self.msg) < 2:
-                self.msg += chr(0)
-            while (self.msg[-1] != ETX) or (not dleFound) or (len(self.msg)>128):  
-                # read until DLE ETX
-                try:
-                    if (self.port == None):
-                        return {'dest':"ff", 'cmd':"ff", 'args':""}
-                    self.msg += self.port.read(1)
-                except serial.SerialException:
-                    self.msg += chr(0)
-                    self._open()
-                if debugRaw:
-                    self.debugRaw(self.msg[-1])
-                if self.msg[-1] == DLE:                     
-                    # \x10 read, tentatively is a DLE
-                    dleFound = True
-                if (self.msg[-2] == DLE) and (self.msg[-1] == NUL) and dleFound: 
-                    # skip a NUL following a DLE
-                    self.msg = self.msg[:-1]
-                    # it wasn't a DLE after all
-                    dleFound = False                        
-            # skip any NULs between messages
-            self.msg = self.msg.lstrip('\x00')
-            # parse the elements of the message              
-            dlestx = self.msg[0:2]
-            dest = self.msg[2:3]
-            cmd = self.msg[3:4]
-            args = self.msg[4:-3]
-            ascii_args = filter(lambda x: x in string.printable, args)
-            checksum = self.msg[-3:-2]
-            dleetx = self.msg[-2:]
-            if debugData:
-                debugMsg = dlestx.encode("hex")+" "+dest.encode("hex")+" "+\
-                           cmd.encode("hex")+" "+args.encode("hex")+" \""+ascii_args+"\" " +\
-                           checksum.encode("hex")+" "+dleetx.encode("hex")
-            self.msg = ""
-            # stop reading if a message with a valid checksum is read
-            if self.checksum(dlestx+dest+cmd+args) == checksum:
-                if debugData:
-                    log(self.name, "-->", debugMsg)
-                if args == None:
-                    args = ""
-                return {'dest':dest.encode("hex"), 'cmd':cmd.encode("hex"), 'args':args}
-            else:
-                if debugData:
-                    log(self.name, "-->", debugMsg, "*** bad checksum ***")
+        Frame.  A single read may complete several messages, the extras are
+        returned by the following calls without touching the port."""
+        while not self.frames:
+            if (self.port == None):
+                self.reopens += 1
+                self._open()  # Try and re-open port
+            if (self.port == None):  # We failed, return garbage
+                return Frame(0xff, 0xff, memoryview(""))
+            self._decode(self._read())
+        return self.frames.popleft()
 
     def sendMsg(self, (dest, cmd, args)):
         """ Send a message.
         The destination address, command, and arguments are specified as a tuple."""
-        msg = DLE + STX + dest + cmd + args
-        msg = msg + self.checksum(msg) + DLE + ETX
-        for i in range(2, len(msg) - 2):                       
-            # if a byte in the message has the value \x10 insert a NUL after it
-            if msg[i] == DLE:
-                msg = msg[0:i+1]+NUL+msg[i+1:]
+        self.sendRaw(buildMsg(dest, cmd, args))
+
+    def sendRaw(self, msg):
+        """ Send an already framed and stuffed message, such as a cached ACK."""
         if debugData:
-            log(self.name, "<--", msg[0:2].encode("hex"), 
-                msg[2:3].encode("hex"), msg[3:4].encode("hex"), 
-                msg[4:-3].encode("hex"), msg[-3:-2].encode("hex"), 
-                msg[-2:].encode("hex"))
+            log("%s: <-- %s", self.name, Lazy(binascii.hexlify, msg))
         n = self.port.write(msg)
+        if self.capture:
+            self._capture(CAPTX, msg)
+
+    def metrics(self):
+        """Return the bus counters and ACK latency in Prometheus text format."""
+        ret = promHeader("aquaweb_frames_total", "counter",
+                         "Good frames received, by destination and command.")
+        for (dest, cmd), count in sorted(self.counts.items()):
+            ret += 'aquaweb_frames_total{dest="%02x",cmd="%02x"} %d\n' % (dest, cmd, count)
+        for name, text, count in (
+                ("aquaweb_bad_checksums_total", "Frames dropped for a bad checksum.", self.badChecksums),
+                ("aquaweb_resyncs_total", "Frames given up on part way through.", self.resyncs),
+                ("aquaweb_serial_reopens_total", "Attempts to reopen the serial port.", self.reopens)):
+            ret += promHeader(name, "counter", text) + "%s %d\n" % (name, count)
+        ret += promHeader("aquaweb_ack_seconds", "histogram",
+                          "Time from reading the end of a frame to writing our ACK.")
+        ret += self.ackTimes.prometheus("aquaweb_ack_seconds")
+        if self.pipeline:
+            ret += self.pipeline.metrics()
+        if self.capture:
+            ret += self.capture.metrics()
+        return ret
+
+    def sendAck(self, frame, msg):
+        """ Send a prebuilt ACK in reply to frame, timing it from the frame's ETX."""
+        self.sendRaw(msg)
+        self.ackTimes.add(time.time() - frame.stamp)
+
+    def _capture(self, direction, data):
+        """Queue one record for the capture file."""
+        self.capture.put(direction, data)
+
+    def close(self):
+        """Finish writing the capture file, if any, on the way out."""
+        if self.capture:
+            self.capture.close()
+            self.capture = None
 
     def checksum(self, msg):
         """ Compute the checksum of a string of bytes."""                
-        return struct.pack("!B", reduce(lambda x, y:x+y, map(ord, msg)) % 256)
+        return checksum(msg)
 
     def debugRaw(self, byte):
         """ Debug raw serial data."""
         self.debugRawMsg += byte
         if ((len(self.debugRawMsg) == 48) or (byte==ETX)):
-            log(self.name, self.debugRawMsg.encode("hex"))
+            log("%s: %s", self.name, Lazy(binascii.hexlify, self.debugRawMsg))
             self.debugRawMsg = ""
 
 
 def main():
-    """Start the listener for a screen and spa, run webserver."""
-    print "Creating screen emulator..."
-    screen = Screen()
-    print "Creating spa emulator..."
-    spa = Spa()
+    """Start the listener for the screens and spas, run webserver."""
+    logs.start(LOGFILE, LOGBYTES, LOGBACKUPS, LOGECHO)
+    devices = {}  # bus address -> emulated device
+    for addr in REMOTES:
+        print "Creating screen emulator %02x..." % addr
+        devices[addr] = Screen()
+    for addr in SPAS:
+        print "Creating spa emulator %02x..." % addr
+        devices[addr] = Spa()
 
     print "Creating RS485 port..."
     i = Interface("RS485")
+    if pipelined:
+        i.pipeline = Pipeline()
     print "Creating web server..."
-    server = threading.Thread(target=startServer, args=(screen, spa))
+    server = threading.Thread(target=startServer, args=(devices, i))
+    server.daemon = bool(replayFile)  # don't outlive the replay
     server.start()
 
     print "Main loop begins..."
-    while True:
-        ret = i.readMsg()
-#        print "ATTN: "+ret['dest'];
-        if ret['dest'] == ID:
-            screen.processMessage(ret, i)
-        elif ret['dest'] == SPAID:
-            spa.processMessage(ret, i)
+    try:
+        while True:
+            try:
+                ret = i.readMsg()
+            except EOFError:
+                if i.pipeline:
+                    i.pipeline.drain()
+                print "Replay finished,", i.port.summary()
+                print i.ackTimes.text()
+                return
+    #        print "ATTN: %02x" % ret.dest
+            device = devices.get(ret.dest)
+            if device is None:
+                continue
+            if i.pipeline:
+                device.sendAck(i, ret)
+                i.pipeline.put(device, ret)
+            elif fastAck:
+                # Answer first so rendering or logging can't make us late
+                device.sendAck(i, ret)
+                device.processMessage(ret)
+            else:
+                device.processMessage(ret)
+                device.sendAck(i, ret)
+    finally:
+        i.close()
 
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@
 
 import string
 import serial
+import collections
+import bisect
 import struct
 import threading
 import sys
@@ -14,14 +16,35 @@ import socket
 import os
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 import cgi
+import Queue
+import select
+import gzip
+import hashlib
+import StringIO
+import json
 import logging
+import logging.handlers
+import binascii
+import traceback
 import re
 
 # Configuration
-RS485Device = "/dev/ttyUSB0"    # RS485 serial device to be used
-PORT = 80   # port for web server
-ID = "60"   # address of PDA remote to emulate
+RS485Device = os.environ.get("AQUAWEB_DEVICE", "/dev/ttyUSB0")  # RS485 serial device to be used
+PORT = int(os.environ.get("AQUAWEB_PORT", 80))   # port for web server
+HTTPTHREADS = 16    # web worker threads, each open event stream holds one
+MAXSTREAMS = 8      # event streams allowed at once, pages poll after that
+IDLETIMEOUT = 5.0   # seconds an idle keep-alive connection is kept open
+STARTED = int(time.time())  # makes ETags unique to this run
+PAGEMAXAGE = 3600  # seconds browsers may cache the static page
+KEEPALIVE = 15  # seconds between keepalives on idle event streams
+HISTORY = 32    # screen versions kept for sending clients just the changed lines
+ID = 0x60   # address of PDA remote to emulate
 debugData = False 
+fastAck = True     # ACK before processing a message rather than after
+pipelined = False  # apply updates in their own thread, off the ACK path
+captureFile = None  # append raw bus traffic to this file, for replay later
+replayFile = None   # read bus traffic from this capture instead of the port
+replaySpeed = 1.0   # replay at this multiple of real time, 0 for flat out
 
 # ASCII constants
 NUL = '\x00'
@@ -29,7 +52,53 @@ DLE = '\x10'
 STX = '\x02'
 ETX = '\x03'
 
-logging.basicConfig(filename='aw.log',filemode='a',format='%(message)s',level=logging.DEBUG)
+# Receive decoder states
+HUNT = 0        # looking for the DLE of a DLE STX
+HUNT_DLE = 1    # got a DLE, looking for the STX
+BODY = 2        # inside a frame
+BODY_DLE = 3    # got a DLE inside a frame
+MAXFRAME = 128  # longest frame we'll believe before resyncing
+
+# Histogram bucket edges for ACK latency and HTTP request time, in seconds
+ACKBUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+HTTPBUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+KEYQUEUE = 8        # key presses a device will hold until the controller polls
+PIPEQUEUE = 256     # frames the updater may fall behind before the reader applies them itself
+KEYREPEAT = "keep"  # repeats of the last queued key: "keep", "collapse" or "reject"
+
+menuGraph = True    # macros learn the menus and take the shortest known way through
+MACROSTEPS = 40     # keys a macro may take by the graph before it searches instead
+MACROTIMES = 50     # recent runs of each macro kept for the medians in /metrics
+# The crawl presses SELECT on the real controller with nobody watching, so
+# it only opens items known to be menus, or named in CRAWLOPEN.  Anything
+# else with no state could be an action (ALL OFF, a reset, a confirmation)
+# and is left alone; add to CRAWLOPEN only names that are safe to select.
+menuCrawl = False   # walk the menus when idle, so the graph knows them all
+CRAWLIDLE = 60.0    # seconds after the last key or macro before the crawl goes on
+CRAWLOPEN = re.compile(r"(.* MENU|EQUIPMENT|SYSTEM SETUP|HELP|PDA OPTIONS)$")  # items the crawl may open unseen
+MENUFILE = "aquaweb-menus.json"  # the menu graph is kept here between runs
+MENUSAVE = 60       # seconds between saves of the menu graph, when it has changed
+
+# Telemetry history for /history, sampled now and then and kept in fixed memory
+SAMPLEPERIOD = 10   # seconds between samples of each metric
+SAMPLES = 360       # raw samples kept per metric, an hour's worth
+MINUTES = 1440      # minute rollups kept per metric, a day's worth
+HOURS = 720         # hour rollups kept per metric, 30 days' worth
+
+# Logging, done by a background thread so the bus never waits on a write
+LOGFILE = "aw.log"  # log file, rotated by size
+LOGBYTES = 1000000  # size the log file grows to before it's rotated
+LOGBACKUPS = 3      # rotated log files kept, aw.log.1 to aw.log.3
+LOGQUEUE = 1000     # records waiting to be written, any more are dropped and counted
+LOGECHO = True      # write the log to stdout as well
+
+# Capture files are a series of records, each this header followed by
+# length raw bytes as they crossed the bus
+CAPHEAD = struct.Struct("!dBH")  # time.time(), direction, length
+CAPRX = 0   # bytes we received
+CAPTX = 1   # bytes we sent
+CAPQUEUE = 1000  # records waiting to be written, any more are dropped and counted
 
 INDEXHTML = """
 <html>
@@ -45,31 +114,60 @@ if (window.XMLHttpRequest) {
     var xmlHttpReqScreen = new ActiveXObject("Microsoft.XMLHTTP");
 }
 
-function screen() {
-    xmlhttpPost(xmlHttpReqScreen, "/screen.cgi", "", "screen");
+var version = -1;  /* of the screen we're showing */
+
+function delta() {
+    xmlHttpReqScreen.open('GET', "/screen.delta?since=" + version, true);
+    xmlHttpReqScreen.onreadystatechange = function() {
+        if (xmlHttpReqScreen.readyState == 4) {
+            if (xmlHttpReqScreen.status == 200) {
+                patch(JSON.parse(xmlHttpReqScreen.responseText));
+            }
+            setTimeout(delta, 250);
+        }
+    }
+    xmlHttpReqScreen.send(null);
+}
+
+function patch(d) {  /* A full screen rebuilds it, a delta swaps in just the changed lines */
+    if (d.full) {
+        var html = "";
+        for (var n = 0; n < d.lines.length; n++) {
+            html += '<span id="line' + n + '">' + d.lines[n] + '</span>\\n';
+        }
+        document.getElementById("screen").innerHTML = "<pre>" + html + "</pre>";
+    } else {
+        for (var n in d.lines) {
+            document.getElementById("line" + n).innerHTML = d.lines[n];
+        }
+    }
+    version = d.version;
 }
 
 function sendkey(key) {
     xmlhttpPost(xmlHttpReqKey, "/key.cgi", "key="+key);
 }
 
-function xmlhttpPost(xmlReq, strURL, params, update) {
+function xmlhttpPost(xmlReq, strURL, params) {
     xmlReq.open('POST', strURL, true);
     xmlReq.setRequestHeader("Content-type","application/x-www-form-urlencoded");
     xmlReq.send(params);
-    if (update != "") {
-      xmlReq.onreadystatechange = function() {
-        if (xmlReq.readyState == 4) {
-            updatepage(xmlReq.responseText, update);
-        }
-      }
-    }
-    xmlReq.send();
 }
 
-function updatepage(str, div){
-    document.getElementById(div).innerHTML = str;
-    setTimeout(window[div](), 250);
+function start() {
+    if (window.EventSource) {  /* Server pushes the changes to the screen */
+        var events = new EventSource("/screen.events");
+        events.onmessage = function(e) {
+            patch(JSON.parse(e.data));
+        };
+        events.onerror = function(e) {
+            if (events.readyState == 2) {  /* Refused, server is busy */
+                delta();
+            }
+        };
+    } else {
+        delta();
+    }
 }
 </script>
 
@@ -97,7 +195,7 @@ td {
 </style>
 
 </head>
-<body onload="screen();">
+<body onload="start();">
 
 <table style="width: 100%;">
 <tr><td align="center" style="border:1px solid black; font-size: 5vw; background-color: #cce0ff;"><div id="screen"></div></font></td></tr>
@@ -139,23 +237,290 @@ td {
 
 class webHandler(BaseHTTPRequestHandler):
     """CGI and dummy web page handler to interface to control objects."""
+    protocol_version = "HTTP/1.1"  # keep-alive, so every reply needs a length
+    wbufsize = -1  # send each reply in one go, flushed by handle_one_request
+    # Read ahead only where buffered() can see what was read, see there
+    rbufsize = hasattr(socket, '_fileobject') and -1 or 0
+    streams = threading.BoundedSemaphore(MAXSTREAMS)  # event streams open
     screen = None
+    interface = None
+    httpTimes = None  # Histogram of request handling time, streams excluded
+    httpCodes = collections.defaultdict(int)  # replies sent by status code
+    httpLock = threading.Lock()
+    pages = {}
+    state = (None, None)  # last (version, JSON) from Screen.stateJson()
     
+    def log_request(self, code='-', size='-'):
+        """Note the code for /metrics, then log as usual."""
+        self.code = code
+        BaseHTTPRequestHandler.log_request(self, code, size)
+
+    def sendEvents(self, device):
+        """Stream the device's changed lines to the client as Server-Sent
+        Events, in the JSON of Screen.delta(), one each time it changes."""
+        if not self.streams.acquire(False):
+            self.send_error(503, 'Too many event streams')
+            return
+        try:
+            self.streamEvents(device)
+        finally:
+            self.streams.release()
+
+    def streamEvents(self, device):
+        """Send the event stream, each open one holds a server worker."""
+        self.stream = True  # not a request to time
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')  # The stream ends with the connection
+        self.end_headers()
+        self.close_connection = 1
+        version = None
+        try:
+            while True:
+                current = device.waitChange(version)
+                if current != version:
+                    version, ret = device.delta(version)
+                    self.wfile.write(eventText(ret))
+                else:
+                    self.wfile.write(": keepalive\n\n")
+                self.wfile.flush()
+        except socket.error:
+            pass  # Client went away
+
+    def handle(self):
+        """Handle the request that woke the connection.  The server parks
+        the connection between keep-alive requests rather than a worker
+        waiting on it, but requests a client pipelined behind this one are
+        already read into rfile's buffer where select() can't see them, so
+        those are handled first."""
+        self.handleOne()
+        while not self.close_connection and self.buffered():
+            self.handleOne()
+
+    def buffered(self):
+        """Whether rfile holds bytes already read off the socket.  This
+        looks at the read buffer of Python 2.7's socket._fileobject, a
+        private detail; rbufsize turns read-ahead off where there's no
+        such thing, so nothing can be left in a buffer when we park."""
+        rbuf = getattr(self.rfile, '_rbuf', None)
+        return rbuf is not None and rbuf.tell() > 0
+
+    def handleOne(self):
+        """Handle one request, timing it for /metrics."""
+        self.close_connection = 1
+        self.code = None
+        self.stream = False
+        start = time.time()
+        self.handle_one_request()
+        if self.code and not self.stream:
+            self.httpLock.acquire()
+            try:
+                self.httpTimes.add(time.time() - start)
+                self.httpCodes[self.code] += 1
+            finally:
+                self.httpLock.release()
+
+    def sendPage(self, page):
+        """Send a static page built by staticPage(), gzipped if the client
+        takes it, or just a 304 if the client's copy is current."""
+        if acceptsGzip(self.headers.getheader('accept-encoding')):
+            ret, etag, encoding = page['gzip'], page['etag'] + '-gz', 'gzip'
+        else:
+            ret, etag, encoding = page['body'], page['etag'], None
+        etag = '"' + etag + '"'
+        matches = [t.strip() for t in (self.headers.getheader('if-none-match') or "").split(",")]
+        if etag in matches or "*" in matches:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'max-age=%d' % PAGEMAXAGE)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'max-age=%d' % PAGEMAXAGE)
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def queueKeys(self, device, postvars):
+        """Queue the posted keys on device and return the reply page.
+        Takes any number of key=<key> fields and a comma separated
+        keys=<key>,<key>,... field, queued in that order."""
+        keys = list(postvars.get('key', []))
+        for field in postvars.get('keys', []):
+            keys += [key for key in field.split(",") if key]
+        sent = []
+        refused = []
+        for key in keys:
+            if device.sendKey(key):
+                sent.append(key)
+            else:
+                refused.append(key)
+        ret = "<html><head><title>key</title></head><body>" + cgi.escape(" ".join(sent))
+        if refused:
+            ret += "<br>refused: " + cgi.escape(" ".join(refused))
+        return ret + "</body></html>\n"
+
+    def sendMetrics(self):
+        """Send the bus and web server counters in Prometheus text format."""
+        ret = self.interface.metrics()
+        self.httpLock.acquire()
+        try:
+            ret += promHeader("aquaweb_http_requests_total", "counter",
+                              "HTTP replies sent, by status code.")
+            for code, count in sorted(self.httpCodes.items()):
+                ret += 'aquaweb_http_requests_total{code="%s"} %d\n' % (code, count)
+            ret += promHeader("aquaweb_http_request_seconds", "histogram",
+                              "Time to handle an HTTP request, event streams excluded.")
+            ret += self.httpTimes.prometheus("aquaweb_http_request_seconds")
+        finally:
+            self.httpLock.release()
+        ret += self.screen.macroMetrics()
+        ret += logs.metrics()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def sendState(self):
+        """Send the state snapshot as JSON, or 304 if the client has it."""
+        version, ret = self.state
+        if version != self.screen.snap.version:
+            version, ret = self.screen.stateJson()
+            webHandler.state = (version, ret)
+        etag = versionTag(version)
+        if self.headers.getheader('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def sendCells(self):
+        """Send the screen snapshot as it's stored, the character cells
+        then their attribute bytes, or 304 if the client has it."""
+        snap = self.screen.snap
+        etag = versionTag(snap.version)
+        if self.headers.getheader('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Screen-Size', "%dx%d" % (self.screen.W, self.screen.H))
+        self.send_header('Content-Length', str(len(snap.cells) + len(snap.attrs)))
+        self.end_headers()
+        self.wfile.write(snap.cells)
+        self.wfile.write(snap.attrs)
+
+    def sendDelta(self):
+        """Send the screen lines changed since the version in the query,
+        e.g. /screen.delta?since=5f0c1a2b-42, or the whole screen without
+        one or with one from another run."""
+        query = cgi.parse_qs(self.path.partition("?")[2])
+        try:
+            run, since = query['since'][0].split("-")
+            if int(run, 16) != STARTED:
+                since = None
+            else:
+                since = int(since)
+        except (KeyError, ValueError):
+            since = None
+        version, ret = self.screen.delta(since)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def sendMenus(self):
+        """Send the menu index as JSON: every item the menu graph knows,
+        with its value and the keys that reach it."""
+        ret = self.screen.menuIndex()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
+    def sendHistory(self, history):
+        """Send /history?metric=<name>&from=<time>[&res=raw|minute|hour]
+        as JSON.  from is a Unix time, or seconds ago if not above 0, and
+        defaults to an hour ago.  Without a metric, list them."""
+        query = cgi.parse_qs(self.path.partition("?")[2])
+        metric = query.get('metric', [None])[0]
+        resolution = query.get('res', [None])[0]
+        try:
+            since = float(query.get('from', [-3600])[0])
+        except ValueError:
+            self.send_error(400, 'Bad from time')
+            return
+        if since <= 0:
+            since += time.time()
+        if resolution not in (None, 'raw', 'minute', 'hour'):
+            self.send_error(400, 'Bad resolution')
+            return
+        ret = history.query(metric, since, resolution)
+        if ret is None:
+            self.send_error(404, 'No such metric: %s' % metric)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(ret)))
+        self.end_headers()
+        self.wfile.write(ret)
+
     #Handler for the GET requests
     def do_GET(self):
-        """HTTP GET handler, only the html files allowed."""
+        """HTTP GET handler, only the html file, state and event stream allowed."""
         if self.path == "/":
             self.path = "/index.html"
+        if self.path == "/metrics":
+            self.sendMetrics()
+            return
+        if self.path.startswith("/state.json"):
+            self.sendState()
+            return
+        if self.path.startswith("/screen.bin"):
+            self.sendCells()
+            return
+        if self.path.startswith("/screen.delta"):
+            self.sendDelta()
+            return
+        if self.path.startswith("/history"):
+            self.sendHistory(self.screen.history)
+            return
+        if self.path.startswith("/menu.json"):
+            self.sendMenus()
+            return
+        if self.path.startswith("/screen.events"):
+            self.sendEvents(self.screen)
+            return
         # We only serve some static stuff
-        if self.path.startswith("/index.html"):
-            mimetype = 'text/html'
-            ret = INDEXHTML
-            self.send_response(200)
-            self.send_header('Content-Type', mimetype)
-            self.end_headers()
-            self.wfile.write(ret)
-        else:
-            self.send_error(404, 'File Not Found: %s' % self.path)
+        for name, page in self.pages.items():
+            if self.path.startswith(name):
+                self.sendPage(page)
+                return
+        self.send_error(404, 'File Not Found: %s' % self.path)
 
     # don't log POSTs
     def log_message(self, format, *args):
@@ -175,49 +540,212 @@ class webHandler(BaseHTTPRequestHandler):
         except:
             postvars = {}
         if (self.path.startswith("/key.cgi") or
-                self.path.startswith("/screen.cgi")):
+                self.path.startswith("/screen.cgi") or
+                self.path.startswith("/acktimes.cgi")):
             mimetype = 'text/html'
             ret = ""
+            # Screen polls can be answered 304 if nothing has changed
+            etag = None
+            if self.path.startswith("/screen.cgi"):
+                etag = versionTag(self.screen.snap.version)
+                if self.headers.getheader('if-none-match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
             if self.path.startswith("/key.cgi"):
-                if 'key' in postvars:
-                    key = postvars['key'][0]
-                    self.screen.sendKey(key)
-                ret = "<html><head><title>key</title></head><body>"+key+"</body></html>\n"
+                ret = self.queueKeys(self.screen, postvars)
             elif self.path.startswith("/screen.cgi"):
                 ret = self.screen.html()
+            elif self.path.startswith("/acktimes.cgi"):
+                mimetype = 'text/plain'
+                ret = self.interface.ackTimes.text()
             self.send_response(200)
             self.send_header('Content-Type', mimetype)
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Length', str(len(ret)))
             self.end_headers()
             self.wfile.write(ret)
         else:
             self.send_error(404, 'File Not Found: %s' % self.path)
 
 
-class MyServer(HTTPServer):
-    """Override some HTTPServer procedures to allow instance variables and timeouts."""
-    def serve_forever(self, screen):
-        """Store the screen object and serve until end of times."""
+def staticPage(html):
+    """Prepare a static page once: the plain and gzipped bodies and a
+    strong ETag from its contents."""
+    buf = StringIO.StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+    gz.write(html)
+    gz.close()
+    return {'body': html, 'gzip': buf.getvalue(), 'etag': hashlib.md5(html).hexdigest()}
+
+
+def acceptsGzip(header):
+    """Check an Accept-Encoding header for gzip (not refused with q=0)."""
+    for coding in (header or "").split(","):
+        params = coding.split(";")
+        if params[0].strip().lower() in ("gzip", "x-gzip", "*"):
+            for param in params[1:]:
+                name, _, value = param.strip().partition("=")
+                try:
+                    if name == "q" and float(value) == 0:
+                        return False
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def versionTag(version):
+    """Return an ETag for a screen version.  The start time is mixed in
+    so tags from before a restart never match."""
+    return '"%x-%d"' % (STARTED, version)
+
+
+def runVersion(version):
+    """Return a display version as clients see it, with the start time
+    mixed in like versionTag() so one from before a restart never matches."""
+    return "%x-%d" % (STARTED, version)
+
+
+class PoolMixIn:
+    """Mix-in handing connections to a fixed pool of worker threads.
+
+    A worker only holds a connection while it handles one request.  Idle
+    keep-alive connections are parked and watched with select() by the
+    serving thread, and go back in the queue when the next request arrives.
+    When every worker is busy, ready connections wait in the queue."""
+
+    def servePool(self, size):
+        """Start size worker threads and serve until the end of times."""
+        self.requests = Queue.Queue()
+        self.idle = {}  # parked socket -> (client address, parked at)
+        self.idleLock = threading.Lock()
+        self.wakeRead, self.wakeWrite = os.pipe()
+        for n in range(size):
+            worker = threading.Thread(target=self.worker)
+            worker.daemon = True
+            worker.start()
+        while True:
+            self.idleLock.acquire()
+            try:
+                parked = self.idle.keys()
+            finally:
+                self.idleLock.release()
+            ready = select.select([self.socket, self.wakeRead] + parked, [], [], 1.0)[0]
+            now = time.time()
+            self.idleLock.acquire()
+            try:
+                for sock in ready:
+                    if sock is self.socket:
+                        self._handle_request_noblock()
+                    elif sock == self.wakeRead:
+                        os.read(self.wakeRead, 512)  # just a wake up
+                    elif sock in self.idle:
+                        self.requests.put((sock, self.idle.pop(sock)[0]))
+                for sock, (client_address, since) in self.idle.items():
+                    if now - since > IDLETIMEOUT:
+                        del self.idle[sock]
+                        self.shutdown_request(sock)
+            finally:
+                self.idleLock.release()
+
+    def worker(self):
+        """Handle one request at a time from the queue, forever."""
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                keep = not self.finish_request(request, client_address).close_connection
+            except:
+                self.handle_error(request, client_address)
+                keep = False
+            if keep:
+                self.idleLock.acquire()
+                try:
+                    self.idle[request] = (client_address, time.time())
+                finally:
+                    self.idleLock.release()
+                os.write(self.wakeWrite, "x")
+            else:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        """Queue a new connection for the next free worker."""
+        self.requests.put((request, client_address))
+
+    def finish_request(self, request, client_address):
+        """Handle one request, returning the handler."""
+        return self.RequestHandlerClass(request, client_address, self)
+
+
+def eventText(data):
+    """Format one Server-Sent Event, a data: field per line of data."""
+    ret = ""
+    for line in data.split("\n"):
+        ret += "data: " + line + "\n"
+    return ret + "\n"
+
+
+class MyServer(PoolMixIn, HTTPServer):
+    """Override some HTTPServer procedures to allow instance variables and timeouts.
+    Connections are handled by a fixed pool of worker threads, so one slow
+    client or event stream doesn't hold up the rest."""
+
+    def serve_forever(self, screen, interface):
+        """Store the screen and interface objects and serve until end of times."""
         self.RequestHandlerClass.screen = screen 
-        HTTPServer.serve_forever(self)
+        self.RequestHandlerClass.interface = interface
+        self.RequestHandlerClass.httpTimes = Histogram(HTTPBUCKETS)
+        self.RequestHandlerClass.pages = {"/index.html": staticPage(INDEXHTML)}
+        self.servePool(HTTPTHREADS)
     def get_request(self):
         """Get the request and client address from the socket."""
-        self.socket.settimeout(1.0)
-        result = None
-        while result is None:
-            try:
-                result = self.socket.accept()
-            except socket.timeout:
-                pass
-        result[0].settimeout(1.0)
-        return result
+        request, client_address = self.socket.accept()
+        request.settimeout(IDLETIMEOUT)
+        return request, client_address
+
+
+def keepAlive(screen):
+    """Wake up event streams now and then so they can notice dead clients."""
+    while True:
+        time.sleep(KEEPALIVE)
+        screen.poke()
+
+
+def sampler(screen):
+    """Record the equipment status in the history every SAMPLEPERIOD."""
+    while True:
+        time.sleep(SAMPLEPERIOD)
+        screen.sample()
 
 
-def startServer(screen):
+def menuKeeper(screen):
+    """Save the menu graph to MENUFILE every MENUSAVE, if it has changed."""
+    while True:
+        time.sleep(MENUSAVE)
+        try:
+            screen.saveMenus(MENUFILE)
+        except (IOError, OSError), e:
+            log("Can't save the menus: %s", e)
+
+
+def startServer(screen, interface):
     """HTTP Server implementation, to be in separate thread from main code."""
     try:
         webServer = MyServer(('', PORT), webHandler)
+        ticker = threading.Thread(target=keepAlive, args=(screen,))
+        ticker.daemon = True
+        ticker.start()
+        recorder = threading.Thread(target=sampler, args=(screen,))
+        recorder.daemon = True
+        recorder.start()
+        keeper = threading.Thread(target=menuKeeper, args=(screen,))
+        keeper.daemon = True
+        keeper.start()
         # Wait forever for incoming http requests
-        webServer.serve_forever(screen)
+        webServer.serve_forever(screen, interface)
     except KeyboardInterrupt:
         print '^C received, shutting down the web server'
         webServer.shutdown()
@@ -226,99 +754,189 @@ class Screen(object):
     """Emulates the Aqualink PDA remote control unit."""
     W = 16
     H = 10 
+    INVERSE = '\x01'  # attribute byte of an inverted cell
+    INVERTED = re.compile('\x01+')
     lock = None
-    nextAck = "00"
+    KEYS = { 'up':0x06, 'down':0x05, 'back':0x02, 'select':0x04, 'but1':0x01, 'but2':0x03 }
     poolmode = spamode = heater = poolheater = spaheater = pump = pumprpm = pumpwatts = tempair = tempwater = 0
-    macro = ""
+    FIELDS = ('poolmode', 'spamode', 'heater', 'poolheater', 'spaheater', 'pump',
+              'pumprpm', 'pumpwatts', 'tempair', 'tempwater')
+    # updateStatus() patterns, by the first word of the lines they match
+    MODES = re.compile(r"\s*(POOL|SPA) (MODE|HEATER)\s+(.*)")
+    TEMPS = re.compile(r"\s*(\d+)`\s+((\d+)`|)")
+    STATUS = {'POOL': MODES, 'SPA': MODES,
+              'RPM:': re.compile(r"\s+RPM\:\s+(\d{1,4})"),
+              'WATTS:': re.compile(r"\s+WATTS\:\s+(\d{1,4})")}
+    # Macros: the menu items each one selects, in turn
+    MACROS = {'cleaner': ("EQUIPMENT", "CLEANER"), 'poollight': ("EQUIPMENT", "POOL LIGHT"),
+              'spalight': ("EQUIPMENT", "SPA LIGHT"), 'poolmode': ("POOL MODE",),
+              'spamode': ("SPA MODE",), 'poolheater': ("POOL HEATER",),
+              'spaheater': ("SPA HEATER",), 'alloff': ("EQUIPMENT", "ALL OFF"),
+              'blower': ("EQUIPMENT", "AIR BLOWER")}
+    ITEM = re.compile(r"\s*(.*?\S)(?:\s{2,}(\S+))?\s*$")  # a menu item's name and state
+    MORE = re.compile(r"MORE")  # on the last line when a menu scrolls
+    CLOCK = re.compile(r"\d{1,2}:\d\d")  # the home screen's title is the time
+    BACK = 0x02  # route() heading back to the parent menu
+    macro = ()
     macroback = macroscroll = 0
 
     def __init__(self):
         """Set up the instance"""
-        self.screen = self.W * [self.H * " "]
-        self.invert = {'line':-1, 'start':-1, 'end':-1}
+        self.blank = self.H * self.W * " "  # cells of a clear screen
+        self.plain = self.H * self.W * NUL  # attrs with nothing inverted
+        self.cells = bytearray(self.blank)  # the display, row after row
+        self.attrs = bytearray(self.plain)  # an attribute byte per cell
+        self.snap = Snapshot(str(self.cells), str(self.attrs),
+                             dict((name, 0) for name in self.FIELDS), 0)
         self.currentline = -1
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()  # serializes changes, readers just take snap
+        self.changed = threading.Condition(self.lock)
+        self.renderLock = threading.Lock()
+        self.renders = {}  # form -> (version, output)
+        self.recent = collections.deque([self.snap], HISTORY)  # recent snapshots
+        self.deltas = (None, {})  # version, {base version: delta JSON}
+        self.acks = ackFrames(0x40, self.KEYS.values())
+        self.keys = KeyQueue(KEYQUEUE, KEYREPEAT)
+        self.history = History(energy=('pumpwatts',))
+        self.listeners = []  # each called with a StatusChange, from the bus thread
+        # The menu graph: title -> {'items': {name: index}, 'values': {name:
+        # state}, 'children': {item name: title it opens, None if it opens
+        # nothing}, 'parent': title back goes to}
+        self.menus = {}
+        self.graphLock = threading.Lock()  # the bus thread changes menus under it
+        self.graphChanges = 0  # bumped on every change to menus
+        self.graphSaved = 0    # graphChanges as of the last save
+        self.menu = None    # title of the menu on the screen
+        self.top = 0        # index in it of the item on line 1
+        self.learned = -1   # snapshot version the graph last looked at
+        self.pending = None  # (title, item, key) of a select or back not yet seen through
+        self.macroName = None
+        self.macroStart = 0.0
+        self.macroSteps = 0  # keys the running macro has sent
+        self.macroTimes = MacroTimes(MACROTIMES)
+        self.lastKey = time.time()  # of the last key or macro, for the crawl
+        self.crawled = set()  # menus the crawl has scrolled all the way through
+        self.backed = set()   # menus the crawl has tried going back from
+        self.opened = set()   # (menu, index) of items the crawl has selected
+        self.sweep = (None, set())  # menu being crawled, items the cursor has been on
+        self.crawlIdle = -1   # snapshot version the crawl found nothing to do at
+        self.prepared = None  # (version, macro, key, (macro, scroll, back) after) for the next poll
+
+    def _publish(self, snap):
+        """Make snap, with the next version, what readers see, and wake up
+        anyone waiting on a change.  Called with the lock held."""
+        self.snap = snap._replace(version=self.snap.version + 1)
+        self.recent.append(self.snap)
+        self.changed.notifyAll()
+
+    def _commit(self, cells=True, attrs=True):
+        """Publish copies of the buffers that were changed, if they no
+        longer match the snapshot.  Called with the lock held."""
+        snap = self.snap
+        cells = cells and str(self.cells) or snap.cells
+        attrs = attrs and str(self.attrs) or snap.attrs
+        if cells != snap.cells or attrs != snap.attrs:
+            self._publish(snap._replace(cells=cells, attrs=attrs))
+
+    def waitChange(self, version):
+        """Wait until our version differs from version, or for the next
+        keepalive poke, and return the current version."""
+        self.lock.acquire()
+        try:
+            if self.snap.version == version:
+                self.changed.wait()
+            return self.snap.version
+        finally:
+            self.lock.release()
+
+    def poke(self):
+        """Wake up waiters without changing anything."""
+        self.lock.acquire()
+        try:
+            self.changed.notifyAll()
+        finally:
+            self.lock.release()
 
     def cls(self):
-        """Clear the screen."""
+        """Clear the screen, and the invert region with it."""
         self.lock.acquire()
         try:
-            for i in range(0, self.H):
-                self.screen[i] = " "
-            self.invert['line'] = -1
+            self.cells[:] = self.blank
+            self.attrs[:] = self.plain
+            self._commit()
         finally:
             self.lock.release()
         self.currentline = -1
 
     def scroll(self, start, end, direction):
         """Scroll screen up or down per controller request."""
+        end = min(end, self.H - 1)
+        if start >= self.H:
+            return
+        W = self.W
         self.lock.acquire()
         try:
             if direction == 255:  #-1
-                for x in range(start, end):
-                    self.screen[x] = self.screen[x+1]
-                self.screen[end] = self.W*" "
+                self.cells[start*W:end*W] = self.cells[(start+1)*W:(end+1)*W]
+                self.cells[end*W:(end+1)*W] = W*" "
             elif direction == 1:  # +1
-                for x in range(end, start, -1):
-                    self.screen[x] = self.screen[x-1]
-                self.screen[start] = self.W*" "
+                self.cells[(start+1)*W:(end+1)*W] = self.cells[start*W:end*W]
+                self.cells[start*W:(start+1)*W] = W*" "
+            self._commit(attrs=False)
         finally:
             self.lock.release()
 
     def updateStatus(self, text):
-        # check for ON or ENA on main menu
-        searchObj = re.search("POOL MODE\s+(.*)",text)
-        if searchObj:
-            if searchObj.group(1) == "ON":
-                self.poolmode = 1
-                self.spamode = 0
-                self.pump = 1
-            else:
-                self.poolmode = 0
-
-        searchObj = re.search("SPA MODE\s+(.*)",text)
-        if searchObj:
-            if searchObj.group(1) == "ON":
-                self.spamode = 1
-                self.poolmode = 0
-                self.pump = 1 
-            else:
-                self.spamode = 0
-
-        searchObj = re.search("POOL HEATER\s+(.*)",text)
-        if searchObj:
-            if searchObj.group(1) == "ENA":
-                self.poolheater = 1
-                self.pump = 1
-            else:
-                self.poolheater = 0
-
-
-        searchObj = re.search("SPA HEATER\s+(.*)",text)
-        if searchObj:
-            if searchObj.group(1) == "ENA":
-                self.spaheater = 1
-                self.pump = 1
-            else:
-                self.spaheater = 0
-
-        # get temps - first is air, second is water (but only shows if pump is running)
-        searchObj = re.search("^\s*(\d+)`\s+((\d+)`|)",text)
-        if searchObj:
-            if searchObj.group(1): self.tempair = searchObj.group(1)
-            if searchObj.group(3): 
-                self.tempwater =  searchObj.group(3)
+        """Parse any equipment status out of a line the controller wrote.
+        The first word picks the one pattern that could match, as most
+        lines are menu text, and listeners get a StatusChange for each
+        value that changed."""
+        words = text.split(None, 1)
+        if not words:
+            return
+        first = words[0]
+        if first[0].isdigit():
+            pattern = self.TEMPS
+        else:
+            pattern = self.STATUS.get(first)
+        if pattern is None:
+            return
+        match = pattern.match(text)
+        if not match:
+            return
+        before = [getattr(self, name) for name in self.FIELDS]
+
+        # ON or ENA on main menu
+        if pattern is self.MODES:
+            equipment, setting = match.group(1, 2)
+            if setting == "MODE":
+                if match.group(3) == "ON":
+                    self.poolmode = int(equipment == "POOL")
+                    self.spamode = int(equipment == "SPA")
+                    self.pump = 1
+                elif equipment == "POOL":
+                    self.poolmode = 0
+                else:
+                    self.spamode = 0
             else:
-                self.tempwater = 0
-
-        # get pump info
-        searchObj = re.search("^\s+RPM\:\s+(\d{1,4})",text)
-        if searchObj:
-            if searchObj.group(1): self.pumprpm = searchObj.group(1)
-            
-        searchObj = re.search("^\s+WATTS\:\s+(\d{1,4})",text)
-        if searchObj:
-            if searchObj.group(1): self.pumpwatts = searchObj.group(1)
+                heater = int(match.group(3) == "ENA")
+                if equipment == "POOL":
+                    self.poolheater = heater
+                else:
+                    self.spaheater = heater
+                if heater:
+                    self.pump = 1
+
+        # temps - first is air, second is water (but only shows if pump is running)
+        elif pattern is self.TEMPS:
+            self.tempair = int(match.group(1))
+            self.tempwater = int(match.group(3) or 0)
+
+        # pump info
+        elif first == "RPM:":
+            self.pumprpm = int(match.group(1))
+        else:
+            self.pumpwatts = int(match.group(1))
 
         if self.poolheater == 1 or self.spaheater == 1:
             self.heater = 1
@@ -327,163 +945,561 @@ class Screen(object):
 
         if self.poolmode == 0 and self.spamode == 0: self.pump = self.pumprpm = self.pumpwatts = self.heater = 0  # if both pool and spa are off, assume pump and heater is as well
 
+        after = [getattr(self, name) for name in self.FIELDS]
+        if after == before:
+            return
+        self.lock.acquire()
+        try:
+            self._publish(self.snap._replace(status=dict(zip(self.FIELDS, after))))
+        finally:
+            self.lock.release()
+
+        for name, old, new in zip(self.FIELDS, before, after):
+            if new != old:
+                change = StatusChange(name, old, new)
+                for listener in self.listeners:
+                    listener(change)
+
+    def sample(self):
+        """Record the status parsed from the screen in the history.  No
+        temperature shows as 0."""
+        self.history.record({'poolmode': self.poolmode, 'spamode': self.spamode,
+                             'heater': self.heater, 'poolheater': self.poolheater,
+                             'spaheater': self.spaheater, 'pump': self.pump,
+                             'pumprpm': self.pumprpm, 'pumpwatts': self.pumpwatts,
+                             'tempair': self.tempair or None,
+                             'tempwater': self.tempwater or None})
 
     def writeLine(self, line, text):
         """"Controller sent new line for screen."""
+        if line >= self.H:
+            return
+        text = text[:self.W].ljust(self.W)
+        start = line*self.W
         self.lock.acquire()
         try:
-            self.screen[line] = text + self.W*" "
-            self.screen[line] = self.screen[line][:self.W]
+            # Controllers rewrite lines that haven't changed all the time
+            if self.snap.cells[start:start + self.W] != text:
+                self.cells[start:start + self.W] = text
+                self._commit(attrs=False)
         finally:
             self.lock.release()
 
     def invertLine(self, line):
         """Controller asked to invert entire line."""
-        self.lock.acquire()
-        try:
-            self.invert['line'] = line
-            self.invert['start'] = 0
-            self.invert['end'] = self.W
-        finally:
-            self.lock.release()
+        self.setInvert(line, 0, self.W)
         self.currentline = line
 
     def invertChars(self, line, start, end):
         """Controller asked to invert chars on a line."""
+        self.setInvert(line, start, end)
+
+    def setInvert(self, line, start, end):
+        """Invert cells start to end (inclusive) of line, in place of
+        whatever was inverted before."""
         self.lock.acquire()
         try:
-            self.invert['line'] = line
-            self.invert['start'] = start
-            self.invert['end'] = end
+            self.attrs[:] = self.plain
+            if line < self.H:
+                first = line*self.W + min(start, self.W)
+                last = line*self.W + min(end, self.W - 1) + 1
+                self.attrs[first:last] = (last - first) * self.INVERSE
+            self._commit(cells=False)
         finally:
             self.lock.release()
 
+    def rows(self, cells):
+        """Split a snapshot's cells into its lines of text."""
+        return [cells[n:n + self.W] for n in range(0, self.H * self.W, self.W)]
+
+    def inverted(self, attrs):
+        """Return (line, start, end) for each run of inverted cells in a
+        snapshot's attrs, end exclusive."""
+        ret = []
+        for m in self.INVERTED.finditer(attrs):
+            start, end = m.span()
+            while start < end:  # split any run that wraps onto the next line
+                line, first = divmod(start, self.W)
+                last = min(end - line*self.W, self.W)
+                ret.append((line, first, last))
+                start = line*self.W + last
+        return ret
 
-    def html(self):
-        """Return the screen as a HTML element (<PRE> assumed)"""
-        self.lock.acquire()
+    def rendered(self, form, render):
+        """Return render(cells, attrs) for the current screen, reusing the
+        last result until the screen changes.  Rendering works from the
+        current snapshot without the bus lock, and concurrent callers wait
+        for and share a single render."""
+        self.renderLock.acquire()
         try:
-            ret = "<pre>"
-            for x in range(0, self.H): 
-                if x == self.invert['line']:
-                    for y in range(0, self.W):
-                        if y == self.invert['start']:
-                            ret += "<span style=\"background-color: #FFFF00\"><b>"
-                        ret += self.screen[x][y:y+1]
-                        if y == self.invert['end']:
-                            ret += "</b></span>"
-                    if self.invert['end'] == self.W:
-                        ret += "</b></span>"
-                    ret += "\n"
-                else:
-                    ret += self.screen[x] + "\n"
-            ret += "</pre>"
+            return self._render(form, render, self.snap)
         finally:
-            self.lock.release()
+            self.renderLock.release()
+
+    def _render(self, form, render, snap):
+        """rendered() for snap.  Called with the render lock held."""
+        version, ret = self.renders.get(form, (None, None))
+        if version != snap.version:
+            ret = render(snap.cells, snap.attrs)
+            self.renders[form] = (snap.version, ret)
         return ret
 
+    def delta(self, since):
+        """Return (version, JSON text) to bring a client showing version
+        since up to date: the HTML of just the lines that changed since
+        then, or of every line with "full" set if since is too old."""
+        self.renderLock.acquire()
+        try:
+            snap = self.snap
+            base = None
+            for old in list(self.recent):  # a copy, the bus thread appends
+                if old.version == since:
+                    base = old
+            key = base and base.version
+            version, deltas = self.deltas
+            if version != snap.version:
+                deltas = {}
+                self.deltas = (snap.version, deltas)
+            if key not in deltas:
+                lines = self._render('lines', self._htmlLines, snap)
+                if base is None:
+                    delta = {'version': runVersion(snap.version), 'full': True, 'lines': lines}
+                else:
+                    delta = {'version': runVersion(snap.version), 'lines': {}}
+                    for n in range(0, self.H):
+                        start, end = n*self.W, (n+1)*self.W
+                        if (base.cells[start:end] != snap.cells[start:end] or
+                            base.attrs[start:end] != snap.attrs[start:end]):
+                            delta['lines'][n] = lines[n]
+                deltas[key] = json.dumps(delta, encoding="latin-1")  # screen bytes as they are
+            return snap.version, deltas[key]
+        finally:
+            self.renderLock.release()
+
+    def html(self):
+        """Return the screen as a HTML element (<PRE> assumed)"""
+        return self.rendered('html', self._html)
+
+    def _html(self, cells, attrs):
+        """Render cells as HTML with the inverted ones highlighted."""
+        return "<pre>" + "".join([line + "\n" for line in self._htmlLines(cells, attrs)]) + "</pre>"
+
+    def _htmlLines(self, cells, attrs):
+        """The lines of cells as HTML, inverted ones highlighted."""
+        lines = self.rows(cells)
+        for line, start, end in reversed(self.inverted(attrs)):
+            text = lines[line]
+            lines[line] = text[:start] + "<span style=\"background-color: #FFFF00\"><b>" + \
+                          text[start:end] + "</b></span>" + text[end:]
+        return lines
+
+    def text(self):
+        """Return the screen as plain text, one line per row."""
+        return self.rendered('text', lambda cells, attrs: "\n".join(self.rows(cells)) + "\n")
+
+    def stateJson(self):
+        """Turn the current snapshot of the screen, and the equipment status
+        parsed from it, into (version, JSON text)."""
+        snap = self.snap
+        state = {'version': snap.version,
+                 'lines': self.rows(snap.cells),
+                 'invert': [{'line': line, 'start': start, 'end': end - 1}
+                            for line, start, end in self.inverted(snap.attrs)],
+                 'status': snap.status}
+        return snap.version, json.dumps(state, encoding="latin-1")
+
     def sendAck(self, i, ret):
-        """Controller talked to us - send back macro, last keypress, or an empty ack."""
-        ackstr = "4000"
+        """Controller talked to us - send back macro, last keypress, or an empty ack.
+        The graph and the macro's next key are usually worked out already
+        by prepare(), so a poll only looks them up."""
+        ack = 0x00
+        if menuGraph and ret.cmd == 0x02:
+            self.learn(self.snap)
 
         # if a macro button has been pressed, process it
-        if len(self.macro) >= 1:
-           
-            if ret['cmd'] == "02": 
-               
-                # loop through macro steps and current screen to see if anything is here, in which case skip a few macro steps
-                macrocount = 0
-                for macroitem in self.macro:
-                    if filter(re.compile(macroitem).search,self.screen[1:-1]):
-                            del self.macro[0:macrocount]
-                            break
-                    macrocount += 1
-               
-                searchMore = re.search("MORE",self.screen[9])  # search for "MORE" line (scrolling menu)
-                searchCurrentline = re.search(self.macro[0],self.screen[self.currentline])  # search current line for target
-                searchScreen = filter(re.compile(self.macro[0]).search,self.screen[1:-1]) # search screen for first macro
-                                                                 
-                #move up if it looks quicker to get to target command
-                movecmd = "4006" # by default move down
-                if searchScreen:
-                    foundindex = self.screen.index(searchScreen[0])
-                    if self.currentline < foundindex:
-                        movecmd = "4005"
-
-                if searchScreen or searchMore:   # is current macro anywhere on the screen or can we scroll for more options?
-                    if searchCurrentline: # target found, select
-                        ackstr = "4004" 
-                        del self.macro[0]
-                        self.macroscroll = 0
-                    else:
-                        if self.macroscroll > 13: # can't find it here, move back to look on previous screen
-                            self.macroscroll = 0
-                            ackstr = "4002"  # move back to look on previous screen
-                            self.macroback += 1
-                        else:
-                            ackstr = movecmd  # target is on this screen, move up or down 
-                            self.macroscroll += 1
+        if self.macro:
+            if ret.cmd == 0x02:
+                prepared, self.prepared = self.prepared, None
+                if prepared and prepared[0] == self.snap.version and prepared[1] is self.macro:
+                    ack = prepared[2]
+                    self.macro, self.macroscroll, self.macroback = prepared[3]
                 else:
+                    ack = self.macroKey()
+                if ack:
+                    self.macroSteps += 1
+                if not self.macro:
+                    self.macroTimes.add(self.macroName, ack == 0x04 and "done" or "abandoned",
+                                        time.time() - self.macroStart, self.macroSteps)
+        else:
+            ack = self.keys.get()
+            if not ack and menuCrawl and ret.cmd == 0x02 and time.time() - self.lastKey > CRAWLIDLE:
+                ack = self.crawlKey()
+
+        if menuGraph and ack in (0x02, 0x04) and self.menu:
+            # see where it goes next time round, for the graph
+            name = ack == 0x04 and self.currentline > 0 and \
+                self.itemName(self.rows(self.snap.cells)[self.currentline])
+            self.pending = (self.menu, name, ack)
+        i.sendAck(ret, self.acks[ack])
+
+    def prepare(self):
+        """Learn the screen and work out the running macro's next key ahead
+        of the poll, after each frame rather than on the way to an ACK.
+        The key is worked out on a copy of the macro, and only taken up by
+        sendAck() if the screen and the macro are still the same."""
+        snap = self.snap
+        if self.prepared and self.prepared[0] == snap.version:
+            return
+        if menuGraph:
+            self.learn(snap)
+        macro = self.macro
+        if not macro:
+            return
+        state = self.macroscroll, self.macroback
+        ahead = self.macro = list(macro)
+        try:
+            ack = self.macroKey()
+            self.prepared = (snap.version, macro, ack, (self.macro, self.macroscroll, self.macroback))
+        finally:
+            if self.macro is ahead:  # unless sendKey() started another meanwhile
+                self.macro = macro
+            self.macroscroll, self.macroback = state
+
+    def macroKey(self):
+        """Return the running macro's next key, or 0 to wait, dropping
+        the items it has selected off the front of it."""
+        rows = self.rows(self.snap.cells)
+        if menuGraph and self.macroSteps < MACROSTEPS:
+            ack = self.graphKey(rows)
+            if ack is not None:
+                return ack
+        return self.searchKey(rows)
+
+    def graphKey(self, rows):
+        """Head for the furthest of the macro's items the graph knows a way
+        to, by the shortest way it knows.  None if it knows none."""
+        if self.currentline < 1 or self.menuTitle(rows[0]) != self.menu:
+            return None
+        for n in range(len(self.macro) - 1, -1, -1):
+            hop = self.route(self.menu, self.macro[n])
+            if hop is not None:
+                break
+        else:
+            return None
+        del self.macro[:n]
+        if hop == self.BACK:
+            return 0x02
+        # hop is an item on this menu, the one we want or the way to it
+        ack = self.towards(rows, hop)
+        if ack == 0x04 and self.macro[0].search(hop):
+            del self.macro[0]
+        return ack
+
+    def towards(self, rows, name):
+        """The key that moves the cursor towards item name of the menu on
+        the screen, or selects it once it's there."""
+        index = self.menus[self.menu]['items'][name]
+        current = self.top + self.currentline - 1
+        if index == current and self.itemName(rows[self.currentline]) == name:
+            return 0x04
+        if index > current:
+            return 0x05
+        return 0x06
+
+    def crawlKey(self):
+        """The next key of the crawl: scroll through each menu, open each
+        item known to lead to another or named in CRAWLOPEN, then go back.
+        0 once there's nothing left to learn from here."""
+        snap = self.snap
+        if snap.version == self.crawlIdle or not menuGraph:
+            return 0
+        rows = self.rows(snap.cells)
+        if self.currentline < 1 or self.menuTitle(rows[0]) != self.menu:
+            return 0  # wait for the screen to settle
+        node = self.menus[self.menu]
+        if self.menu not in self.crawled:
+            # down until the cursor comes round again, or stops at the end
+            name = self.itemName(rows[self.currentline])
+            if self.sweep[0] != self.menu:
+                self.sweep = (self.menu, set())
+            if name not in self.sweep[1]:
+                self.sweep[1].add(name)
+                return 0x05
+            self.crawled.add(self.menu)
+        for name in sorted(node['items'], key=node['items'].get):
+            child = node['children'].get(name, False)
+            if child is False and not node['values'].get(name) and CRAWLOPEN.match(name) \
+                    and (self.menu, node['items'][name]) not in self.opened \
+                    or child and child not in self.crawled:
+                ack = self.towards(rows, name)
+                if ack == 0x04:  # once only, whatever it turns out to do
+                    self.opened.add((self.menu, node['items'][name]))
+                return ack
+        if node['parent'] or self.menu not in self.backed:
+            self.backed.add(self.menu)
+            return 0x02
+        self.crawlIdle = snap.version
+        return 0
+
+    def searchKey(self, rows):
+        """Look for the macro's next item by moving about the menus."""
+        ack = 0x00
+        screen = rows
+
+        # loop through macro steps and current screen to see if anything is here, in which case skip a few macro steps
+        macrocount = 0
+        for macroitem in self.macro:
+            if filter(macroitem.search, screen[1:]):
+                    del self.macro[0:macrocount]
+                    break
+            macrocount += 1
+
+        searchMore = self.MORE.search(screen[9])  # search for "MORE" line (scrolling menu)
+        searchCurrentline = self.macro[0].search(screen[self.currentline])  # search current line for target
+        searchScreen = filter(self.macro[0].search, screen[1:]) # search screen for first macro
+
+        #move up if it looks quicker to get to target command
+        movecmd = 0x06 # by default move down
+        if searchScreen:
+            foundindex = screen.index(searchScreen[0])
+            if self.currentline < foundindex:
+                movecmd = 0x05
+
+        if searchScreen or searchMore:   # is current macro anywhere on the screen or can we scroll for more options?
+            if searchCurrentline: # target found, select
+                ack = 0x04
+                del self.macro[0]
+                self.macroscroll = 0
+            else:
+                if self.macroscroll > 13: # can't find it here, move back to look on previous screen
                     self.macroscroll = 0
-                    if self.macroback >= 3:  # moved back too many times, give up
-                        del self.macro[0]
-                        self.macroback = 0
-                    else:
-                        ackstr = "4002"  # move back to look on previous screen
-                        self.macroback += 1
-
-                #brute force - string of button pushes only
-                #ackstr = "40" + self.macro[0]
-                #del self.macro[0]
+                    ack = 0x02  # move back to look on previous screen
+                    self.macroback += 1
+                else:
+                    ack = movecmd  # target is on this screen, move up or down
+                    self.macroscroll += 1
         else:
-            ackstr = "40" + self.nextAck
-            
-        i.sendMsg( (chr(0), chr(1), ackstr.decode("hex")) )
-        self.nextAck = "00"
+            self.macroscroll = 0
+            if self.macroback >= 3:  # moved back too many times, give up
+                del self.macro[0]
+                self.macroback = 0
+            else:
+                ack = 0x02  # move back to look on previous screen
+                self.macroback += 1
+
+        #brute force - string of button pushes only
+        #ack = self.macro[0]
+        #del self.macro[0]
+        return ack
+
+    def menuTitle(self, line):
+        """The title of the menu with line 0 line."""
+        title = line.strip()
+        if self.CLOCK.search(title):
+            return "HOME"
+        return title
+
+    def itemName(self, line):
+        """The name of the menu item on line, without its state."""
+        m = self.ITEM.match(line)
+        return m and m.group(1) or ""
+
+    def learn(self, snap):
+        """Add what's on the screen to the menu graph: the menu, its items
+        and where they sit in it, and where the last select or back key
+        led.  Called from the bus thread."""
+        if snap.version == self.learned:
+            return
+        self.learned = snap.version
+        rows = self.rows(snap.cells)
+        title = self.menuTitle(rows[0])
+        if not title:  # cleared and not yet redrawn
+            return
+        page = []
+        for line in range(1, self.H):
+            m = self.ITEM.match(rows[line])
+            if m and not (line == self.H - 1 and self.MORE.search(rows[line])):
+                page.append((line, m.group(1), m.group(2) or ""))
+
+        self.graphLock.acquire()
+        try:
+            changed = title not in self.menus
+            menu = self.menus.setdefault(title, {'items': {}, 'values': {}, 'children': {},
+                                                 'parent': None})
+            if self.pending:
+                last, name, key = self.pending
+                self.pending = None
+                node = self.menus[last]
+                if key == 0x04 and name:
+                    child = title != last and title or None
+                    changed = changed or node['children'].get(name, False) != child
+                    node['children'][name] = child
+                elif key == 0x02 and title != last:
+                    changed = changed or node['parent'] != title
+                    node['parent'] = title
+            self.menu = title
+            before = (dict(menu['items']), dict(menu['values']), dict(menu['children']))
+
+            # Where the page sits in the menu, from an item we've placed
+            # before, else just past the ones we know of.  If the others we
+            # know don't agree the menu has changed, so start it afresh.
+            items = menu['items']
+            for line, name, value in page:
+                if name in items:
+                    self.top = items[name] - line + 1
+                    break
+            else:
+                self.top = items and max(items.values()) + 1 or 0
+            for line, name, value in page:
+                if items.get(name, self.top + line - 1) != self.top + line - 1:
+                    items.clear()
+                    menu['values'].clear()
+                    menu['children'].clear()
+                    self.crawled.discard(title)
+                    self.top = 0
+                    break
+            shown = {}
+            for line, name, value in page:
+                shown[self.top + line - 1] = name
+                menu['values'][name] = value
+            for name, index in items.items():
+                if shown.get(index, name) != name:  # moved, or gone
+                    del items[name]
+                    menu['values'].pop(name, None)
+                    menu['children'].pop(name, None)
+            for index, name in shown.items():
+                items[name] = index
+            if changed or (items, menu['values'], menu['children']) != before:
+                self.graphChanges += 1
+        finally:
+            self.graphLock.release()
+
+    def route(self, title, pattern):
+        """The first step of the shortest way the graph knows from menu
+        title to a menu with an item matching pattern: the item on title to
+        select or go to, BACK, or None if it knows no way."""
+        first = {title: None}
+        queue = collections.deque([title])
+        while queue:
+            menu = queue.popleft()
+            node = self.menus.get(menu)
+            if node is None:
+                continue
+            for name in node['items']:
+                if pattern.search(name):
+                    return first[menu] or name
+            hops = [(child, name) for name, child in node['children'].items()
+                    if child and name in node['items']]
+            if node['parent']:
+                hops.append((node['parent'], self.BACK))
+            for child, hop in hops:
+                if child not in first:
+                    first[child] = first[menu] or hop
+                    queue.append(child)
+        return None
+
+    def menuIndex(self):
+        """Every item in the menu graph as JSON, with its menu, value, and
+        the keys that reach it from a top menu, moving down from the first
+        item of each menu on the way.  keys is null for items in menus the
+        graph doesn't know the way to."""
+        self.graphLock.acquire()
+        try:
+            # the way to each menu, breadth first from those with no parent
+            paths = {}
+            queue = collections.deque()
+            for title, node in sorted(self.menus.items()):
+                if not node['parent']:
+                    paths[title] = []
+                    queue.append(title)
+            while queue:
+                title = queue.popleft()
+                node = self.menus[title]
+                first = min(node['items'].values() or [0])
+                for name, child in sorted(node['children'].items()):
+                    if child in self.menus and child not in paths and name in node['items']:
+                        paths[child] = paths[title] + (node['items'][name] - first) * ["down"] + ["select"]
+                        queue.append(child)
+            items = []
+            for title, node in sorted(self.menus.items()):
+                first = min(node['items'].values() or [0])
+                for name, index in sorted(node['items'].items(), key=lambda item: item[1]):
+                    keys = paths[title] + (index - first) * ["down"] if title in paths else None
+                    items.append({'menu': title, 'item': name, 'value': node['values'].get(name, ""),
+                                  'keys': keys})
+        finally:
+            self.graphLock.release()
+        return json.dumps({'menus': len(self.menus), 'items': items}, encoding="latin-1")
+
+    def saveMenus(self, filename):
+        """Write the menu graph to filename if it has changed since the
+        last time, by way of a temporary file so a crash can't leave half
+        of it.  Only the copy is taken under graphLock, learn() waits on
+        that before an ACK goes out."""
+        self.graphLock.acquire()
+        try:
+            changes = self.graphChanges
+            if changes == self.graphSaved:
+                return
+            menus = {}
+            for title, menu in self.menus.items():
+                menus[title] = {'items': dict(menu['items']), 'values': dict(menu['values']),
+                                'children': dict(menu['children']), 'parent': menu['parent']}
+        finally:
+            self.graphLock.release()
+        data = json.dumps({'menus': menus}, indent=1, sort_keys=True, encoding="latin-1")
+        f = open(filename + ".new", "w")
+        f.write(data)
+        f.close()
+        os.rename(filename + ".new", filename)
+        self.graphSaved = changes  # only once it's written, else it's tried again
+
+    def loadMenus(self, filename):
+        """Start the menu graph off with one saved by an earlier run, so
+        macros know their way from the start.  The crawl still goes over
+        it again to bring the values up to date.  False if there's none."""
+        try:
+            menus = latin1(json.load(open(filename))['menus'])
+        except (IOError, ValueError, KeyError):
+            return False
+        self.graphLock.acquire()
+        try:
+            self.menus = menus
+        finally:
+            self.graphLock.release()
+        return True
 
-    def setNextAck(self, nextAck):
-        """Set the value we will send on the next ack, but don't send yet."""
-        self.nextAck = nextAck
+    def macroMetrics(self):
+        """Macro runs, their median time and keys, and the menus known, in
+        Prometheus text format."""
+        ret = self.macroTimes.prometheus()
+        ret += promHeader("aquaweb_menus_known", "gauge", "Menus in the macros' menu graph.")
+        return ret + "aquaweb_menus_known %d\n" % len(self.menus)
 
     def sendKey(self, key):
-        """Send a key (text) on the next ack."""
-        keyToAck = { 'up':"06", 'down':"05", 'back':"02", 'select':"04", 'but1':"01", 'but2':"03" }
-        
-        if key == "cleaner":
-            self.macro = ["EQUIPMENT","CLEANER"]
-        elif key == "poollight":
-            self.macro = ["EQUIPMENT","POOL LIGHT"]
-        elif key == "spalight":
-            self.macro = ["EQUIPMENT","SPA LIGHT"]
-        elif key == "poolmode":
-            self.macro = ["POOL MODE"]
-        elif key == "spamode":
-            self.macro = ["SPA MODE"]
-        elif key == "poolheater":
-            self.macro = ["POOL HEATER"]
-        elif key == "spaheater":
-            self.macro = ["SPA HEATER"]
-        elif key == "alloff":
-            self.macro = ["EQUIPMENT","ALL OFF"]
-        elif key == "blower":
-            self.macro = ["EQUIPMENT","AIR BLOWER"]
+        """Queue a key (text) or start a macro.  Return False if refused."""
+        if key in self.MACROS:
+            self.macro = [re.compile(item) for item in self.MACROS[key]]
+            self.macroName = key
+            self.macroStart = time.time()
+            self.macroSteps = self.macroscroll = self.macroback = 0
+            self.lastKey = self.macroStart
         elif key == "status":
-            log("poolmode="+str(self.poolmode)+\
-                    " spamode="+str(self.spamode)+\
-                    " heater="+str(self.heater)+\
-                    " pump="+str(self.pump)+\
-                    " pumprpm="+str(self.pumprpm)+\
-                    " pumpwatts="+str(self.pumpwatts)+\
-                    " air="+str(self.tempair)+\
-                    " water="+str(self.tempwater))
-            log("current line = " + str(self.currentline) +" - [" + self.screen[self.currentline] + "]")
-            self.screen[0] = "Status!"
+            log("poolmode=%s spamode=%s heater=%s pump=%s pumprpm=%s pumpwatts=%s air=%s water=%s",
+                self.poolmode, self.spamode, self.heater, self.pump, self.pumprpm,
+                self.pumpwatts, self.tempair, self.tempwater)
+            log("current line = %d - [%s]", self.currentline, self.rows(self.snap.cells)[self.currentline])
+            self.writeLine(0, "Status!")
         else:
-            if key in keyToAck.keys():
-                self.setNextAck(keyToAck[key])
+            if key in self.KEYS:
+                self.lastKey = time.time()
+                return self.keys.put(self.KEYS[key])
+            return False
+        return True
 
-    def processMessage(self, ret, i):
-        """Process message from a controller, updating internal state."""
+    def processMessage(self, ret):
+        """Process message from a controller, updating internal state.
+        The ACK is sent separately."""
 
         """ known commands:
             00 = probe
@@ -497,64 +1513,612 @@ class Screen(object):
             1b = unknown/initial screen (?)
         """
 
-        if ret['cmd'] == "09":  # Clear Screen
+        if ret.cmd == 0x09:  # Clear Screen
             self.cls()
-        elif ret['cmd'] == "0f":  # Scroll Screen
-            start = ord(ret['args'][:1])
-            end = ord(ret['args'][1:2])
-            direction = ord(ret['args'][2:3])
+        elif ret.cmd == 0x0f:  # Scroll Screen
+            start = ret.arg(0)
+            end = ret.arg(1)
+            direction = ret.arg(2)
             self.scroll(start, end, direction)
-        elif ret['cmd'] == "04":  # Write a line
-            line = ord(ret['args'][:1])
+        elif ret.cmd == 0x04:  # Write a line
+            line = ret.arg(0)
             if line == 64: line = 0  # PDA: time (hex=40)
             if line == 130: line = 2  # PDA: temp (hex=82)
-            offset = 1
-            text = ""
-            while (ret['args'][offset:offset+1].encode("hex") != "00") and (offset < len(ret['args'])):
-                text += ret['args'][offset:offset+1]
-                offset = offset + 1
-            self.writeLine(line, text)
+            # Text runs up to the first NUL
+            text = ret.args[1:].tobytes().split(NUL, 1)[0]
+            # Status first, so it's current by the time the version moves
             self.updateStatus(text)
-        elif ret['cmd'] == "00":  # probe
+            self.writeLine(line, text)
+        elif ret.cmd == 0x00:  # probe
             pass
-        elif ret['cmd'] == "1b":  # boot message
+        elif ret.cmd == 0x1b:  # boot message
             pass #do nothing
-        elif ret['cmd'] == "02":  # status/keepalive
+        elif ret.cmd == 0x02:  # status/keepalive
             pass #do nothing; args may be useful?
-        elif ret['cmd'] == "08":  # Invert an entire line
-            self.invertLine( ord(ret['args'][:1]) )
-        elif ret['cmd'] == "10":  # Invert just some chars on a line
-            self.invertChars( ord(ret['args'][:1]), ord(ret['args'][1:2]), ord(ret['args'][2:3]) )
+        elif ret.cmd == 0x08:  # Invert an entire line
+            self.invertLine( ret.arg(0) )
+        elif ret.cmd == 0x10:  # Invert just some chars on a line
+            self.invertChars( ret.arg(0), ret.arg(1), ret.arg(2) )
         else:
-            log("UNKNOWN MESSAGE: dest=" +ret['dest'] + " cmd=" + ret['cmd'] + " args=" + ret['args'].encode("hex"))
-        
-        self.sendAck(i,ret)
-
-def log(*args):
-    message = "%-16s " % args[0]
-    for arg in args[1:]:
-        message += arg.__str__() + " "
-    logmsg = time.asctime(time.localtime()) + ": " + message
-    print(logmsg)
-    logging.info(logmsg)
+            log("UNKNOWN MESSAGE: dest=%02x cmd=%02x args=%s", ret.dest, ret.cmd, Lazy(binascii.hexlify, ret.args))
+        self.prepare()
+
+def log(format, *args):
+    """Queue format % args for the log.  The formatting is left to the
+    log writer, so pass anything costly to work out as a Lazy."""
+    logs.put(format, args)
+
+
+class Lazy(object):
+    """A log argument worked out only when the record is written, as the
+    text of fn(*args).  args must not change in the meantime."""
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+class LogQueue(object):
+    """Log records waiting in memory for a background thread to format
+    them and write them out, so the bus thread never waits on stdout or
+    the disk.  Records that don't fit are dropped and counted."""
+
+    def __init__(self, size):
+        self.queue = Queue.Queue(size)  # (time, format, args)
+        self.dropped = 0
+
+    def put(self, format, args):
+        """Queue a record, or drop it if the queue is full."""
+        try:
+            self.queue.put_nowait((time.time(), format, args))
+        except Queue.Full:
+            self.dropped += 1
+
+    def start(self, filename, maxBytes, backups, echo):
+        """Write records from now on to filename, rotated at maxBytes,
+        and to stdout as well if echo."""
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=maxBytes,
+                                                       backupCount=backups)
+        writer = threading.Thread(target=self.run, args=(handler, echo))
+        writer.daemon = True
+        writer.start()
+
+    def run(self, handler, echo):
+        """Format and write records as they come, forever."""
+        dropped = 0
+        while True:
+            stamp, format, args = self.queue.get()
+            lines = []
+            if self.dropped != dropped:
+                lines.append("%d log records dropped" % (self.dropped - dropped))
+                dropped = self.dropped
+            try:
+                lines.append(args and format % args or format)
+            except (TypeError, ValueError), e:
+                lines.append("%s %r (%s)" % (format, args, e))
+            for line in lines:
+                line = time.asctime(time.localtime(stamp)) + ": " + line
+                if echo:
+                    print line
+                handler.emit(logging.makeLogRecord({'msg': line}))
+            self.queue.task_done()
+
+    def drain(self):
+        """Wait for everything queued so far to be written."""
+        self.queue.join()
+
+    def metrics(self):
+        """Return the queue depth and drops in Prometheus text format."""
+        ret = promHeader("aquaweb_log_queue_depth", "gauge", "Log records waiting to be written.")
+        ret += "aquaweb_log_queue_depth %d\n" % self.queue.qsize()
+        ret += promHeader("aquaweb_log_dropped_total", "counter", "Log records dropped, the queue being full.")
+        return ret + "aquaweb_log_dropped_total %d\n" % self.dropped
+
+logs = LogQueue(LOGQUEUE)
+
+def latin1(obj):
+    """Turn the text in something read back from JSON into the screen
+    bytes it was written from."""
+    if isinstance(obj, unicode):
+        return obj.encode("latin-1")
+    if isinstance(obj, dict):
+        return dict((latin1(key), latin1(value)) for key, value in obj.items())
+    return obj
+
+def logStatus(change):
+    """Log a change in the equipment status, as a Screen listener."""
+    log("status: %s %s -> %s", change.name, change.old, change.new)
+
+def frameText(frame):
+    """Describe a frame, dest to checksum, for the log."""
+    cmd = ord(frame[1])
+    args = frame[2:-1]
+    if cmd == 0x04:
+        ascii_args = " msg='" + filter(lambda x: x in string.printable, args) + "'"
+    else:
+        ascii_args = ""
+    return "cmd=%02x args=%s%s" % (cmd, args.encode("hex"), ascii_args)
+
+def checksum(msg):
+    """ Compute the checksum of a string of bytes."""
+    return chr(sum(bytearray(msg)) & 0xff)
+
+def buildMsg(dest, cmd, args):
+    """ Frame a message for the wire: DLE STX, checksum, DLE ETX, and a NUL
+    stuffed after every \x10 in between."""
+    msg = DLE + STX + dest + cmd + args
+    msg = msg + checksum(msg)
+    return DLE + STX + msg[2:].replace(DLE, DLE + NUL) + DLE + ETX
+
+def ackFrames(ackType, keycodes):
+    """ Build the complete on-the-wire ACK for every keycode we can send
+    (and 0, no key), so answering the controller is a single write."""
+    acks = {}
+    for keycode in [0] + list(keycodes):
+        acks[keycode] = buildMsg(chr(0), chr(1), chr(ackType) + chr(keycode))
+    return acks
+
+class Frame(object):
+    """One validated message off the bus.  dest and cmd are ints, args is
+    a read-only memoryview of the argument bytes."""
+    __slots__ = ('dest', 'cmd', 'args', 'stamp')
+
+    def __init__(self, dest, cmd, args, stamp=0.0):
+        self.dest = dest
+        self.cmd = cmd
+        self.args = args
+        self.stamp = stamp  # time the read holding its DLE ETX returned
+
+    def arg(self, n):
+        """Return argument byte n as an int, or 0 if the message was short."""
+        if n < len(self.args):
+            return ord(self.args[n])
+        return 0
+
+def promHeader(name, kind, text):
+    """The HELP and TYPE lines that start a Prometheus metric."""
+    return "# HELP %s %s\n# TYPE %s %s\n" % (name, text, name, kind)
+
+
+# What readers see of the screen.  A new one replaces it on every change and
+# it is never modified, so readers take a reference to it without locking.
+Snapshot = collections.namedtuple('Snapshot', 'cells attrs status version')
+
+# One of the Screen.FIELDS parsed from the screen taking a new value
+StatusChange = collections.namedtuple('StatusChange', 'name old new')
+
+
+class Histogram(object):
+    """Counts of timings in fixed buckets, cheap enough to bump every frame."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds  # upper bucket edges in seconds, ascending
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Record one timing, in seconds."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def text(self):
+        """Return the buckets as a small plain-text table."""
+        ret = "count %d" % self.count
+        if self.count:
+            ret += "  avg %.1fms  max %.1fms" % (1000 * self.sum / self.count, 1000 * self.max)
+        ret += "\n"
+        for bound, count in zip(self.bounds, self.counts):
+            ret += "<= %6.1fms: %d\n" % (1000 * bound, count)
+        ret += ">  %6.1fms: %d\n" % (1000 * self.bounds[-1], self.counts[-1])
+        return ret
+
+    def prometheus(self, name):
+        """Return the buckets in Prometheus text format, which wants them
+        cumulative."""
+        ret = ""
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            ret += '%s_bucket{le="%g"} %d\n' % (name, bound, total)
+        ret += '%s_bucket{le="+Inf"} %d\n' % (name, self.count)
+        return ret + "%s_sum %f\n%s_count %d\n" % (name, self.sum, name, self.count)
+
+class MacroTimes(object):
+    """How each macro turned out, and the time and keys its recent
+    successful runs took."""
+
+    def __init__(self, size):
+        self.size = size
+        self.counts = collections.defaultdict(int)  # (macro, outcome) -> runs
+        self.runs = {}  # macro -> deque of (seconds, keys)
+
+    def add(self, name, outcome, seconds, keys):
+        """Record one run of macro name."""
+        self.counts[(name, outcome)] += 1
+        if outcome == "done":
+            self.runs.setdefault(name, collections.deque(maxlen=self.size)).append((seconds, keys))
+
+    def medians(self, name):
+        """The median seconds and keys of the recent runs of macro name."""
+        runs = list(self.runs[name])
+        middle = len(runs) / 2
+        return sorted(runs)[middle][0], sorted(keys for seconds, keys in runs)[middle]
+
+    def prometheus(self):
+        """Return the counts and medians in Prometheus text format."""
+        ret = promHeader("aquaweb_macros_total", "counter", "Macros run, by how they ended.")
+        for (name, outcome), count in sorted(self.counts.items()):
+            ret += 'aquaweb_macros_total{macro="%s",outcome="%s"} %d\n' % (name, outcome, count)
+        ret += promHeader("aquaweb_macro_seconds", "summary",
+                          "Time from pressing a macro to its last select, recent runs.")
+        steps = promHeader("aquaweb_macro_keys", "summary", "Keys a macro sent, recent runs.")
+        for name in sorted(self.runs):
+            seconds, keys = self.medians(name)
+            ret += 'aquaweb_macro_seconds{macro="%s",quantile="0.5"} %f\n' % (name, seconds)
+            steps += 'aquaweb_macro_keys{macro="%s",quantile="0.5"} %d\n' % (name, keys)
+        return ret + steps
+
+
+class Series(object):
+    """One metric's samples in a ring, rolled up as they arrive into
+    [start, min, max, sum, count, watt hours] rows per minute and per
+    hour, themselves in rings, so memory never grows."""
+
+    def __init__(self, energy):
+        self.energy = energy  # the metric is in watts, rollups total up watt hours
+        self.samples = collections.deque(maxlen=SAMPLES)  # (time, value)
+        self.rollups = {'minute': (60, collections.deque(maxlen=MINUTES)),
+                        'hour': (3600, collections.deque(maxlen=HOURS))}
+
+    def add(self, now, value, period):
+        """Record value at time now, held for period seconds."""
+        self.samples.append((now, value))
+        wh = self.energy and value * period / 3600.0 or 0.0
+        for size, rows in self.rollups.values():
+            start = int(now) - int(now) % size
+            if rows and rows[-1][0] == start:
+                row = rows[-1]
+                row[1] = min(row[1], value)
+                row[2] = max(row[2], value)
+                row[3] += value
+                row[4] += 1
+                row[5] += wh
+            else:
+                rows.append([start, value, value, value, 1, wh])
+
+    def resolution(self, since):
+        """The finest resolution still holding everything from since on."""
+        if len(self.samples) < SAMPLES or self.samples[0][0] <= since:
+            return 'raw'
+        rows = self.rollups['minute'][1]
+        if len(rows) < MINUTES or rows[0][0] <= since:
+            return 'minute'
+        return 'hour'
+
+    def points(self, since, resolution):
+        """The columns and points from since on at resolution."""
+        if resolution == 'raw':
+            return ['time', 'value'], [[t, value] for t, value in self.samples if t >= since]
+        size, rows = self.rollups[resolution]
+        columns = ['time', 'min', 'max', 'avg']
+        points = []
+        for start, lo, hi, total, count, wh in rows:
+            if start + size > since:
+                points.append([start, lo, hi, total / count])
+                if self.energy:
+                    points[-1].append(wh)
+        if self.energy:
+            columns.append('wh')
+        return columns, points
+
+
+class History(object):
+    """Recent values of a device's metrics, a Series each."""
+
+    def __init__(self, energy=()):
+        self.series = {}
+        self.energy = energy  # names of the metrics in watts
+        self.lock = threading.Lock()
+
+    def record(self, values):
+        """Add a sample of each metric in the values dict, bar any None."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            for name, value in values.items():
+                if value is None:
+                    continue
+                if name not in self.series:
+                    self.series[name] = Series(name in self.energy)
+                self.series[name].add(now, float(value), SAMPLEPERIOD)
+        finally:
+            self.lock.release()
+
+    def query(self, metric, since, resolution=None):
+        """The JSON for /history: metric from time since on, raw if the
+        samples reach back that far, else in minute or hour rollups.
+        The list of metrics if metric is None, None if there's no such
+        metric."""
+        self.lock.acquire()
+        try:
+            if metric is None:
+                return json.dumps({'metrics': sorted(self.series)})
+            series = self.series.get(metric)
+            if series is None:
+                return None
+            resolution = resolution or series.resolution(since)
+            columns, points = series.points(since, resolution)
+        finally:
+            self.lock.release()
+        return json.dumps({'metric': metric, 'resolution': resolution,
+                           'columns': columns, 'points': points})
+
+
+class KeyQueue(object):
+    """Key presses waiting to go out, one per ACK, oldest first."""
+
+    def __init__(self, size, repeat):
+        self.size = size      # most presses we'll hold
+        self.repeat = repeat  # "keep", "collapse" or "reject" repeats of the last key
+        self.keys = collections.deque()
+        self.lock = threading.Lock()
+
+    def put(self, code):
+        """Queue a key code.  Return False if it was refused."""
+        self.lock.acquire()
+        try:
+            if self.keys and self.keys[-1] == code and self.repeat != "keep":
+                return self.repeat == "collapse"
+            if len(self.keys) >= self.size:
+                return False
+            self.keys.append(code)
+            return True
+        finally:
+            self.lock.release()
+
+    def get(self):
+        """Take the oldest key code, or 0 (no key) if there are none."""
+        self.lock.acquire()
+        try:
+            if self.keys:
+                return self.keys.popleft()
+            return 0
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class CaptureQueue(object):
+    """Capture records waiting for a background thread to append them to
+    the capture file, so the bus thread never waits on the disk.  Records
+    that don't fit are dropped and counted."""
+
+    def __init__(self, filename, size):
+        self.file = open(filename, 'ab')
+        self.queue = Queue.Queue(size)  # packed records, None to finish
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def put(self, direction, data):
+        """Queue a record stamped now, or drop it if the queue is full."""
+        try:
+            self.queue.put_nowait(CAPHEAD.pack(time.time(), direction, len(data)) + data)
+        except Queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        """Write records as they come, flushing whenever it catches up,
+        until close()."""
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.file.write(record)
+            if self.queue.empty():
+                self.file.flush()
+        self.file.close()
+
+    def close(self):
+        """Write out what's queued and close the file."""
+        self.queue.put(None)
+        self.writer.join()
+
+    def metrics(self):
+        """Return the records dropped in Prometheus text format."""
+        ret = promHeader("aquaweb_capture_dropped_total", "counter",
+                         "Capture records dropped, the queue being full.")
+        return ret + "aquaweb_capture_dropped_total %d\n" % self.dropped
+
+
+class ReplayPort(object):
+    """Stands in for the serial port, feeding the received bytes from a
+    capture file at the recorded pace divided by speed, or flat out if
+    speed is 0.  Raises EOFError once the capture runs out."""
+
+    def __init__(self, name, speed):
+        self.file = open(name, 'rb')
+        self.speed = speed
+        self.pending = ""   # received bytes that are due but not read yet
+        self.due = None     # (stamp, data) of the next received record
+        self.start = None   # (wall time, capture stamp) of the first record
+        self.bytes = 0
+
+    def _next(self):
+        """Load the next received record, skipping what we sent."""
+        while self.due is None:
+            head = self.file.read(CAPHEAD.size)
+            if len(head) < CAPHEAD.size:
+                raise EOFError
+            stamp, direction, length = CAPHEAD.unpack(head)
+            data = self.file.read(length)
+            if direction == CAPRX:
+                if self.start is None:
+                    self.start = (time.time(), stamp)
+                self.due = (stamp, data)
+
+    def _delay(self):
+        """Seconds until the next record is due."""
+        if not self.speed:
+            return 0
+        wall, first = self.start
+        return wall + (self.due[0] - first) / self.speed - time.time()
+
+    def _take(self):
+        self.pending = self.due[1]
+        self.due = None
+
+    def inWaiting(self):
+        if not self.pending:
+            self._next()
+            if self._delay() <= 0:
+                self._take()
+        return len(self.pending)
+
+    def read(self, size=1):
+        """Read up to size bytes, or the whole of the next record if it
+        has to wait for it, as the port's buffer would hold by the time it
+        came in, so records come back as they were captured."""
+        if not self.pending:
+            self._next()
+            delay = self._delay()
+            if delay > 0:
+                time.sleep(delay)
+            self._take()
+            size = max(size, len(self.pending))
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.bytes += len(data)
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def summary(self):
+        """One line on how much was replayed and how long it took."""
+        elapsed = time.time() - self.start[0] if self.start else 0.0
+        return "replayed %d bytes in %.2fs" % (self.bytes, elapsed)
+
+
+class Pipeline(object):
+    """Applies frames to the devices in a thread of its own, so the bus
+    reader only frames, validates and ACKs, and a render holding a
+    device's lock can't make an ACK late."""
+
+    def __init__(self):
+        self.queue = Queue.Queue(PIPEQUEUE)
+        self.waits = Histogram(ACKBUCKETS)    # frame read to update started
+        self.updates = Histogram(ACKBUCKETS)  # time in processMessage
+        self.maxDepth = 0
+        self.inline = 0    # frames applied by the reader, the queue being full
+        self.failures = 0  # frames processMessage raised on
+        updater = threading.Thread(target=self.run)
+        updater.daemon = True
+        updater.start()
+
+    def put(self, device, frame):
+        """Queue a frame for device.processMessage().  If the updater is
+        that far behind, catch it up and apply the frame here instead, so
+        the queue can't grow without end and frames still go in order."""
+        try:
+            self.queue.put_nowait((device, frame))
+        except Queue.Full:
+            self.inline += 1
+            self.drain()
+            self.apply(device, frame)
+            return
+        depth = self.queue.qsize()
+        if depth > self.maxDepth:
+            self.maxDepth = depth
+
+    def drain(self):
+        """Wait until every queued frame has been applied."""
+        self.queue.join()
+
+    def run(self):
+        """The updater thread."""
+        while True:
+            device, frame = self.queue.get()
+            try:
+                self.apply(device, frame)
+            finally:
+                self.queue.task_done()
+
+    def apply(self, device, frame):
+        """Apply one frame, timing it.  A frame that raises is logged and
+        skipped rather than taking the updater down with it."""
+        start = time.time()
+        self.waits.add(start - frame.stamp)
+        try:
+            device.processMessage(frame)
+        except Exception:
+            self.failures += 1
+            log("pipeline: %02x %02x %s failed\n%s", frame.dest, frame.cmd,
+                Lazy(binascii.hexlify, frame.args.tobytes()), traceback.format_exc())
+        self.updates.add(time.time() - start)
+
+    def metrics(self):
+        """Return the queue depth and stage timings in Prometheus text format."""
+        ret = promHeader("aquaweb_queue_depth", "gauge", "Frames waiting for the updater.")
+        ret += "aquaweb_queue_depth %d\n" % self.queue.qsize()
+        ret += promHeader("aquaweb_queue_depth_max", "gauge", "Most frames ever waiting for the updater.")
+        ret += "aquaweb_queue_depth_max %d\n" % self.maxDepth
+        ret += promHeader("aquaweb_queue_wait_seconds", "histogram",
+                          "Time from reading the end of a frame to the updater starting on it.")
+        ret += self.waits.prometheus("aquaweb_queue_wait_seconds")
+        ret += promHeader("aquaweb_queue_inline_total", "counter",
+                          "Frames applied by the reader, the queue being full.")
+        ret += "aquaweb_queue_inline_total %d\n" % self.inline
+        ret += promHeader("aquaweb_update_failures_total", "counter",
+                          "Frames the updater couldn't apply.")
+        ret += "aquaweb_update_failures_total %d\n" % self.failures
+        ret += promHeader("aquaweb_update_seconds", "histogram",
+                          "Time the updater spends applying a frame.")
+        ret += self.updates.prometheus("aquaweb_update_seconds")
+        return ret
+
 
 class Interface(object):
     """ Aqualink serial interface """
+    typicalAck = buildMsg(chr(0), chr(1), "\x40\x00")
 
     def __init__(self, theName):
         """Initialization.
-        Open the serial port and find the start of a message."""
+        Open the serial port, the decoder will find the start of a message."""
         self.name = theName
         self._open()
-        self.msg = "\x00\x00"
-        # skip bytes until synchronized with the start of a message
-        while (self.msg[-1] != STX) or (self.msg[-2] != DLE):
-            self.msg += self.port.read(1)
-        self.msg = self.msg[-2:]
+        self.state = HUNT              # receive decoder state
+        self.frame = bytearray()       # frame being decoded, reused
+        self.frames = collections.deque()  # decoded frames not yet returned
+        self.stamp = 0.0               # when the last read returned
+        self.ackTimes = Histogram(ACKBUCKETS)  # ETX to ACK written
+        self.counts = collections.defaultdict(int)  # good frames by (dest, cmd)
+        self.badChecksums = 0
+        self.resyncs = 0       # frames given up on part way through
+        self.reopens = 0       # attempts to reopen the serial port
+        self.pipeline = None   # Pipeline applying our frames, if any
+        self.capture = None
+        if captureFile:
+            self.capture = CaptureQueue(captureFile, CAPQUEUE)
 
     def _open(self):
         """Try and connect to the serial port, if it exists.  If not, then
         add a small delay to avoid CPU hogging"""
+        if replayFile:
+            self.port = ReplayPort(replayFile, replaySpeed)
+            return
         try:
             if not os.path.exists(RS485Device):
                 time.sleep(1)
@@ -566,112 +2130,193 @@ class Interface(object):
         except:
             self.port = None
          
-        
+    def _read(self):
+        """Read everything the port has buffered in one go, blocking for at
+        most the port timeout if nothing is waiting yet."""
+        try:
+            data = self.port.read(max(1, self.port.inWaiting()))
+        except serial.SerialException:
+            self.reopens += 1
+            self._open()
+            return ""
+        self.stamp = time.time()
+        if self.capture and data:
+            self._capture(CAPRX, data)
+        return data
+
+    def _decode(self, data):
+        """Run received bytes through the DLE/STX/ETX state machine.
+        Stuffed DLE-NULs are dropped, and every complete frame is queued
+        on self.frames.  Garbage resyncs to the next DLE STX."""
+        state = self.state
+        frame = self.frame
+        for byte in bytearray(data):
+            if state == BODY:
+                if byte == 0x10:
+                    state = BODY_DLE
+                elif len(frame) < MAXFRAME:
+                    frame.append(byte)
+                else:  # runaway frame, we missed the DLE ETX
+                    self.resyncs += 1
+                    state = HUNT
+            elif state == BODY_DLE:
+                if byte == 0x00:  # DLE NUL is a stuffed \x10 data byte
+                    frame.append(0x10)
+                    state = BODY
+                elif byte == 0x03:  # DLE ETX ends the frame
+                    self._frameDone()
+                    state = HUNT
+                elif byte == 0x02:  # DLE STX, lost the end of the last one
+                    self.resyncs += 1
+                    del frame[:]
+                    state = BODY
+                elif byte == 0x10:
+                    self.resyncs += 1
+                    state = HUNT_DLE
+                else:
+                    self.resyncs += 1
+                    state = HUNT
+            elif byte == 0x10:
+                state = HUNT_DLE
+            elif state == HUNT_DLE and byte == 0x02:
+                del frame[:]
+                state = BODY
+            else:
+                state = HUNT
+        self.state = state
+
+    def _frameDone(self):
+        """Validate the just-completed frame and queue it if it's good."""
+        frame = self.frame
+        if len(frame) < 3:
+            self.resyncs += 1
+            return
+        dest = frame[0]
+        cmd = frame[1]
+        checksum = frame[-1]
+        # only pass on messages with a valid checksum, DLE STX adds 0x12
+        if (sum(frame) - checksum + 0x12) & 0xff == checksum:
+            self.counts[(dest, cmd)] += 1
+            if debugData and cmd > 0x02 and dest == 0x60: # only log coms from master and PDA
+                log("IN %s", Lazy(frameText, str(frame)))
+            # frame gets reused, so args views one immutable copy of it
+            self.frames.append(Frame(dest, cmd, memoryview(str(frame))[2:-1], self.stamp))
+        else:
+            self.badChecksums += 1
+            log("IN %s *** bad checksum ***", Lazy(frameText, str(frame)))
+
     def readMsg(self):
         """ Read the next valid message from the serial port.
         Parses and returns the destination address, command, and arguments as a 
-        tuple."""
-        if (self.port == None):
-            self._open()  # Try and re-open port
-        if (self.port == None):  # We failed, return garbage
-            return {'dest':"ff", 'cmd':"ff", 'args':""}
-
-        while True:                                         
-            dleFound = False
-            # read what is probably the DLE STX
-            try:
-                self.msg += self.port.read(2)
-            except serial.SerialException:
-                self.msg += chr(0) + chr(0)
-                self._open()
-            while len(self.msg) < 2:
-                self.msg += chr(0)
-            while (self.msg[-1] != ETX) or (not dleFound) or (len(self.msg)>128):  
-                # read until DLE ETX
-                try:
-                    if (self.port == None):
-                        return {'dest':"ff", 'cmd':"ff", 'args':""}
-                    self.msg += self.port.read(1)
-                except serial.SerialException:
-                    self.msg += chr(0)
-                    self._open()
-                if self.msg[-1] == DLE:                     
-                    # \x10 read, tentatively is a DLE
-                    dleFound = True
-                if (self.msg[-2] == DLE) and (self.msg[-1] == NUL) and dleFound: 
-                    # skip a NUL following a DLE
-                    self.msg = self.msg[:-1]
-                    # it wasn't a DLE after all
-                    dleFound = False                        
-            # skip any NULs between messages
-            self.msg = self.msg.lstrip('\x00')
-            # parse the elements of the message              
-            dlestx = self.msg[0:2]
-            dest = self.msg[2:3]
-            cmd = self.msg[3:4]
-            args = self.msg[4:-3]
-            if cmd.encode("hex") == "04": 
-                ascii_args = " msg='" + filter(lambda x: x in string.printable, args) + "'"
-            else: 
-                ascii_args = ""
-            checksum = self.msg[-3:-2]
-            dleetx = self.msg[-2:]
-            self.msg = ""
-            debugMsg = "IN cmd="+cmd.encode("hex")+" args="+args.encode("hex")+ascii_args
-            # stop reading if a message with a valid checksum is read
-            if self.checksum(dlestx+dest+cmd+args) == checksum:
-                if debugData:
-                    if cmd.encode("hex") != "00" \
-                    and cmd.encode("hex") != "01" \
-                    and cmd.encode("hex") != "02" \
-                    and dest.encode("hex") == "60": # only log coms from master and PDA
-                        log(debugMsg)
-                if args == None:
-                    args = ""
-                return {'dest':dest.encode("hex"), 'cmd':cmd.encode("hex"), 'args':args}
-            else:
-                log(debugMsg, "*** bad checksum ***")
+        Frame.  A single read may complete several messages, the extras are
+        returned by the following calls without touching the port."""
+        while not self.frames:
+            if (self.port == None):
+                self.reopens += 1
+                self._open()  # Try and re-open port
+            if (self.port == None):  # We failed, return garbage
+                return Frame(0xff, 0xff, memoryview(""))
+            self._decode(self._read())
+        return self.frames.popleft()
 
     def sendMsg(self, (dest, cmd, args)):
         """ Send a message.
         The destination address, command, and arguments are specified as a tuple."""
-        msg = DLE + STX + dest + cmd + args
-        msg = msg + self.checksum(msg) + DLE + ETX
-        
+        self.sendRaw(buildMsg(dest, cmd, args))
+
+    def sendRaw(self, msg):
+        """ Send an already framed and stuffed message, such as a cached ACK."""
         if debugData:
-            if args.encode("hex") != "4000": # don't log typical ACKs
-                debugMsg = "OUT cmd="+cmd.encode("hex")+" args="+args.encode("hex")
-                log(debugMsg)
-
-        for i in range(2, len(msg) - 2):                       
-            # if a byte in the message has the value \x10 insert a NUL after it
-            if msg[i] == DLE:
-                msg = msg[0:i+1]+NUL+msg[i+1:]
+            if msg != self.typicalAck: # don't log typical ACKs
+                log("OUT %s", Lazy(binascii.hexlify, msg))
         n = self.port.write(msg)
+        if self.capture:
+            self._capture(CAPTX, msg)
+
+    def metrics(self):
+        """Return the bus counters and ACK latency in Prometheus text format."""
+        ret = promHeader("aquaweb_frames_total", "counter",
+                         "Good frames received, by destination and command.")
+        for (dest, cmd), count in sorted(self.counts.items()):
+            ret += 'aquaweb_frames_total{dest="%02x",cmd="%02x"} %d\n' % (dest, cmd, count)
+        for name, text, count in (
+                ("aquaweb_bad_checksums_total", "Frames dropped for a bad checksum.", self.badChecksums),
+                ("aquaweb_resyncs_total", "Frames given up on part way through.", self.resyncs),
+                ("aquaweb_serial_reopens_total", "Attempts to reopen the serial port.", self.reopens)):
+            ret += promHeader(name, "counter", text) + "%s %d\n" % (name, count)
+        ret += promHeader("aquaweb_ack_seconds", "histogram",
+                          "Time from reading the end of a frame to writing our ACK.")
+        ret += self.ackTimes.prometheus("aquaweb_ack_seconds")
+        if self.pipeline:
+            ret += self.pipeline.metrics()
+        if self.capture:
+            ret += self.capture.metrics()
+        return ret
+
+    def sendAck(self, frame, msg):
+        """ Send a prebuilt ACK in reply to frame, timing it from the frame's ETX."""
+        self.sendRaw(msg)
+        self.ackTimes.add(time.time() - frame.stamp)
+
+    def _capture(self, direction, data):
+        """Queue one record for the capture file."""
+        self.capture.put(direction, data)
+
+    def close(self):
+        """Finish writing the capture file, if any, on the way out."""
+        if self.capture:
+            self.capture.close()
+            self.capture = None
 
     def checksum(self, msg):
         """ Compute the checksum of a string of bytes."""                
-        return struct.pack("!B", reduce(lambda x, y:x+y, map(ord, msg)) % 256)
+        return checksum(msg)
 
 
 def main():
     """Start the listener for a screen, run webserver."""
+    logs.start(LOGFILE, LOGBYTES, LOGBACKUPS, LOGECHO)
     log("Creating screen emulator")
     screen = Screen()
+    screen.listeners.append(logStatus)
+    if screen.loadMenus(MENUFILE):
+        log("Loaded menus from %s", MENUFILE)
     log("Creating RS485 port")
     i = Interface("RS485")
+    if pipelined:
+        i.pipeline = Pipeline()
     log("Creating web server")
-    server = threading.Thread(target=startServer, args=(screen,))
+    server = threading.Thread(target=startServer, args=(screen, i))
+    server.daemon = bool(replayFile)  # don't outlive the replay
     server.start()
 
-    while True:
-        ret = i.readMsg()
-        if 'stop' in ret:
-            global webServer
-            webServer.shutdown()
-            return
-        if ret['dest'] == ID:
-            screen.processMessage(ret, i)
+    try:
+        while True:
+            try:
+                ret = i.readMsg()
+            except EOFError:
+                if i.pipeline:
+                    i.pipeline.drain()
+                log("Replay finished, %s", i.port.summary())
+                log("%s", i.ackTimes.text())
+                logs.drain()
+                return
+            if ret.dest == ID:
+                if i.pipeline:
+                    if screen.macro or ret.cmd == 0x02 and (menuGraph or menuCrawl):
+                        # macros, the crawl and learn() go by what's on the screen
+                        i.pipeline.drain()
+                    screen.sendAck(i, ret)
+                    i.pipeline.put(screen, ret)
+                elif fastAck:
+                    # Answer first so rendering or logging can't make us late
+                    screen.sendAck(i, ret)
+                    screen.processMessage(ret)
+                else:
+                    screen.processMessage(ret)
+                    screen.sendAck(i, ret)
+    finally:
+        i.close()
 
 
 if __name__ == "__main__":
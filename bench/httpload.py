@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Load test the aquaweb web server.
+
+Starts a number of simulated viewers, each polling one CGI over its own
+persistent connection as fast as the server will answer, and reports
+requests/second and latency percentiles.
+
+    python bench/httpload.py [host:port] [clients] [seconds] [path]
+
+Defaults to localhost:80, 16 clients, 10 seconds, /screen.cgi.
+"""
+
+import sys
+import time
+import threading
+import httplib
+
+
+def client(host, path, deadline, times, errors):
+    """Poll path until deadline, appending each request's latency to times."""
+    conn = httplib.HTTPConnection(host, timeout=10)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            conn.request('POST', path, '', headers)
+            resp = conn.getresponse()
+            resp.read()
+        except Exception:
+            errors.append(1)
+            conn.close()
+            conn = httplib.HTTPConnection(host, timeout=10)
+            continue
+        times.append(time.time() - start)
+    conn.close()
+
+
+def percentile(times, pct):
+    """Return the pct'th percentile of an already sorted list."""
+    if not times:
+        return 0.0
+    return times[min(len(times) - 1, int(len(times) * pct / 100.0))]
+
+
+def main():
+    """Run the clients and print the summary."""
+    host = len(sys.argv) > 1 and sys.argv[1] or "localhost:80"
+    clients = len(sys.argv) > 2 and int(sys.argv[2]) or 16
+    seconds = len(sys.argv) > 3 and float(sys.argv[3]) or 10.0
+    path = len(sys.argv) > 4 and sys.argv[4] or "/screen.cgi"
+
+    times = []
+    errors = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=client, args=(host, path, deadline, times, errors))
+               for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    times.sort()
+    print "%s %s, %d clients, %.0fs" % (host, path, clients, seconds)
+    print "requests %d  errors %d  req/s %.1f" % (len(times), len(errors), len(times) / seconds)
+    print "latency p50 %.1fms  p90 %.1fms  p99 %.1fms  max %.1fms" % (
+        1000 * percentile(times, 50), 1000 * percentile(times, 90),
+        1000 * percentile(times, 99), 1000 * (times and times[-1] or 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Microbenchmarks for the protocol and render hot paths.
+
+Loads aquaweb.py and aquawebpda-v2.py as modules and times frame
+decoding, checksums, message stuffing, each Screen command, the HTML
+render, the Spa updates and the PDA status parser and macro ACK, with
+no serial hardware: the Interface reads a synthetic capture through the
+replay port.
+
+    python bench/microbench.py [output.json] [baseline.json]
+
+Prints microseconds per operation and operations per second, and writes
+them to output.json (default microbench.json).  Given a baseline from an
+earlier run, also prints how each result compares to it.
+"""
+
+import sys
+import os
+import imp
+import time
+import json
+import tempfile
+import platform
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MINTIME = 0.2   # seconds each timing run lasts at least
+REPEAT = 5      # timing runs per benchmark, the fastest is kept
+FRAMES = 20000  # frames in the synthetic decode stream
+
+
+def load(name, filename):
+    """Load one of the scripts as a module without running main()."""
+    return imp.load_source(name, os.path.join(HERE, "..", filename))
+
+
+def timeit(fn):
+    """Return seconds per call of fn, the best of REPEAT runs each lasting
+    at least MINTIME."""
+    number = 1
+    while True:
+        start = time.time()
+        for n in xrange(number):
+            fn()
+        elapsed = time.time() - start
+        if elapsed >= MINTIME:
+            break
+        number *= 2
+    best = elapsed / number
+    for run in range(REPEAT - 1):
+        start = time.time()
+        for n in xrange(number):
+            fn()
+        best = min(best, (time.time() - start) / number)
+    return best
+
+
+def capture(m, frames):
+    """Write frames as a capture file for the replay port, return its name."""
+    data = "".join(frames)
+    fd, name = tempfile.mkstemp(suffix=".cap")
+    f = os.fdopen(fd, 'wb')
+    for start in range(0, len(data), 4096):
+        chunk = data[start:start + 4096]
+        f.write(m.CAPHEAD.pack(0.0, m.CAPRX, len(chunk)) + chunk)
+    f.close()
+    return name
+
+
+def interface(m, frames):
+    """An Interface that reads frames from a replay and writes nowhere."""
+    m.replayFile = capture(m, frames)
+    m.replaySpeed = 0
+    try:
+        return m.Interface("bench")
+    finally:
+        os.unlink(m.replayFile)
+        m.replayFile = None
+
+
+def frame(m, dest, cmd, args):
+    """A decoded Frame, as readMsg would return it."""
+    return m.Frame(dest, cmd, memoryview(args), 0.0)
+
+
+def decodeBench(m, dest):
+    """Frames/second through readMsg on a stream of screen traffic."""
+    stream = [m.buildMsg(chr(dest), "\x04", "\x03POOL MODE   ON\x00"),
+              m.buildMsg(chr(dest), "\x02", "\x00\x00\x00\x00\x00"),
+              m.buildMsg(chr(dest), "\x10", "\x02\x00\x10"),  # needs stuffing
+              m.buildMsg(chr(dest + 1), "\x00", "")]
+    frames = (stream * (FRAMES / len(stream)))[:FRAMES]
+    i = interface(m, frames)
+    start = time.time()
+    for n in xrange(FRAMES):
+        i.readMsg()
+    return (time.time() - start) / FRAMES
+
+
+def record(name, seconds, results):
+    """Record and print seconds per operation."""
+    results[name] = {'us_per_op': 1e6 * seconds, 'ops_per_sec': 1.0 / seconds}
+    print "%-32s %10.2fus %12.0f/s" % (name, 1e6 * seconds, 1.0 / seconds)
+
+
+def run(name, fn, results):
+    """Time fn and record the result."""
+    record(name, timeit(fn), results)
+
+
+def alternate(screen, frames):
+    """A call that feeds screen the next of frames each time round.  The
+    same frame twice is mostly a no-op, the second one changing nothing, so
+    each command takes turns with one that undoes it."""
+    def fn():
+        frames.reverse()
+        screen.processMessage(frames[0])
+    return fn
+
+
+def benchAquaweb(results):
+    """The square remote and spa emulator."""
+    m = load("aquaweb", "aquaweb.py")
+    record("aquaweb.decode", decodeBench(m, m.ID), results)
+    msg = m.DLE + m.STX + "\x40\x04\x03POOL MODE   ON\x00"
+    run("aquaweb.checksum", lambda: m.checksum(msg), results)
+    i = interface(m, [])
+    run("aquaweb.sendMsg", lambda: i.sendMsg(("\x00", "\x01", "\x8b\x10")), results)
+
+    screen = m.Screen()
+    commands = [("cls", [(0x09, "\x00"), (0x04, "\x03POOL MODE   ON\x00")]),
+                ("scroll", [(0x0f, "\x01\x0a\xff"), (0x04, "\x0aPOOL MODE   ON\x00")]),
+                ("writeline", [(0x04, "\x03POOL MODE   ON\x00"), (0x04, "\x03POOL MODE  OFF\x00")]),
+                ("handshake", [(0x05, "")]),
+                ("probe", [(0x00, "")]),
+                ("status", [(0x02, "\x00\x00\x00\x00\x00"), (0x02, "\x00\x01\x00\x00\x00")]),
+                ("invertline", [(0x08, "\x02"), (0x08, "\x03")]),
+                ("invertchars", [(0x10, "\x02\x00\x03"), (0x10, "\x02\x04\x07")])]
+    for name, pairs in commands:
+        frames = [frame(m, m.ID, cmd, args) for cmd, args in pairs]
+        run("aquaweb.screen." + name, alternate(screen, frames), results)
+    run("aquaweb.screen.html", screen.html, results)
+    flip = [frame(m, m.ID, 0x04, "\x03POOL MODE   ON\x00"),
+            frame(m, m.ID, 0x04, "\x03POOL MODE  OFF\x00")]
+
+    def changed():
+        flip.reverse()
+        screen.processMessage(flip[0])
+        screen.html()
+    run("aquaweb.screen.html.changed", changed, results)
+
+    spa = m.Spa()
+    texts = [memoryview("\x00101 \x00 !  "), memoryview("\x00102 \x00 !  ")]
+
+    def update():
+        texts.reverse()
+        spa.update(texts[0])
+    run("aquaweb.spa.update", update, results)
+    bits = [memoryview("\x11"), memoryview("\x19")]
+
+    def status():
+        bits.reverse()
+        spa.setStatus(bits[0])
+    run("aquaweb.spa.setStatus", status, results)
+
+
+def benchPda(results):
+    """The PDA emulator."""
+    m = load("aquawebpda", "aquawebpda-v2.py")
+    record("pda.decode", decodeBench(m, m.ID), results)
+    screen = m.Screen()
+    lines = [["POOL MODE     ON", "SPA HEATER   ENA", "  72`   80`", "    RPM: 2750",
+              "    WATTS: 1083", "EQUIPMENT"],
+             ["POOL MODE    OFF", "SPA HEATER   OFF", "  73`   81`", "    RPM: 1800",
+              "    WATTS: 412", "EQUIPMENT"]]
+
+    def status():
+        lines.reverse()
+        for text in lines[0]:
+            screen.updateStatus(text)
+    record("pda.updateStatus", timeit(status) / len(lines[0]), results)
+    flip = [frame(m, m.ID, 0x04, "\x03POOL MODE     ON\x00"),
+            frame(m, m.ID, 0x04, "\x03POOL MODE    OFF\x00")]
+    run("pda.screen.writeline", alternate(screen, flip), results)
+
+    i = interface(m, [])
+    for n, text in enumerate(["    MAIN MENU", "POOL MODE     ON", "POOL HEATER  OFF",
+                              "SPA MODE     OFF", "SPA HEATER   OFF", "EQUIPMENT", "",
+                              "", "", "^^ MORE"]):
+        screen.processMessage(frame(m, m.ID, 0x04, chr(n) + text + "\x00"))
+    screen.currentline = 1
+    poll = frame(m, m.ID, 0x02, "")
+
+    def macro():
+        screen.sendKey("cleaner")
+        screen.sendAck(i, poll)
+    run("pda.sendAck.macro", macro, results)
+
+
+def main():
+    """Run everything, save the results and compare to a baseline."""
+    output = len(sys.argv) > 1 and sys.argv[1] or "microbench.json"
+    baseline = len(sys.argv) > 2 and sys.argv[2] or None
+
+    results = {}
+    benchAquaweb(results)
+    benchPda(results)
+    json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+               'time': time.time(), 'results': results},
+              open(output, 'w'), indent=1, sort_keys=True)
+    print "saved", output
+
+    if baseline:
+        old = json.load(open(baseline))['results']
+        print
+        print "speedup over", baseline
+        for name in sorted(results):
+            if name in old:
+                print "%-32s %6.2fx" % (name, old[name]['us_per_op'] / results[name]['us_per_op'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Simulate the Jandy master on a pseudo-terminal.
+
+Opens a pty pair, links the slave side to a fixed path for aquaweb to
+use as its RS485Device, and plays the Aqualink controller as described
+in protocol.md: probes each remote until it answers, draws and updates
+menus on the square remote (40), runs a menu tree with scrolling lists,
+submenus and equipment to switch on the PDA (60), sends binary status
+and LCD text to the SpaLink (20), and re-sends any message whose ACK is
+late, dropping back to probing if a device stops answering.
+
+    python bench/simmaster.py [link] [seconds] [ids] [host:port]
+
+Defaults to /tmp/aquaweb-sim, 30 seconds and ids 40,20.  With host:port
+a viewer also presses keys through the web server and times each one
+until the simulator's reply to it shows up in /state.json, or on the
+PDA runs macros and times each until the equipment it's for switches.
+Run the emulator against it in another shell, e.g.
+
+    AQUAWEB_DEVICE=/tmp/aquaweb-sim AQUAWEB_PORT=8080 python aquaweb.py
+    python bench/simmaster.py /tmp/aquaweb-sim 30 40,20 localhost:8080
+
+or ids 60 with aquawebpda-v2.py.  Reports ACK latency, late ACKs,
+re-sends and key-to-screen times, or the time and keys each macro took.
+"""
+
+import sys
+import os
+import pty
+import tty
+import time
+import select
+import threading
+import httplib
+import json
+
+DLE = '\x10'
+STX = '\x02'
+ETX = '\x03'
+NUL = '\x00'
+
+ACKTIMEOUT = 0.1    # seconds before an ACK counts as late and we re-send
+RETRIES = 3         # re-sends before we decide a device has gone away
+GAP = 0.002         # seconds of bus idle between messages
+KEYTIMEOUT = 5.0    # seconds a viewer waits to see its key take effect
+MACROTIMEOUT = 30.0 # seconds a viewer waits for a macro to finish
+ABSENT = (0x41, 0x42, 0x43, 0x21, 0x22, 0x23)  # probed but never there
+
+MENU = ["    EQUIPMENT", "FILTER PUMP  OFF", "SPA          OFF", "POOL HEAT    OFF",
+        "SPA HEAT     OFF", "CLEANER      OFF", "POOL LIGHT   OFF", "SPA LIGHT    OFF",
+        "AUX5         OFF", "AUX6         OFF", "AUX7         OFF", "^^ MORE vv"]
+# The PDA's menus.  Items naming another menu open it, the rest switch
+# something on and off, bar ALL OFF which switches all of it off.
+PDAMENUS = {
+    "MAIN MENU": ["POOL MODE", "POOL HEATER", "SPA MODE", "SPA HEATER", "EQUIPMENT",
+                  "SYSTEM SETUP", "HELP", "SET TEMP", "SET TIME", "PDA OPTIONS"],
+    "EQUIPMENT": ["FILTER PUMP", "SPA", "POOL HEAT", "SPA HEAT", "CLEANER", "POOL LIGHT",
+                  "SPA LIGHT", "AIR BLOWER", "AUX5", "AUX6", "AUX7", "ALL OFF"],
+    "SYSTEM SETUP": ["LABEL AUX", "FREEZE PROT", "AIR TEMP", "DEGREES C/F",
+                     "TEMP CALIB", "SOLAR PRIOR", "PUMP LOCK", "ASSIGN JVAs",
+                     "SPA SWITCH", "SERVICE", "DIAGNOSTICS"],
+    "HELP": ["SERVICE MD", "VERSION", "FAULTS"],
+}
+PDAROWS = 8  # menu items shown at once, rows 1-8
+# Macros the viewer runs on the PDA, and the item each one switches
+PDAMACROS = [("cleaner", "CLEANER"), ("poolmode", "POOL MODE"), ("spalight", "SPA LIGHT"),
+             ("spaheater", "SPA HEATER"), ("blower", "AIR BLOWER"), ("poollight", "POOL LIGHT"),
+             ("spamode", "SPA MODE"), ("alloff", "ALL OFF")]
+
+
+def frame(dest, cmd, args):
+    """Build a complete DLE STX ... DLE ETX message, stuffing any DLEs."""
+    body = chr(dest) + chr(cmd) + args
+    body += chr((sum(bytearray(DLE + STX + body))) & 0xff)
+    return DLE + STX + body.replace(DLE, DLE + NUL) + DLE + ETX
+
+
+class Reader(object):
+    """Pulls whole frames out of the bytes the emulator writes back."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.buf = ""
+
+    def next(self, timeout):
+        """Return the next (dest, cmd, args) within timeout, or None."""
+        deadline = time.time() + timeout
+        while True:
+            start = self.buf.find(DLE + STX)
+            end = self.buf.find(DLE + ETX, start + 2)
+            if start >= 0 and end >= 0:
+                body = self.buf[start + 2:end].replace(DLE + NUL, DLE)
+                self.buf = self.buf[end + 2:]
+                if len(body) >= 3:
+                    return ord(body[0]), ord(body[1]), body[2:-1]
+                continue
+            left = deadline - time.time()
+            if left <= 0 or not select.select([self.fd], [], [], left)[0]:
+                return None
+            self.buf += os.read(self.fd, 1024)
+
+    def drain(self):
+        """Throw away whatever has come back so far, such as ACKs to probes
+        sent before the emulator opened the port or ACKs too late for their
+        exchange, so the next reply read is to the next message sent."""
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 1024)
+        self.buf = ""
+
+
+class Device(object):
+    """One emulated remote on the bus and what we've seen of it."""
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.online = False
+        self.keys = []         # key codes seen in ACKs, not yet acted on
+        self.keycount = 0      # keys acted on, shown on the screen
+        self.switched = {}     # PDA item -> times it has been switched
+        self.sent = self.acks = self.late = self.resends = self.lost = 0
+        self.times = []        # ACK latencies
+        self.script = self.run()
+
+    def run(self):
+        """Generate the (cmd, args) messages for this device, forever."""
+        while not self.online:
+            yield 0x00, ""
+        if self.addr in (0x20, 0x21, 0x22, 0x23):
+            bits = 0
+            temp = 100
+            while True:
+                while self.keys:
+                    key = self.keys.pop(0)
+                    bits ^= {0x09: 16, 0x03: 1, 0x06: 8}.get(key, 0)
+                    self.keycount += 1
+                yield 0x02, chr(bits)
+                temp = 98 + (temp - 97) % 5
+                yield 0x03, " %3d \x00 !  " % temp
+        if self.addr >= 0x60:
+            for msg in self.pda():
+                yield msg
+        menu = MENU
+        lines = len(menu)
+        yield 0x09, NUL
+        for n, text in enumerate(menu):
+            yield 0x04, chr(n) + text + NUL
+        sel = 1
+        yield 0x08, chr(sel)
+        tick = 0
+        while True:
+            while self.keys:
+                key = self.keys.pop(0)
+                if key == 0x05:
+                    sel = min(sel + 1, lines - 2)
+                elif key == 0x06:
+                    sel = max(sel - 1, 1)
+                self.keycount += 1
+                yield 0x08, chr(sel)
+                yield 0x04, chr(lines - 1) + ("KEY %d" % self.keycount) + NUL
+            yield 0x02, "\x00\x00\x00\x00\x00"
+            tick += 1
+            if tick % 10 == 0:
+                yield 0x04, chr(0) + time.strftime("    %H:%M:%S") + NUL
+            if tick % 25 == 0:
+                yield 0x0f, chr(1) + chr(lines - 2) + "\xff"
+                yield 0x04, chr(lines - 2) + menu[(tick / 25) % (lines - 2) + 1] + NUL
+            if tick % 40 == 0:
+                yield 0x10, chr(sel) + chr(0) + chr(3)
+
+    def pda(self):
+        """Generate the PDA's messages, forever: a menu tree driven by the
+        keys in its ACKs."""
+        on = {}
+        stack = []  # (menu, cursor, top) of the menus we came through
+        menu, cursor, top = "MAIN MENU", 0, 0
+        redraw = True
+        while True:
+            items = PDAMENUS[menu]
+            if redraw:
+                yield 0x09, NUL
+                yield 0x04, chr(0) + "    " + menu + NUL
+                for row in range(PDAROWS):
+                    text = ""
+                    if top + row < len(items):
+                        name = items[top + row]
+                        text = name
+                        if name not in PDAMENUS and name != "ALL OFF":
+                            state = on.get(name) and (name.endswith("HEATER") and "ENA" or "ON") or "OFF"
+                            text = name.ljust(13) + state.rjust(3)
+                    yield 0x04, chr(row + 1) + text + NUL
+                yield 0x04, chr(PDAROWS + 1) + (len(items) > PDAROWS and "^^ MORE vv" or "") + NUL
+                yield 0x08, chr(cursor - top + 1)
+                redraw = False
+            while self.keys and not redraw:
+                key = self.keys.pop(0)
+                self.keycount += 1
+                if key in (0x05, 0x06):  # down, up, wrapping round
+                    cursor = (cursor + (key == 0x05 and 1 or -1)) % len(items)
+                    if cursor < top or cursor >= top + PDAROWS:
+                        top = max(0, min(cursor, len(items) - PDAROWS))
+                        redraw = True
+                    else:
+                        yield 0x08, chr(cursor - top + 1)
+                elif key == 0x04:  # select
+                    name = items[cursor]
+                    if name in PDAMENUS:
+                        stack.append((menu, cursor, top))
+                        menu, cursor, top = name, 0, 0
+                    elif name == "ALL OFF":
+                        on = {}
+                    else:
+                        on[name] = not on.get(name)
+                    self.switched[name] = self.switched.get(name, 0) + 1
+                    redraw = True
+                elif key == 0x02 and stack:  # back
+                    menu, cursor, top = stack.pop()
+                    redraw = True
+            if not redraw:  # the new screen goes out before the next poll
+                yield 0x02, "\x00\x00\x00\x00\x00"
+
+    def summary(self):
+        """One line of counts and ACK latency percentiles."""
+        times = sorted(self.times)
+        return "%02x: sent %d  acks %d  late %d  resends %d  lost %d  keys %d  " \
+               "ack p50 %.1fms  p99 %.1fms  max %.1fms" % (
+                   self.addr, self.sent, self.acks, self.late, self.resends, self.lost,
+                   self.keycount, 1000 * percentile(times, 50),
+                   1000 * percentile(times, 99), 1000 * (times and times[-1] or 0))
+
+
+def percentile(times, pct):
+    """Return the pct'th percentile of an already sorted list."""
+    if not times:
+        return 0.0
+    return times[min(len(times) - 1, int(len(times) * pct / 100.0))]
+
+
+def exchange(fd, reader, dest, cmd, args):
+    """Send one message and wait for its ACK.  Returns (latency, keycode),
+    or None if nothing came back in time."""
+    reader.drain()
+    os.write(fd, frame(dest, cmd, args))
+    sent = time.time()
+    while True:
+        reply = reader.next(sent + ACKTIMEOUT - time.time())
+        if reply is None:
+            return None
+        dest, cmd, args = reply
+        if dest == 0x00 and cmd == 0x01:
+            return time.time() - sent, len(args) > 1 and ord(args[1]) or 0
+
+
+def master(fd, devices, deadline):
+    """Poll each device in turn until deadline, like the controller."""
+    reader = Reader(fd)
+    absent = 0
+    probed = 0
+    while time.time() < deadline:
+        for device in devices:
+            cmd, args = device.script.next()
+            device.sent += 1
+            # Probes go out once a cycle, anything else is re-sent when late
+            for attempt in range(device.online and RETRIES + 1 or 1):
+                if attempt:
+                    device.resends += 1
+                reply = exchange(fd, reader, device.addr, cmd, args)
+                if reply:
+                    break
+                if device.online and not attempt:
+                    device.late += 1
+            if reply:
+                latency, key = reply
+                device.acks += 1
+                if device.online:
+                    device.times.append(latency)
+                device.online = True
+                if key:
+                    device.keys.append(key)
+            elif device.online:
+                device.lost += 1
+                device.online = False
+                device.script = device.run()
+            time.sleep(GAP)
+        # The controller also probes addresses nobody answers to
+        if time.time() - probed > 1.0:
+            exchange(fd, reader, ABSENT[absent % len(ABSENT)], 0x00, "")
+            absent += 1
+            probed = time.time()
+
+
+def viewer(host, device, deadline, times, misses):
+    """Press keys through the web server and time until the reply shows
+    up in /state.json."""
+    conn = httplib.HTTPConnection(host, timeout=10)
+    spa = device.addr < 0x40
+    # aquaweb serves each of its devices under /<address>/, the PDA has one
+    prefix = device.addr < 0x60 and "/%02x" % device.addr or ""
+    cgi = prefix + (spa and "/spakey.cgi" or "/key.cgi")
+    key = spa and "3" or "down"  # jets toggle, or move down the menu
+    while time.time() < deadline - KEYTIMEOUT:
+        if not device.online:
+            time.sleep(0.1)
+            continue
+        target = device.keycount + 1
+        start = time.time()
+        conn.request('POST', cgi, "key=" + key, {'Content-Type': 'application/x-www-form-urlencoded'})
+        conn.getresponse().read()
+        while True:
+            conn.request('GET', prefix + '/state.json')
+            state = json.loads(conn.getresponse().read())
+            if spa:
+                seen = state['spa']['status']['jets'] == (target % 2 and "ON" or "OFF")
+            else:
+                lines = 'screen' in state and state['screen']['lines'] or state['lines']
+                seen = lines[-1].startswith("KEY %d " % target)
+            if seen:
+                times.append(time.time() - start)
+                break
+            if time.time() - start > KEYTIMEOUT:
+                misses.append(1)
+                break
+            time.sleep(0.005)
+        time.sleep(0.2)
+
+
+def macroViewer(host, device, deadline, times, misses, steps):
+    """Run macros on the PDA through the web server and time each one
+    until the simulator switches what it's for."""
+    n = 0
+    while time.time() < deadline - MACROTIMEOUT:
+        if not device.online:
+            time.sleep(0.1)
+            continue
+        key, item = PDAMACROS[n % len(PDAMACROS)]
+        n += 1
+        target = device.switched.get(item, 0) + 1
+        keys = device.keycount
+        start = time.time()
+        # a fresh connection each time, a macro can outlast keep-alive
+        conn = httplib.HTTPConnection(host, timeout=10)
+        conn.request('POST', '/key.cgi', "key=" + key, {'Content-Type': 'application/x-www-form-urlencoded'})
+        conn.getresponse().read()
+        conn.close()
+        while device.switched.get(item, 0) < target:
+            if time.time() - start > MACROTIMEOUT:
+                misses.append(key)
+                break
+            time.sleep(0.005)
+        else:
+            times.append(time.time() - start)
+            steps.append(device.keycount - keys)
+        time.sleep(0.2)
+
+
+def main():
+    """Set up the pty, run the master and viewer, print the summary."""
+    link = len(sys.argv) > 1 and sys.argv[1] or "/tmp/aquaweb-sim"
+    seconds = len(sys.argv) > 2 and float(sys.argv[2]) or 30.0
+    ids = len(sys.argv) > 3 and sys.argv[3] or "40,20"
+    host = len(sys.argv) > 4 and sys.argv[4] or None
+
+    fd, slave = pty.openpty()
+    tty.setraw(slave)  # no echo or line editing, even before aquaweb opens it
+    if os.path.lexists(link):
+        os.unlink(link)
+    os.symlink(os.ttyname(slave), link)
+    print "master on %s -> %s" % (link, os.ttyname(slave))
+
+    devices = [Device(int(addr, 16)) for addr in ids.split(",")]
+    deadline = time.time() + seconds
+    times = []
+    misses = []
+    steps = []
+    threads = []
+    if host:
+        watch = [d for d in devices if d.addr >= 0x40] or devices
+        if watch[0].addr >= 0x60:
+            threads.append(threading.Thread(target=macroViewer,
+                                            args=(host, watch[0], deadline, times, misses, steps)))
+        else:
+            threads.append(threading.Thread(target=viewer, args=(host, watch[0], deadline, times, misses)))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        master(fd, devices, deadline)
+    finally:
+        os.unlink(link)
+    for t in threads:
+        t.join(KEYTIMEOUT)
+
+    print "%s, %.0fs" % (ids, seconds)
+    for device in devices:
+        print device.summary()
+    if host and watch[0].addr >= 0x60:
+        steps.sort()
+        times.sort()
+        print "macros: %d done  %d missed  p50 %.0fms  p90 %.0fms  max %.0fms  keys p50 %d  max %d" % (
+            len(times), len(misses), 1000 * percentile(times, 50), 1000 * percentile(times, 90),
+            1000 * (times and times[-1] or 0), percentile(steps, 50), steps and steps[-1] or 0)
+    elif host:
+        times.sort()
+        print "key to screen: %d keys  %d missed  p50 %.1fms  p90 %.1fms  max %.1fms" % (
+            len(times), len(misses), 1000 * percentile(times, 50),
+            1000 * percentile(times, 90), 1000 * (times and times[-1] or 0))
+
+
+if __name__ == "__main__":
+    main()